@@ -20,6 +20,9 @@ import os
 import sys
 import bs4
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline'))
+from utils import elements
+
 
 PUBMED_DIR = '/data/random-dataset-trunk/ftp.ncbi.nlm.nih.gov/pub/pmc/oa_bulk/decompressed'
 PUBMED_DIR = '/DATA/eager/pubmed-01000'
@@ -28,17 +31,8 @@ FILE_LIST = '../../data/files_random.txt'
 
 
 def analyze(filelist, start, end):
-    process = False
-    line_number = 1
-    for line in open(filelist):
-        fname = line.strip()
-        if line_number == start:
-            process = True
-        if process:
-            analyze_abstract(line_number, fname)
-        if line_number == end:
-            break
-        line_number += 1
+    for line_number, fname in elements(filelist, start, end):
+        analyze_abstract(line_number, fname)
 
 
 def analyze_abstract(line_number, fname):
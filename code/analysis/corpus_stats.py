@@ -0,0 +1,260 @@
+"""corpus_stats.py
+
+Collect statistics on the nxml files in one pass over each file.
+
+Usage:
+
+$ python3 corpus_stats.py -s PUBMED_DIR -f FILE_LIST -b BEGIN -e END [OPTIONS]
+$ python3 corpus_stats.py --merge OUTFILE INFILE1 INFILE2 ...
+
+The first invocation streams through all files on lines BEGIN through END of
+FILE_LIST (paths relative to PUBMED_DIR) with lxml's iterparse, without building
+a tree for the whole document, and collects histograms. Options:
+
+-j JOBS             number of worker processes (default 1)
+-o OUTFILE          write the JSON to OUTFILE instead of to the standard output
+--shard I/N         only use the I-th of N shards, see utils.parse_shard()
+--collect NAMES     comma-separated list of histograms to collect, the default
+                    is to collect all of them
+
+The histograms are:
+
+abstracts   parent tag and attributes of abstracts, this is what
+            analyze_abstracts.py prints for each file
+tags        number of occurrences of each tag
+types       article types (the article-type attribute of the article tag)
+sizes       file sizes in bytes, in powers of two
+missing     number of files missing each of the fields that convert_nxml.py
+            extracts (id-pmid, id-pmc, title, abstract, journal, year, authors)
+journals    number of files per journal
+journal_bytes   number of bytes per journal
+
+The output is a JSON object with the number of files, the number of files that
+could not be parsed and the histograms. Outputs of separate runs, for example
+runs on different shards, can be added up with the --merge invocation.
+
+This replaces count_pmc_files.py, the journal histograms have the same counts.
+
+"""
+
+
+import os
+import sys
+import json
+import getopt
+import collections
+import multiprocessing
+
+from lxml import etree
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline'))
+from utils import elements, parse_shard
+
+
+PUBMED_DIR = '/data/random-dataset-trunk/ftp.ncbi.nlm.nih.gov/pub/pmc/oa_bulk/decompressed'
+PUBMED_DIR = '/DATA/eager/pubmed-01000'
+
+FILE_LIST = '../../data/files-random-01000.txt'
+
+HISTOGRAMS = ('abstracts', 'tags', 'types', 'sizes', 'missing', 'journals', 'journal_bytes')
+
+FIELDS = ('id-pmid', 'id-pmc', 'title', 'abstract', 'journal', 'year', 'authors')
+
+# number of files handed to a worker at once
+CHUNK_SIZE = 64
+
+
+def tag_name(element):
+    """Return the tag name with the namespace prefix as used in the file, for
+    example mml:math instead of {http://www.w3.org/1998/Math/MathML}math."""
+    name = etree.QName(element).localname
+    return "%s:%s" % (element.prefix, name) if element.prefix else name
+
+
+def parent_name(element):
+    parent = element.getparent()
+    return tag_name(parent) if parent is not None else None
+
+
+def file_statistics(path, journal, collect):
+    """Return a dictionary of Counters for one file."""
+    stats = {name: collections.Counter() for name in collect}
+    size = os.path.getsize(path)
+    if 'sizes' in collect:
+        stats['sizes'][str(1 << max(0, size - 1).bit_length())] += 1
+    if 'journals' in collect:
+        stats['journals'][journal] += 1
+    if 'journal_bytes' in collect:
+        stats['journal_bytes'][journal] += size
+    found = set()
+    context = etree.iterparse(path, events=('start', 'end'), recover=True,
+                              resolve_entities=False, load_dtd=False, no_network=True)
+    for event, element in context:
+        if not isinstance(element.tag, str):
+            # comments and processing instructions
+            continue
+        name = tag_name(element)
+        if event == 'start':
+            if 'tags' in collect:
+                stats['tags'][name] += 1
+            if name == 'article' and 'types' in collect:
+                stats['types'][element.get('article-type', 'None')] += 1
+            if name == 'abstract' and 'abstracts' in collect:
+                stats['abstracts']["%s %s" % (parent_name(element), _attrs(element))] += 1
+            continue
+        # at the end event the text of the element is available, all checks
+        # only look at the element and its ancestors so the element can be
+        # cleared afterwards
+        _check_fields(element, name, found)
+        element.clear(keep_tail=True)
+    if 'missing' in collect:
+        for field in FIELDS:
+            if field not in found:
+                stats['missing'][field] += 1
+    return stats
+
+
+def _attrs(element):
+    return json.dumps(dict(element.attrib), sort_keys=True)
+
+
+def _check_fields(element, name, found):
+    parent = parent_name(element)
+    if name == 'article-id' and parent == 'article-meta':
+        if element.get('pub-id-type') == 'pmid':
+            found.add('id-pmid')
+        elif element.get('pub-id-type') == 'pmc':
+            found.add('id-pmc')
+    elif name == 'article-title' and parent == 'title-group':
+        found.add('title')
+    elif name == 'abstract':
+        found.add('abstract')
+    elif name == 'journal-title' and parent == 'journal-title-group':
+        found.add('journal')
+    elif name == 'year' and parent == 'pub-date':
+        if parent_name(element.getparent()) == 'article-meta':
+            found.add('year')
+    elif name == 'contrib' and parent == 'contrib-group':
+        if element.get('contrib-type') == 'author':
+            found.add('authors')
+
+
+def chunk_statistics(args):
+    """Collect statistics for a list of file names, this runs in the workers."""
+    pubmed_dir, fnames, collect = args
+    result = new_result()
+    for fname in fnames:
+        try:
+            stats = file_statistics(os.path.join(pubmed_dir, fname),
+                                    os.path.split(fname)[0], collect)
+        except Exception as e:
+            sys.stderr.write("ERROR on %s  %s\n" % (fname, e))
+            result['errors'] += 1
+            continue
+        result['files'] += 1
+        for name, counter in stats.items():
+            result['histograms'].setdefault(name, collections.Counter()).update(counter)
+    return result
+
+
+def new_result():
+    return {'files': 0, 'errors': 0, 'histograms': {}}
+
+
+def merge_results(result, other):
+    """Add the counts in other to result and return result."""
+    result['files'] += other['files']
+    result['errors'] += other['errors']
+    for name, histogram in other['histograms'].items():
+        result['histograms'].setdefault(name, collections.Counter()).update(histogram)
+    return result
+
+
+def _chunks(items, size):
+    chunk = []
+    for n, fname in items:
+        chunk.append(fname)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def collect_statistics(pubmed_dir, filelist, start, end, jobs=1, collect=HISTOGRAMS,
+                       shard=None):
+    result = new_result()
+    tasks = ((pubmed_dir, chunk, collect)
+             for chunk in _chunks(elements(filelist, start, end, shard), CHUNK_SIZE))
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            for chunk_result in pool.imap_unordered(chunk_statistics, tasks):
+                merge_results(result, chunk_result)
+                sys.stderr.write("\r%d files" % result['files'])
+    else:
+        for task in tasks:
+            merge_results(result, chunk_statistics(task))
+            sys.stderr.write("\r%d files" % result['files'])
+    sys.stderr.write("\n")
+    return result
+
+
+def write_result(result, fname=None):
+    histograms = {name: dict(sorted(histogram.items()))
+                  for name, histogram in result['histograms'].items()}
+    data = {'files': result['files'], 'errors': result['errors'], 'histograms': histograms}
+    s = json.dumps(data, indent=4)
+    if fname is None:
+        print(s)
+    else:
+        with open(fname, 'w') as fh:
+            fh.write(s + "\n")
+
+
+def read_result(fname):
+    with open(fname) as fh:
+        data = json.load(fh)
+    data['histograms'] = {name: collections.Counter(histogram)
+                          for name, histogram in data['histograms'].items()}
+    return data
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 corpus_stats.py -s PUBMED_DIR -f FILE_LIST -b BEGIN -e END"
+          + "\n          [-j JOBS] [-o OUTFILE] [--shard I/N] [--collect NAMES]"
+          + "\n    $ python3 corpus_stats.py --merge OUTFILE INFILE1 INFILE2 ..."
+          + "\n    $ python3 corpus_stats.py (-h | --help)\n")
+
+
+def main(args):
+    opts, args = getopt.getopt(args, 's:f:b:e:j:o:h',
+                               ['shard=', 'collect=', 'merge=', 'help'])
+    options = dict(opts)
+
+    if '-h' in options or '--help' in options:
+        usage()
+    elif '--merge' in options:
+        result = new_result()
+        for fname in args:
+            merge_results(result, read_result(fname))
+        write_result(result, options['--merge'])
+    else:
+        collect = HISTOGRAMS
+        if '--collect' in options:
+            collect = tuple(options['--collect'].split(','))
+            unknown = set(collect).difference(HISTOGRAMS)
+            if unknown:
+                exit("ERROR: unknown histograms: %s" % ', '.join(sorted(unknown)))
+        shard = parse_shard(options['--shard']) if '--shard' in options else None
+        result = collect_statistics(options.get('-s', PUBMED_DIR),
+                                    options.get('-f', FILE_LIST),
+                                    int(options.get('-b', 1)), int(options.get('-e', 1)),
+                                    jobs=int(options.get('-j', 1)), collect=collect,
+                                    shard=shard)
+        write_result(result, options.get('-o'))
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -2,18 +2,20 @@
 
 Just counting the files and printing some counts for large journals.
 
+See corpus_stats.py for a version that collects this and more in one pass.
+
 """
 
 import os
 
 PUBMED_DIR = '/data/random-dataset-trunk/ftp.ncbi.nlm.nih.gov/pub/pmc/oa_bulk/decompressed'
 
-journals = os.listdir(DIR)
+journals = os.listdir(PUBMED_DIR)
 doc_count = 0
 c = 0
 for journal in journals:
     c += 1
-    journal_dir = os.path.join(DIR, journal)
+    journal_dir = os.path.join(PUBMED_DIR, journal)
     files = os.listdir(journal_dir)
     journal_files = len(files)
     doc_count += journal_files
@@ -0,0 +1,180 @@
+"""bench_startup.py
+
+Measure the startup time of the commands of eager_elk.py.
+
+Usage:
+
+$ python3 bench_startup.py [-n RUNS] [-o OUTFILE] [--compare FILE [--threshold F]]
+
+For each command this runs "eager_elk.py COMMAND --help" RUNS times (default 5)
+in a new Python process and prints the fastest and the median wall clock time,
+together with the time of a Python process that does nothing. It also lists
+which of the heavy modules in HEAVY_MODULES are loaded by importing the module
+of the command. Most of them are only needed once work is being done and
+should not be loaded, the exceptions are in EXPECTED_IMPORTS: numpy is
+imported at the top of the modules of the vectors, index, cube, citations and
+export commands, which work on numpy arrays throughout. Expected imports are
+shown in parentheses.
+
+Since --help does not load the modules that are only needed for real work, the
+commands in WORK_COMMANDS are also timed on a corpus of one small article that
+is created in a temporary directory. These times include loading bs4 and lxml
+for convert and numpy for index, they are listed as "convert run" and so on.
+
+With -o the median times are written to OUTFILE as JSON. With --compare the
+times are compared to those in FILE, written earlier with -o, and the exit
+status is 1 if any command got slower by more than a fraction F (default 0.25)
+and more than 20 milliseconds, so this can be used to keep track of startup
+time.
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import getopt
+import statistics
+import tempfile
+import subprocess
+
+from eager_elk import COMMANDS, PIPELINE_DIR
+
+
+RUNS = 5
+THRESHOLD = 0.25
+
+# slower commands are only reported if they are at least this many seconds slower
+MIN_DIFFERENCE = 0.02
+
+HEAVY_MODULES = ('gensim', 'nltk', 'bs4', 'lxml', 'numpy', 'scipy', 'pyarrow')
+
+# heavy modules that are expected to be loaded by the module of a command
+EXPECTED_IMPORTS = {
+    'topic_vectors': ('numpy',),
+    'search_index': ('numpy',),
+    'cube': ('numpy',),
+    'citations': ('numpy',),
+    'export_table': ('numpy',)}
+
+# commands that are run on the one article corpus, each one uses the output of
+# the one before it
+WORK_COMMANDS = (
+    ('convert', ['-s', '{source}', '-d', '{data}', '-f', '{filelist}', '-b', '1', '-e', '1']),
+    ('lif', ['-d', '{data}', '-f', '{filelist}', '-s', '1', '-e', '1']),
+    ('index', ['--build', '-d', '{data}', '-f', '{filelist}', '-b', '1', '-e', '1']))
+
+SAMPLE_FILE = 'Sample_Journal/PMC0000001.nxml'
+
+SAMPLE_NXML = """<?xml version="1.0"?>
+<!DOCTYPE article>
+<article article-type="research-article"><front><journal-meta><journal-title-group>
+<journal-title>Sample Journal</journal-title></journal-title-group></journal-meta>
+<article-meta><article-id pub-id-type="pmid">1</article-id>
+<article-id pub-id-type="pmc">1</article-id>
+<title-group><article-title>Startup time of the pipeline</article-title></title-group>
+<pub-date pub-type="epub"><year>2020</year></pub-date>
+<abstract><p>The time needed to load the modules of a command.</p></abstract>
+</article-meta></front>
+<body><sec><title>Introduction</title><p>Some text about proteins and cells.</p></sec></body>
+</article>
+"""
+
+
+def time_command(args, runs=RUNS):
+    """Return the times of running a Python process with args."""
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        result = subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, cwd=PIPELINE_DIR)
+        times.append(time.perf_counter() - t0)
+        if result.returncode != 0:
+            print("WARNING: %s exited with status %d" % (' '.join(args), result.returncode))
+    return times
+
+
+def heavy_imports(module):
+    """Return the heavy modules that are loaded by importing the module."""
+    if module.endswith('.py'):
+        return []
+    code = ("import sys, %s; print(' '.join(m for m in %r if m in sys.modules))"
+            % (module, HEAVY_MODULES))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                            text=True, cwd=PIPELINE_DIR)
+    expected = EXPECTED_IMPORTS.get(module, ())
+    return [('(%s)' % m if m in expected else m) for m in result.stdout.split()]
+
+
+def benchmark(runs=RUNS):
+    results = {'python': statistics.median(time_command(['-c', 'pass'], runs))}
+    print("\n%-14s %9s %9s   %s" % ('command', 'min', 'median', 'heavy imports'))
+    print("%-14s %9s %8.1fms" % ('(python)', '', results['python'] * 1000))
+    for name, module, description in COMMANDS:
+        times = time_command(['eager_elk.py', name, '--help'], runs)
+        results[name] = statistics.median(times)
+        print("%-14s %7.1fms %7.1fms   %s" % (name, min(times) * 1000, results[name] * 1000,
+                                            ' '.join(heavy_imports(module)) or '-'))
+    results.update(benchmark_work(runs))
+    return results
+
+
+def benchmark_work(runs=RUNS):
+    """Time the commands in WORK_COMMANDS on the one article corpus."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {'source': os.path.join(tmp_dir, 'source'),
+                 'data': os.path.join(tmp_dir, 'data'),
+                 'filelist': os.path.join(tmp_dir, 'files.txt')}
+        os.makedirs(os.path.join(paths['source'], os.path.dirname(SAMPLE_FILE)))
+        with open(os.path.join(paths['source'], SAMPLE_FILE), 'w') as fh:
+            fh.write(SAMPLE_NXML)
+        with open(paths['filelist'], 'w') as fh:
+            fh.write(SAMPLE_FILE + "\n")
+        for name, args in WORK_COMMANDS:
+            args = [arg.format(**paths) for arg in args]
+            times = time_command(['eager_elk.py', name] + args, runs)
+            name += ' run'
+            results[name] = statistics.median(times)
+            print("%-14s %7.1fms %7.1fms" % (name, min(times) * 1000, results[name] * 1000))
+    return results
+
+
+def compare(results, previous, threshold=THRESHOLD):
+    """Print the commands that got slower and return True if there were any."""
+    slower = False
+    for name, seconds in sorted(results.items()):
+        before = previous.get(name)
+        if before is None:
+            continue
+        if seconds > before * (1 + threshold) and seconds - before > MIN_DIFFERENCE:
+            print("SLOWER  %-14s %7.1fms -> %7.1fms" % (name, before * 1000, seconds * 1000))
+            slower = True
+    if not slower:
+        print("\nNo command got slower than in the earlier run")
+    return slower
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 bench_startup.py [-n RUNS] [-o OUTFILE] [--compare FILE [--threshold F]]"
+          + "\n    $ python3 bench_startup.py (-h | --help)\n")
+
+
+if __name__ == '__main__':
+
+    options = dict(getopt.getopt(sys.argv[1:], 'n:o:h', ['compare=', 'threshold=', 'help'])[0])
+
+    if '-h' in options or '--help' in options:
+        usage()
+    else:
+        results = benchmark(int(options.get('-n', RUNS)))
+        if '-o' in options:
+            with open(options['-o'], 'w') as fh:
+                json.dump(results, fh, indent=4)
+        if '--compare' in options:
+            with open(options['--compare']) as fh:
+                previous = json.load(fh)
+            if compare(results, previous, float(options.get('--threshold', THRESHOLD))):
+                sys.exit(1)
@@ -0,0 +1,410 @@
+"""citations.py
+
+Citation graph of the corpus, with "cites" and "cited by" lookups, citation
+counts and PageRank.
+
+Usage:
+
+$ python3 citations.py --build -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS]
+$ python3 citations.py --cites DOC -d DATA_DIR
+$ python3 citations.py --cited-by DOC -d DATA_DIR
+$ python3 citations.py --co-cited DOC -d DATA_DIR [-k K]
+$ python3 citations.py --top -d DATA_DIR [-k K] [--rank (count|pagerank)]
+
+The first invocation builds the graph for the documents on lines BEGIN through
+END of FILELIST and writes it to DATA_DIR/cit. The pmid of each document and the
+pmids of its references are taken from the JSON files in DATA_DIR/jsn, which
+only have references if convert_nxml.py was run with --references. A reference
+is an edge in the graph if its pmid is the pmid of a document in the range,
+other references are only counted. If more than one document has the same pmid
+references to it go to the first of them, run dedup.py first to avoid this.
+With -j JOBS the JSON files are read by JOBS worker processes, each worker
+writes the references of a chunk of documents to a part file which is then
+resolved and added to the graph, so the references of all documents are never
+in memory at once.
+
+DOC is a pmid or a file name from FILELIST. The second and third invocations
+print the documents that DOC cites and the documents that cite DOC. The fourth
+prints the K (default 10) documents that are most often cited together with DOC.
+The fifth prints the K documents with the most citations in the corpus, or with
+the highest PageRank.
+
+From Python:
+
+>>> graph = CitationGraph(data_dir)
+>>> graph.cited_by(graph.lookup('12345678'))
+>>> graph.most_cited(k=10)
+
+The graph is made up of these files:
+
+    docs.bin, docs.offsets.npy          file names of the documents
+    docs.order.npy                      documents sorted on file name
+    pmids.npy, pmids.order.npy          pmid of each document (or -1), and the
+                                        documents sorted on pmid
+    cites.indptr.npy, cites.npy         documents cited by each document
+    cited_by.indptr.npy, cited_by.npy   documents citing each document
+    references.npy                      number of references with a pmid of
+                                        each document, including those that
+                                        are not in the corpus
+    pagerank.npy                        PageRank of each document
+    meta.json                           number of documents, references and
+                                        edges
+
+Both directions of the graph are stored in compressed sparse row format, the
+documents cited by document i are cites[cites.indptr[i]:cites.indptr[i+1]], in
+increasing order, and the same goes for cited_by. All files are memory-mapped,
+so opening the graph is instant and a lookup reads only two short slices. The
+citation counts are the differences of the indptr arrays, and PageRank and the
+co-citation counts are computed with numpy over the edge arrays.
+
+The graph is not kept up to date by update.py, build it again after updates.
+
+"""
+
+
+import os
+import sys
+import json
+import getopt
+import shutil
+import functools
+
+import numpy as np
+
+from utils import elements, time_elapsed, open_file, existing_file
+from utils import write_strings, MappedStrings
+from schedule import run_jobs
+
+
+# number of documents handed to a worker at once
+CHUNK_SIZE = 5000
+
+NO_PMID = -1
+
+# damping factor and stopping criterion for PageRank
+DAMPING = 0.85
+TOLERANCE = 1e-10
+MAX_ITERATIONS = 100
+
+
+def graph_dir(data_dir):
+    return os.path.join(data_dir, 'cit')
+
+
+def parse_pmid(pmid):
+    """Return the pmid as an integer, or NO_PMID if there is none."""
+    if pmid is None:
+        return NO_PMID
+    pmid = str(pmid).strip()
+    return int(pmid) if pmid.isdigit() else NO_PMID
+
+
+def document_references(data_dir, fname):
+    """Return the pmid of a document and the pmids of its references."""
+    with open_file(existing_file(os.path.join(data_dir, 'jsn', fname))) as fh:
+        json_obj = json.load(fh)
+    refs = [parse_pmid(ref.get('pmid')) for ref in json_obj.get('references', [])]
+    return parse_pmid(json_obj.get('id-pmid')), [pmid for pmid in refs if pmid != NO_PMID]
+
+
+## Building
+
+def read_chunk(data_dir, tmp_dir, chunk):
+    """Collect the references of a list of (docid, fname) pairs, this runs in the
+    workers. The number of references of each document and the pmids of all
+    references are written to a part file, returns the name of the part file,
+    the document identifiers and their pmids."""
+    pmids = np.full(len(chunk), NO_PMID, dtype=np.int64)
+    counts = np.zeros(len(chunk), dtype=np.int32)
+    refs = []
+    for i, (docid, fname) in enumerate(chunk):
+        try:
+            pmids[i], doc_refs = document_references(data_dir, fname)
+        except Exception as e:
+            sys.stderr.write("ERROR on %s  %s\n" % (fname, e))
+            continue
+        counts[i] = len(doc_refs)
+        refs.extend(doc_refs)
+    basename = os.path.join(tmp_dir, 'part-%09d' % chunk[0][0])
+    np.save(basename + '.counts.npy', counts)
+    np.save(basename + '.refs.npy', np.array(refs, dtype=np.int64))
+    return basename, [docid for docid, fname in chunk], pmids
+
+
+def _chunks(fnames, size):
+    chunk = []
+    for docid, fname in enumerate(fnames):
+        chunk.append((docid, fname))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@time_elapsed
+def build(data_dir, filelist, start, end, jobs=1):
+    out_dir = graph_dir(data_dir)
+    tmp_dir = os.path.join(out_dir, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    fnames = [fname for n, fname in elements(filelist, start, end)]
+    write_strings(os.path.join(out_dir, 'docs'), fnames)
+    np.save(os.path.join(out_dir, 'docs.order.npy'),
+            np.array(sorted(range(len(fnames)), key=fnames.__getitem__), dtype=np.int32))
+    pmids = np.full(len(fnames), NO_PMID, dtype=np.int64)
+    parts = []
+    done = 0
+    fun = functools.partial(read_chunk, data_dir, tmp_dir)
+    for basename, docids, chunk_pmids in run_jobs(fun, _chunks(fnames, CHUNK_SIZE), jobs):
+        parts.append((docids[0], basename))
+        pmids[docids] = chunk_pmids
+        done += len(docids)
+        sys.stderr.write("\r%d documents" % done)
+    sys.stderr.write("\n")
+    # all pmids are needed to resolve references, so the part files are only
+    # resolved once all of them are written, in the order of the documents
+    parts.sort()
+    sources, targets, references = resolve_parts([basename for docid, basename in parts], pmids)
+    graph = write_graph(out_dir, pmids, sources, targets, references)
+    shutil.rmtree(tmp_dir)
+    print("Wrote %s with %d documents, %d references and %d citations in the corpus"
+          % (out_dir, graph['documents'], graph['references'], graph['edges']))
+
+
+def resolve_parts(parts, pmids):
+    """Resolve the references in the part files against the pmids of the
+    documents. Returns the sources and targets of the edges, ordered on source
+    and then on target, and the number of references of each document."""
+    # only documents with a pmid, sorted on pmid, the stable sort puts the first
+    # document with a pmid first
+    order = np.argsort(pmids, kind='stable')
+    order = order[pmids[order] != NO_PMID]
+    sorted_pmids = pmids[order]
+    sources = []
+    targets = []
+    references = []
+    first = 0
+    for basename in parts:
+        counts = np.load(basename + '.counts.npy')
+        refs = np.load(basename + '.refs.npy', mmap_mode='r')
+        references.append(counts)
+        src = np.repeat(np.arange(first, first + len(counts), dtype=np.int64), counts)
+        first += len(counts)
+        positions = np.searchsorted(sorted_pmids, refs)
+        positions[positions == len(sorted_pmids)] = 0
+        found = (sorted_pmids[positions] == refs) if len(sorted_pmids) else np.zeros(len(refs), bool)
+        dst = order[positions[found]]
+        src = src[found]
+        # drop self citations and references to the same document more than once
+        keep = src != dst
+        edges = np.unique(src[keep] * len(pmids) + dst[keep])
+        sources.append((edges // len(pmids)).astype(np.int32))
+        targets.append((edges % len(pmids)).astype(np.int32))
+    if not parts:
+        return np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0, np.int32)
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(references)
+
+
+def csr(rows, columns, num_rows):
+    """Return the indptr and indices arrays of the compressed sparse row matrix
+    with the (row, column) pairs, rows must be sorted."""
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+    return indptr, columns
+
+
+def pagerank(sources, targets, num_docs, damping=DAMPING):
+    """Return the PageRank of each document, documents without references
+    spread their rank over all documents."""
+    if num_docs == 0:
+        return np.zeros(0)
+    out_degree = np.bincount(sources, minlength=num_docs).astype(np.float64)
+    dangling = out_degree == 0
+    out_degree[dangling] = 1.0
+    rank = np.full(num_docs, 1.0 / num_docs)
+    for _ in range(MAX_ITERATIONS):
+        share = rank / out_degree
+        new_rank = np.bincount(targets, weights=share[sources], minlength=num_docs)
+        new_rank = damping * (new_rank + rank[dangling].sum() / num_docs) + (1 - damping) / num_docs
+        change = np.abs(new_rank - rank).sum()
+        rank = new_rank
+        if change < TOLERANCE:
+            break
+    return rank
+
+
+def write_graph(out_dir, pmids, sources, targets, references):
+    num_docs = len(pmids)
+    cites_indptr, cites = csr(sources, targets, num_docs)
+    # a stable sort on the targets keeps the sources of each target sorted
+    order = np.argsort(targets, kind='stable')
+    cited_by_indptr, cited_by = csr(targets[order], sources[order], num_docs)
+    np.save(os.path.join(out_dir, 'pmids.npy'), pmids)
+    np.save(os.path.join(out_dir, 'pmids.order.npy'), np.argsort(pmids, kind='stable').astype(np.int32))
+    np.save(os.path.join(out_dir, 'cites.indptr.npy'), cites_indptr)
+    np.save(os.path.join(out_dir, 'cites.npy'), cites)
+    np.save(os.path.join(out_dir, 'cited_by.indptr.npy'), cited_by_indptr)
+    np.save(os.path.join(out_dir, 'cited_by.npy'), cited_by)
+    np.save(os.path.join(out_dir, 'references.npy'), references)
+    np.save(os.path.join(out_dir, 'pagerank.npy'), pagerank(sources, targets, num_docs))
+    meta = {'documents': num_docs,
+            'documents_with_pmid': int((pmids != NO_PMID).sum()),
+            'references': int(references.sum()),
+            'edges': len(sources)}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh, indent=4)
+    return meta
+
+
+## Queries
+
+class CitationGraph(object):
+
+    def __init__(self, data_dir):
+        directory = graph_dir(data_dir)
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+        self.docs = MappedStrings(os.path.join(directory, 'docs'))
+        load = lambda name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        self.docs_order = load('docs.order')
+        self.pmids = load('pmids')
+        self.pmids_order = load('pmids.order')
+        self.cites_indptr = load('cites.indptr')
+        self.cites_indices = load('cites')
+        self.cited_by_indptr = load('cited_by.indptr')
+        self.cited_by_indices = load('cited_by')
+        self.references = load('references')
+        self.pagerank = load('pagerank')
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def lookup(self, doc):
+        """Return the document identifier for a pmid or a file name, or None if
+        there is no such document."""
+        if str(doc).isdigit():
+            pmid = int(doc)
+            i = np.searchsorted(self.pmids, pmid, sorter=self.pmids_order)
+            if i < len(self) and self.pmids[self.pmids_order[i]] == pmid:
+                return int(self.pmids_order[i])
+            return None
+        # binary search on the file names, which are decoded as needed
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.docs[int(self.docs_order[middle])] < doc:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.docs[int(self.docs_order[low])] == doc:
+            return int(self.docs_order[low])
+        return None
+
+    def cites(self, docid):
+        """Return the documents cited by a document."""
+        return self.cites_indices[self.cites_indptr[docid]:self.cites_indptr[docid + 1]]
+
+    def cited_by(self, docid):
+        """Return the documents that cite a document."""
+        return self.cited_by_indices[self.cited_by_indptr[docid]:self.cited_by_indptr[docid + 1]]
+
+    def citation_counts(self):
+        """Return the number of citations in the corpus of each document."""
+        return np.diff(self.cited_by_indptr)
+
+    def reference_counts(self):
+        """Return the number of references to documents in the corpus of each
+        document."""
+        return np.diff(self.cites_indptr)
+
+    def most_cited(self, k=10, rank='count'):
+        """Return the identifiers of the k documents with the most citations, or
+        with the highest PageRank if rank is 'pagerank'."""
+        scores = self.pagerank if rank == 'pagerank' else self.citation_counts()
+        k = min(k, len(scores))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        best = np.argpartition(-scores, k - 1)[:k]
+        return best[np.argsort(-scores[best], kind='stable')]
+
+    def co_cited(self, docid, k=10):
+        """Return the k documents most often cited together with a document, as
+        a list of (docid, count) pairs."""
+        citing = self.cited_by(docid)
+        if len(citing) == 0:
+            return []
+        starts = self.cites_indptr[citing]
+        lengths = self.cites_indptr[np.asarray(citing) + 1] - starts
+        # positions in cites of the references of all citing documents
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        counts = np.bincount(self.cites_indices[positions], minlength=len(self))
+        counts[docid] = 0
+        best = [i for i in np.argsort(-counts, kind='stable')[:k] if counts[i] > 0]
+        return [(int(i), int(counts[i])) for i in best]
+
+
+def print_documents(graph, docids, counts=None):
+    """Print the pmid, the number of citations and the file name of documents,
+    preceded by the counts if there are any."""
+    citations = graph.citation_counts()
+    for n, docid in enumerate(docids):
+        pmid = int(graph.pmids[docid])
+        prefix = '' if counts is None else "%6d  " % counts[n]
+        print("%s%10s  %6d  %s" % (prefix, pmid if pmid != NO_PMID else '-',
+                                   citations[docid], graph.docs[int(docid)]))
+
+
+def lookup_or_exit(graph, doc):
+    docid = graph.lookup(doc)
+    if docid is None:
+        print("No document %s" % doc)
+        sys.exit(1)
+    return docid
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 citations.py --build -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS]"
+          + "\n    $ python3 citations.py --cites DOC -d DATA_DIR"
+          + "\n    $ python3 citations.py --cited-by DOC -d DATA_DIR"
+          + "\n    $ python3 citations.py --co-cited DOC -d DATA_DIR [-k K]"
+          + "\n    $ python3 citations.py --top -d DATA_DIR [-k K] [--rank (count|pagerank)]"
+          + "\n    $ python3 citations.py (-h | --help)\n")
+
+
+def main(args):
+    data_dir = '/DATA/eager/sample-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(
+        args, 'd:f:b:e:j:k:h',
+        ['build', 'cites=', 'cited-by=', 'co-cited=', 'top', 'rank=', 'help'])[0])
+    data_dir = options.get('-d', data_dir)
+    k = int(options.get('-k', 10))
+
+    if '-h' in options or '--help' in options:
+        usage()
+    elif '--build' in options:
+        build(data_dir, options.get('-f', filelist),
+              int(options.get('-b', 1)), int(options.get('-e', 1)),
+              jobs=int(options.get('-j', 1)))
+    elif '--cites' in options:
+        graph = CitationGraph(data_dir)
+        print_documents(graph, graph.cites(lookup_or_exit(graph, options['--cites'])))
+    elif '--cited-by' in options:
+        graph = CitationGraph(data_dir)
+        print_documents(graph, graph.cited_by(lookup_or_exit(graph, options['--cited-by'])))
+    elif '--co-cited' in options:
+        graph = CitationGraph(data_dir)
+        pairs = graph.co_cited(lookup_or_exit(graph, options['--co-cited']), k)
+        print_documents(graph, [docid for docid, count in pairs], [count for docid, count in pairs])
+    elif '--top' in options:
+        graph = CitationGraph(data_dir)
+        print_documents(graph, graph.most_cited(k, options.get('--rank', 'count')))
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -27,6 +27,60 @@ are not included.
 
 The third invocation prints a help message.
 
+With --shard I/N only the lines in the I-th of N shards of the BEGIN-END range
+are processed, lines are distributed round robin. With --shard hash:I/N lines
+are assigned to shards by a hash of the file name. See utils.parse_shard().
+
+With --jobs J the files are processed by J worker processes, largest files
+first, and with --costs FILE the costs in FILE are used instead of file sizes to
+decide on the order. See schedule.py.
+
+Instead of a line for each file a progress line is printed to standard error.
+With --metrics FILE timing histograms for each stage, throughput, bytes read and
+written, peak memory and the slowest files are written to FILE (as JSON, or in
+the Prometheus textfile format if FILE ends in .prom). With --record-costs FILE
+the time spent on each file is written to FILE, which can be used with --costs
+in later runs. See instrument.py.
+
+With --profile FRACTION a random FRACTION of the files is profiled, the profiles
+from all workers are added up and written to profile-convert.pstats and
+profile-convert.collapsed (use --profile-out PREFIX to change the names). Use
+--profiler cprofile to use cProfile instead of the sampling profiler. See
+profiling.py.
+
+The nxml files are read ahead on --readers threads (default 4) while the
+workers convert earlier files, at most --prefetch K files (default 8) are read
+ahead, and the JSON files are written on --writers W threads (default 4). This
+keeps the workers busy when reading from or writing to slow or remote disks.
+The time spent reading is still recorded in the metrics, but writing happens
+after the record for a file is made and is not in the stage timings. See
+utils.Prefetcher and utils.BackgroundWriter.
+
+With --compress gz or --compress zst the JSON files are written compressed with
+gzip or zstd (the latter needs the zstandard package), with .gz or .zst added
+to their names. The later stages read compressed and uncompressed files
+alike, see utils.open_file().
+
+Elements that are never used but can be very large, like tables, MathML and
+supplementary material, are cut out of the nxml text after the front matter
+before it is parsed. The default list of elements is in SKIP_TAGS, use
+--skip-tags TAG1,TAG2,... to use another list, for example to also skip
+disp-formula, fig, fig-group or media (an empty string keeps all elements).
+With --max-size BYTES files larger than BYTES are handled following
+--size-policy, which is one of
+
+truncate    only read the first BYTES bytes of the file, and the rest of the
+            front matter if it is longer than that (the default)
+summarize   like truncate, but only the front matter is parsed, which has all
+            information that is extracted except for the references
+skip        do not read the file at all
+
+Only the part of a large file that is used is read, so this puts a bound on the
+time and memory needed to read, strip and parse a file.
+
+References are only extracted with --references, they are needed for the
+citation graph built by citations.py.
+
 The following information is extracted:
 
 - pubmed ids, both pmid and pmc
@@ -77,7 +131,8 @@ the abstractText property.
 == References
 
 We get the title, year, authors, pmid and source. References are ignored if
-there is no year, title and authors.
+there is no year, title and authors, unless they have a pmid, which is all that
+citations.py needs.
 
 
 == Runtime
@@ -94,45 +149,215 @@ import os
 import sys
 import json
 import time
+import re
 import getopt
+import functools
 import collections
-import bs4
 
-from utils import ensure_directory, elements, time_elapsed
+from utils import elements, time_elapsed, parse_shard
+from utils import Prefetcher, BackgroundWriter, PREFETCH, READERS, WRITERS
+from utils import write_file
+from schedule import schedule_items, run_jobs
+from instrument import DocTimer, Monitor, estimate_total
+from profiling import session, collector, profiler_from_options
 
 
-@time_elapsed
-def process_filelist(source_dir, data_dir, filelist, start, end, crash=False):
-    for n, fname in elements(filelist, start, end):
-        if crash:
-            process_list_element(data_dir, n, fname)
-        else:
-            try:
-                process_list_element(source_dir, data_dir, n, fname)
-            except Exception as e:
-                sys.stderr.write("ERROR on %07d  %s\n" % (n, fname))
-                print('ERROR:', Exception, e)
+# elements that are removed before parsing, none of them are used and some of
+# them can be huge
+SKIP_TAGS = ('table-wrap', 'table-wrap-group', 'supplementary-material', 'mml:math',
+             'math', 'tex-math')
 
+SIZE_POLICIES = ('truncate', 'summarize', 'skip')
 
-def process_list_element(source_dir, data_dir, n, fname):
-    print("%07d  %s" % (n, fname))
-    nxml_file = os.path.join(source_dir, fname)
-    jsn_file = os.path.join(data_dir, 'jsn', fname)
-    ensure_directory(jsn_file)
-    create_jsn_file(nxml_file, jsn_file)
 
+@time_elapsed
+def process_filelist(source_dir, data_dir, filelist, start, end, crash=False,
+                     shard=None, jobs=1, costs=None, metrics=None, record_costs=None,
+                     profiler=None, profile_out='profile-convert', reader=None,
+                     prefetch=PREFETCH, readers=READERS, writers=WRITERS, compress=None,
+                     references=False):
+    reader = NxmlReader() if reader is None else reader
+    items = elements(filelist, start, end, shard)
+    total = estimate_total(filelist, start, end, shard)
+    if jobs > 1:
+        items = schedule_items(items, filelist, costs,
+                               lambda fname: os.path.join(source_dir, fname))
+        total = len(items)
+    monitor = Monitor('convert', total, metrics, record_costs,
+                      profile=collector(profiler, profile_out))
+    # the nxml files are read ahead on reader threads and the JSON files are
+    # written on writer threads, the worker processes only do the conversion
+    inputs = Prefetcher(items, functools.partial(read_nxml_file, source_dir, reader),
+                        prefetch, readers, jobs)
+    writer = BackgroundWriter(writers, compression=compress)
+    fun = functools.partial(process_item, data_dir, crash, profiler, reader, references)
+    for record in run_jobs(fun, inputs, jobs):
+        inputs.done()
+        writer.write_all(record.pop('outputs', ()))
+        monitor.add(record)
+    monitor.errors += len(writer.close())
+    print(monitor.finish().summary())
+    return monitor
+
+
+def read_nxml_file(source_dir, reader, item):
+    """Return the text and the size of the nxml file for an item from the file
+    list, the text is None if the file is skipped because of its size."""
+    n, fname = item
+    return reader.read_file(os.path.join(source_dir, fname))
+
+
+def process_item(data_dir, crash, profiler, reader, references, task):
+    (n, fname), data, read_time = task
+    if crash:
+        return process_list_element(data_dir, n, fname, data, read_time, profiler, reader,
+                                    references)
+    try:
+        return process_list_element(data_dir, n, fname, data, read_time, profiler, reader,
+                                    references)
+    except Exception as e:
+        sys.stderr.write("\nERROR on %07d  %s\n" % (n, fname))
+        print('ERROR:', Exception, e)
+        return DocTimer(fname).record(error=str(e))
+
+
+def process_list_element(data_dir, n, fname, data, read_time, profiler=None, reader=None,
+                         references=False):
+    """Convert the text read by read_nxml_file() and return the record of the
+    DocTimer, with the JSON file to be written in the outputs."""
+    if isinstance(data, Exception):
+        raise data
+    text, size = data
+    jsn_file = os.path.join(data_dir, 'jsn', fname)
+    timer = DocTimer(fname)
+    timer.stages['read'] = read_time
+    timer.bytes_in += size
+    if text is None:
+        sys.stderr.write("\nSKIPPING %07d  %s  (%d bytes)\n" % (n, fname, size))
+        return timer.record(skipped=True)
+    with session(profiler, fname) as profile:
+        pmc_article = PmcArticle(fname, jsn_file, reader, references)
+        pmc_article.add_data_from_text(text, size, timer)
+        s = pmc_article.as_string(timer)
+    return timer.record(profile=profile.result, outputs=[(jsn_file, s)])
+
+
+def create_jsn_file(nxml_file, jsn_file, timer=None, reader=None, references=False):
+    """Create the JSON file, returns False if the nxml file was skipped because
+    of its size."""
+    timer = DocTimer() if timer is None else timer
+    pmc_article = PmcArticle(nxml_file, jsn_file, reader, references)
+    if not pmc_article.add_data_from_nxml_file(timer):
+        return False
+    pmc_article.write(timer)
+    return True
+
+
+class NxmlReader(object):
+
+    """Reads the text of an nxml file, removing the elements in skip_tags and
+    applying the size policy to files larger than max_size bytes."""
+
+    def __init__(self, skip_tags=SKIP_TAGS, max_size=None, size_policy='truncate'):
+        if size_policy not in SIZE_POLICIES:
+            raise ValueError("size policy should be one of %s" % ', '.join(SIZE_POLICIES))
+        self.skip_tags = tuple(skip_tags)
+        self.max_size = max_size
+        self.size_policy = size_policy
+        self.pattern = None
+        if self.skip_tags:
+            # matches start tags, end tags and empty elements, the lookahead
+            # makes sure that 'math' does not match 'math-inline'
+            self.pattern = re.compile(
+                r'<(/?)(%s)(?=[\s/>])[^>]*?(/?)>' % '|'.join(re.escape(t) for t in self.skip_tags))
+
+    def too_large(self, size):
+        return self.max_size is not None and size > self.max_size
+
+    def skip(self, size):
+        """Return True if a file of this size should be skipped."""
+        return self.too_large(size) and self.size_policy == 'skip'
+
+    def read_file(self, fname):
+        """Return the text and the size of a file, the text is None if the file
+        should be skipped. Of a file larger than max_size only the first max_size
+        bytes are read, and the rest of the front matter if it starts in those
+        bytes. With the summarize policy only the front matter is kept, if
+        there is one. The text is cut at the start of a tag, so there are no
+        half tags or half characters."""
+        size = os.path.getsize(fname)
+        if self.skip(size):
+            return None, size
+        with open(fname, 'rb') as fh:
+            if not self.too_large(size):
+                return fh.read().decode('utf8'), size
+            data = fh.read(self.max_size)
+            if b'<front' in data:
+                data = self._read_front_matter(fh, data)
+        end = data.find(b'</front>')
+        start = end + len(b'</front>') if end >= 0 else 0
+        if self.size_policy == 'summarize' and end >= 0:
+            data = data[:start]
+        elif len(data) > start:
+            cut = data.rfind(b'<', start, max(start, self.max_size))
+            data = data[:cut if cut >= 0 else max(start, self.max_size)]
+        return data.decode('utf8'), size
 
-def create_jsn_file(nxml_file, jsn_file):
-    pmc_article = PmcArticle(nxml_file, jsn_file)
-    pmc_article.add_data_from_nxml_file()
-    pmc_article.write()
+    @staticmethod
+    def _read_front_matter(fh, data, block=65536):
+        """Keep reading until the end of the front matter or of the file."""
+        found = b'</front>' in data
+        while not found:
+            more = fh.read(block)
+            if not more:
+                break
+            found = b'</front>' in data[-8:] + more
+            data += more
+        return data
+
+    def prepare(self, text):
+        """Return the part of the text read by read_file() that should be
+        parsed."""
+        # the front matter is small and has everything that is extracted, so
+        # it is kept as it is, for example to keep the math in abstracts
+        end = text.find('</front>')
+        return text[:end] + self.strip(text[end:]) if end >= 0 else self.strip(text)
+
+    def strip(self, text):
+        """Remove all elements in skip_tags from the text. Elements nested inside
+        a removed element go with it."""
+        if self.pattern is None:
+            return text
+        pieces = []
+        last = 0
+        depth = 0
+        name = None
+        for match in self.pattern.finditer(text):
+            closing, tag, empty = match.groups()
+            if depth == 0:
+                if closing:
+                    continue
+                pieces.append(text[last:match.start()])
+                last = match.end()
+                if not empty:
+                    depth = 1
+                    name = tag
+            elif tag == name and not empty:
+                depth += -1 if closing else 1
+                if depth == 0:
+                    last = match.end()
+        if depth == 0:
+            pieces.append(text[last:])
+        return ''.join(pieces)
 
 
 class PmcArticle(object):
 
-    def __init__(self, source, target):
+    def __init__(self, source, target, reader=None, references=False):
         self.source = source
         self.target = target
+        self.reader = NxmlReader() if reader is None else reader
+        self.references = references
         self.json = {
             'id-pmid': None,
             'id-pmc': None,
@@ -144,20 +369,36 @@ class PmcArticle(object):
             "abstractText": None,
             "references": [] }
 
-    def add_data_from_nxml_file(self):
-        # References almost double processing time so I am leaving them out
-        # given our current time crunch and the fact we did not use it last time
-        # for the Kibana visualiation. Not doing this also reduces diskspace
-        # used by a factor 4.
-        with open(self.source) as fp:
-            self.soup = bs4.BeautifulSoup(fp, 'lxml')
+    def add_data_from_nxml_file(self, timer=None):
+        # References almost double processing time so they are left out unless
+        # asked for, we did not use them last time for the Kibana visualiation
+        # and leaving them out also reduces diskspace used by a factor 4.
+        # Returns False if the file was skipped because of its size.
+        timer = DocTimer() if timer is None else timer
+        with timer.stage('read'):
+            text, size = self.reader.read_file(self.source)
+        timer.bytes_in += size
+        if text is None:
+            return False
+        self.add_data_from_text(text, size, timer)
+        return True
+
+    def add_data_from_text(self, text, size, timer=None):
+        """Add data from the text of the nxml file, which had the given size."""
+        # bs4 takes a tenth of a second to import, which --help does not need
+        from bs4 import BeautifulSoup
+        timer = DocTimer() if timer is None else timer
+        with timer.stage('parse'):
+            self.soup = BeautifulSoup(self.reader.prepare(text), 'lxml')
+        with timer.stage('extract'):
             self._add_ids()
             self._add_title()
             self._add_abstract()
             self._add_journal()
             self._add_authors()
             self._add_year()
-            # self._add_references()
+            if self.references:
+                self._add_references()
 
     @staticmethod
     def _get_text(tag):
@@ -221,27 +462,37 @@ class PmcArticle(object):
             year = ref.find('year')
             title = ref.find('article-title')
             source = ref.find('source')
-            pmid = ref.find('pub-id')
-            if year and title:
+            # there can be a doi or other identifiers before the pmid
+            pmid = ref.find('pub-id', attrs={'pub-id-type': 'pmid'})
+            if year and title and year.get_text()[:4].isdigit():
                 obj['year'] = int(year.get_text()[:4])
                 obj['title'] = title.get_text()
-            if pmid is not None and pmid.attrs.get('pub-id-type') == 'pmid':
-                obj['pmid'] =  pmid.get_text()
-            self._set_field('source', source)
+            if pmid is not None:
+                obj['pmid'] = self._get_text(pmid)
+            obj['source'] = self._get_text(source)
             for n in ref.find_all('name'):
                 first = self._get_text(n.find('given-names'))
                 last = self._get_text(n.surname)
                 obj['authors'].append(self._get_fullname(first, last))
-            if year and title and obj['authors']:
+            if (obj['year'] and obj['authors']) or obj['pmid']:
                 self.json['references'].append(obj)
 
     @staticmethod
     def _get_fullname(first, last):
         return ' '.join([n for n in (first, last) if n is not None])
 
-    def write(self):
-        with open(self.target, 'w') as out:
-            json.dump(self.json, out, sort_keys=True, indent=4)
+    def write(self, timer=None):
+        timer = DocTimer() if timer is None else timer
+        s = self.as_string(timer)
+        with timer.stage('write'):
+            write_file(self.target, s)
+
+    def as_string(self, timer=None):
+        timer = DocTimer() if timer is None else timer
+        with timer.stage('serialize'):
+            s = json.dumps(self.json, sort_keys=True, indent=4)
+        timer.bytes_out += len(s)
+        return s
 
 
 def usage():
@@ -249,25 +500,61 @@ def usage():
           + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST"
           + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST -s START -e END"
           + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST --crash"
+          + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST --shard I/N"
+          + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST --jobs J [--costs FILE]"
+          + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST --metrics FILE [--record-costs FILE]"
+          + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST --profile FRACTION"
+          + "\n          [--profiler (sample|cprofile)] [--profile-out PREFIX]"
+          + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST [--skip-tags TAGS]"
+          + "\n          [--max-size BYTES [--size-policy (truncate|summarize|skip)]]"
+          + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST [--prefetch K]"
+          + "\n          [--readers R] [--writers W] [--compress (gz|zst)]"
+          + "\n    $ python3 convert_nxml.py -s SOURCE_DIR -d DATA_DIR -f FILELIST --references"
           + "\n    $ python3 convert_nxml.py (-h | --help)\n")
 
 
-if __name__ == '__main__':
-
+def main(args):
     source_dir = '/DATA/eager/pubmed-01000'
     data_dir = '/DATA/eager/sample-01000'
     filelist = '../../data/files-random-01000.txt'
 
-    options = dict(getopt.getopt(sys.argv[1:], 's:d:f:b:e:h', ['crash', 'help'])[0])
+    options = dict(getopt.getopt(
+        args, 's:d:f:b:e:h',
+        ['crash', 'help', 'shard=', 'jobs=', 'costs=', 'metrics=', 'record-costs=',
+         'profile=', 'profiler=', 'profile-out=', 'skip-tags=', 'max-size=',
+         'size-policy=', 'prefetch=', 'readers=', 'writers=', 'compress=', 'references'])[0])
     source_dir = options.get('-s', source_dir)
     data_dir = options.get('-d', data_dir)
     filelist = options.get('-f', filelist)
     begin = int(options.get('-b', 1))
     end = int(options.get('-e', 1))
     crash = True if '--crash' in options else False
+    shard = parse_shard(options['--shard']) if '--shard' in options else None
+    jobs = int(options.get('--jobs', 1))
     help_wanted = True if '-h' in options or '--help' in options else False
+    skip_tags = SKIP_TAGS
+    if '--skip-tags' in options:
+        skip_tags = [t for t in options['--skip-tags'].split(',') if t]
+    max_size = int(options['--max-size']) if '--max-size' in options else None
+    reader = NxmlReader(skip_tags, max_size, options.get('--size-policy', 'truncate'))
 
     if help_wanted:
         usage()
     else:
-        process_filelist(source_dir, data_dir, filelist, begin, end, crash=crash)
+        process_filelist(source_dir, data_dir, filelist, begin, end, crash=crash,
+                         shard=shard, jobs=jobs, costs=options.get('--costs'),
+                         metrics=options.get('--metrics'),
+                         record_costs=options.get('--record-costs'),
+                         profiler=profiler_from_options(options),
+                         profile_out=options.get('--profile-out', 'profile-convert'),
+                         reader=reader,
+                         prefetch=int(options.get('--prefetch', PREFETCH)),
+                         readers=int(options.get('--readers', READERS)),
+                         writers=int(options.get('--writers', WRITERS)),
+                         compress=options.get('--compress'),
+                         references='--references' in options)
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -14,6 +14,25 @@ listed in FILE_LIST. New directories lif and txt will be created (if they exist,
 contents may be overwritten) and after running this script those directory will
 have the same structure as jsn.
 
+With --shard I/N only the lines in the I-th of N shards of the START-END range
+are processed, lines are distributed round robin. With --shard hash:I/N lines
+are assigned to shards by a hash of the file name. See utils.parse_shard().
+
+With --jobs J the files are processed by J worker processes, largest files
+first, and with --costs FILE the costs in FILE are used instead of file sizes to
+decide on the order. See schedule.py.
+
+Instead of a line for each file a progress line is printed to standard error,
+the --metrics and --record-costs options work as for convert_nxml.py, see
+instrument.py. So do --profile, --profiler and --profile-out, the default
+prefix for profiles is profile-lif. See profiling.py.
+
+The --prefetch, --readers and --writers options also work as for
+convert_nxml.py, JSON files are read ahead on reader threads and the LIF and
+text files are written on writer threads. With --compress gz or --compress zst
+the LIF and text files are written compressed, the JSON files are read whether
+they are compressed or not. See utils.open_file().
+
 """
 
 
@@ -21,41 +40,98 @@ import os
 import sys
 import json
 import traceback
+import functools
 from getopt import getopt
 from io import StringIO
 
 from lif import LIF, Container, View, Annotation
-from utils import time_elapsed, elements, ensure_directory
+from utils import time_elapsed, elements, parse_shard
+from utils import Prefetcher, BackgroundWriter, PREFETCH, READERS, WRITERS
+from utils import open_file, existing_file, write_file
+from schedule import schedule_items, run_jobs
+from instrument import DocTimer, Monitor, estimate_total
+from profiling import session, collector, profiler_from_options
 
 
 @time_elapsed
-def process_filelist(data_dir, filelist, start, end, crash=False):
-    for n, fname in elements(filelist, start, end):
-        if crash:
-            process_list_element(data_dir, n, fname)
-        else:
-            try:
-                process_list_element(data_dir, n, fname)
-            except Exception as e:
-                sys.stderr.write("ERROR on %07d  %s\n" % (n, fname))
-                print('ERROR:', Exception, e)
-
-
-def process_list_element(data_dir, n, fname):
-    print("%07d  %s" % (n, fname))
-    jsn_file = os.path.join(data_dir, 'jsn', fname)
+def process_filelist(data_dir, filelist, start, end, crash=False, shard=None,
+                     jobs=1, costs=None, metrics=None, record_costs=None,
+                     profiler=None, profile_out='profile-lif',
+                     prefetch=PREFETCH, readers=READERS, writers=WRITERS, compress=None):
+    items = elements(filelist, start, end, shard)
+    total = estimate_total(filelist, start, end, shard)
+    if jobs > 1:
+        items = schedule_items(items, filelist, costs,
+                               lambda fname: existing_file(os.path.join(data_dir, 'jsn', fname)))
+        total = len(items)
+    monitor = Monitor('lif', total, metrics, record_costs,
+                      profile=collector(profiler, profile_out))
+    inputs = Prefetcher(items, functools.partial(read_json_file, data_dir),
+                        prefetch, readers, jobs)
+    writer = BackgroundWriter(writers, compression=compress)
+    fun = functools.partial(process_item, data_dir, crash, profiler)
+    for record in run_jobs(fun, inputs, jobs):
+        inputs.done()
+        writer.write_all(record.pop('outputs', ()))
+        monitor.add(record)
+    monitor.errors += len(writer.close())
+    print(monitor.finish().summary())
+    return monitor
+
+
+def read_json_file(data_dir, item):
+    n, fname = item
+    with open_file(existing_file(os.path.join(data_dir, 'jsn', fname))) as fh:
+        return fh.read()
+
+
+def process_item(data_dir, crash, profiler, task):
+    (n, fname), json_string, read_time = task
+    if crash:
+        return process_list_element(data_dir, n, fname, json_string, read_time, profiler)
+    try:
+        return process_list_element(data_dir, n, fname, json_string, read_time, profiler)
+    except Exception as e:
+        sys.stderr.write("\nERROR on %07d  %s\n" % (n, fname))
+        print('ERROR:', Exception, e)
+        return DocTimer(fname).record(error=str(e))
+
+
+def process_list_element(data_dir, n, fname, json_string, read_time, profiler=None):
+    """Create the LIF and text strings from the JSON string read by
+    read_json_file() and return the record of the DocTimer, with the files to
+    be written in the outputs."""
+    if isinstance(json_string, Exception):
+        raise json_string
     lif_file = os.path.join(data_dir, 'lif', fname[:-4] + 'lif')
     txt_file = os.path.join(data_dir, 'txt', fname[:-4] + 'txt')
-    ensure_directory(lif_file, txt_file)
-    create_lif_file(jsn_file, lif_file, txt_file)
+    timer = DocTimer(fname)
+    timer.stages['read'] = read_time
+    with session(profiler, fname) as profile:
+        lif_string, txt_string = lif_strings(json_string, timer)
+    return timer.record(profile=profile.result,
+                        outputs=[(lif_file, lif_string), (txt_file, txt_string)])
 
 
-def create_lif_file(json_file, lif_file, txt_file, test=False):
+def create_lif_file(json_file, lif_file, txt_file, test=False, timer=None):
     #print("Creating {}".format(lif_file))
-    with open(json_file, encoding='utf8') as fh_in, \
-         open(lif_file, 'w', encoding='utf8') as fh_out_lif, \
-         open(txt_file, 'w', encoding='utf8') as fh_out_txt:
-        json_obj = json.loads(fh_in.read())
+    timer = DocTimer() if timer is None else timer
+    with timer.stage('read'), open_file(existing_file(json_file)) as fh_in:
+        json_string = fh_in.read()
+    lif_string, txt_string = lif_strings(json_string, timer)
+    with timer.stage('write'):
+        write_file(lif_file, lif_string)
+        write_file(txt_file, txt_string)
+    if test:
+        test_lif_file(lif_file)
+
+
+def lif_strings(json_string, timer=None):
+    """Return the LIF string and the text string for a JSON string."""
+    timer = DocTimer() if timer is None else timer
+    with timer.stage('parse'):
+        json_obj = json.loads(json_string)
+    with timer.stage('extract'):
         lif_obj = LIF()
         _add_metadata(lif_obj, json_obj)
         _add_view(lif_obj, json_obj)
@@ -63,10 +139,12 @@ def create_lif_file(json_file, lif_file, txt_file, test=False):
         container = Container()
         container.discriminator = "http://vocab.lappsgrid.org/ns/media/jsonld#lif"
         container.payload = lif_obj
-        fh_out_lif.write(json.dumps(container.as_json(), indent=4))
-        fh_out_txt.write(container.payload.text.value)
-    if test:
-        test_lif_file(lif_file)
+    with timer.stage('serialize'):
+        lif_string = json.dumps(container.as_json(), indent=4)
+        txt_string = container.payload.text.value
+    timer.bytes_in += len(json_string)
+    timer.bytes_out += len(lif_string) + len(txt_string)
+    return lif_string, txt_string
 
 
 def _add_metadata(lif_obj, json_obj):
@@ -74,6 +152,7 @@ def _add_metadata(lif_obj, json_obj):
     lif_obj.metadata['id-pmid'] = json_obj['id-pmid']
     lif_obj.metadata['authors'] = json_obj['authors']
     lif_obj.metadata['title'] = json_obj.get('title')
+    lif_obj.metadata['journal'] = json_obj.get('journal')
     lif_obj.metadata['year'] = json_obj.get('year')
     lif_obj.metadata['references'] = json_obj['references']
 
@@ -151,27 +230,51 @@ def vocab(annotation_type):
 
 def usage():
     print("\nUsage:\n"
-          + "\n    $ python3 convert_nxml.py -d DATA_DIR -f FILELIST"
-          + "\n    $ python3 convert_nxml.py -d DATA_DIR -f FILELIST -s START -e END"
-          + "\n    $ python3 convert_nxml.py -d DATA_DIR -f FILELIST --crash"
-          + "\n    $ python3 convert_nxml.py (-h | --help)\n")
-
-
-if __name__ == '__main__':
-
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST"
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST -s START -e END"
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST --crash"
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST --shard I/N"
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST --jobs J [--costs FILE]"
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST --metrics FILE [--record-costs FILE]"
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST --profile FRACTION"
+          + "\n          [--profiler (sample|cprofile)] [--profile-out PREFIX]"
+          + "\n    $ python3 create_lif.py -d DATA_DIR -f FILELIST [--prefetch K] [--readers R] [--writers W]"
+          + "\n          [--compress (gz|zst)]"
+          + "\n    $ python3 create_lif.py (-h | --help)\n")
+
+
+def main(args):
     data_dir = '/DATA/eager/sample-01000'
     filelist = '../../data/files-random-01000.txt'
 
-    options = dict(getopt(sys.argv[1:], 'd:f:s:e:h', ['crash', 'help'])[0])
+    options = dict(getopt(args, 'd:f:s:e:h',
+                          ['crash', 'help', 'shard=', 'jobs=', 'costs=', 'metrics=',
+                           'record-costs=', 'profile=', 'profiler=', 'profile-out=',
+                           'prefetch=', 'readers=', 'writers=', 'compress='])[0])
     data_dir = options.get('-d', data_dir)
     filelist = options.get('-f', filelist)
     start = int(options.get('-s', 1))
     end = int(options.get('-e', 1))
     crash = True if '--crash' in options else False
+    shard = parse_shard(options['--shard']) if '--shard' in options else None
+    jobs = int(options.get('--jobs', 1))
     help_wanted = True if '-h' in options or '--help' in options else False
 
     if help_wanted:
         usage()
     else:
-        process_filelist(data_dir, filelist, start, end, crash=crash)
+        process_filelist(data_dir, filelist, start, end, crash=crash, shard=shard,
+                         jobs=jobs, costs=options.get('--costs'),
+                         metrics=options.get('--metrics'),
+                         record_costs=options.get('--record-costs'),
+                         profiler=profiler_from_options(options),
+                         profile_out=options.get('--profile-out', 'profile-lif'),
+                         prefetch=int(options.get('--prefetch', PREFETCH)),
+                         readers=int(options.get('--readers', READERS)),
+                         writers=int(options.get('--writers', WRITERS)),
+                         compress=options.get('--compress'))
+
+
+if __name__ == '__main__':
 
+    main(sys.argv[1:])
@@ -0,0 +1,320 @@
+"""cube.py
+
+Aggregate counts and topic scores by journal, year and topic, for dashboards
+that show topic trends.
+
+Usage:
+
+$ python3 cube.py --build -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS]
+$ python3 cube.py --trend TOPIC -d DATA_DIR [--journal JOURNAL]
+$ python3 cube.py --journals TOPIC -d DATA_DIR [--year YEAR] [-k K]
+
+The first invocation builds the cube for the documents on lines BEGIN through
+END of FILELIST and writes it to DATA_DIR/cube.npz. The topics and their scores
+are taken from the topic files in DATA_DIR/top, the journal and the year from
+the metadata of the LIF files in DATA_DIR/lif (or from the JSON file for LIF
+files created before the journal was added to the metadata). Documents without
+a topic file are not in the cube. With -j JOBS the documents are split into
+chunks that are aggregated by JOBS worker processes, the partial cubes are then
+added up.
+
+The second invocation prints for each year the number of documents, the number
+of documents with TOPIC and the mean score of TOPIC over all documents, for all
+journals or for JOURNAL only. The third prints the K (default 10) journals with
+the highest summed score for TOPIC, over all years or for YEAR only.
+
+From Python:
+
+>>> cube = CubeReader(data_dir)
+>>> cube.trend(17, journal='PLoS One')
+>>> cube.top_journals(17, year=2015, k=10)
+
+The cube has a cell for each combination of journal and year that has
+documents, with the number of documents, and for each topic the number of
+documents that have the topic and the sum of the scores of the topic. Only the
+topics that are in the topic files are counted, which are the ones with a score
+of at least the minimum probability of the model. Cells are sorted on journal
+and year, so the cells of a journal are a slice of the arrays, and the totals
+for each year are stored as well. A query is a few array lookups on the loaded
+file.
+
+The cube is kept up to date by update.py, which subtracts the old topic files
+of modified and deleted documents and adds the new ones, if DATA_DIR/cube.npz
+exists.
+
+"""
+
+
+import os
+import sys
+import json
+import getopt
+import functools
+
+import numpy as np
+
+from lif import Container, LIF
+from utils import elements, time_elapsed, open_file, existing_file
+from schedule import run_jobs
+
+
+CUBE_FILE = 'cube.npz'
+
+# number of documents handed to a worker at once
+CHUNK_SIZE = 5000
+
+UNKNOWN_JOURNAL = ''
+UNKNOWN_YEAR = 0
+
+
+def cube_file(data_dir):
+    return os.path.join(data_dir, CUBE_FILE)
+
+
+def document_topics(data_dir, fname):
+    """Return the topics of a document as a list of (topic_id, score) pairs, or
+    None if the document has no topic file."""
+    top_file = existing_file(os.path.join(data_dir, 'top', fname[:-5] + '.lif'))
+    if not os.path.exists(top_file):
+        return None
+    topics = []
+    # topic files have a LIF object, not a container
+    for view in LIF(json_file=top_file).views:
+        for anno in view.annotations:
+            if anno.features.get('type') == 'gensim-topic':
+                topics.append((int(anno.features['topic_id']),
+                               float(anno.features['topic_score'])))
+    return topics
+
+
+def document_entry(data_dir, fname):
+    """Return a (journal, year, topics) triple for a document, where topics is a
+    list of (topic_id, score) pairs, or None if the document has no topic file."""
+    topics = document_topics(data_dir, fname)
+    if topics is None:
+        return None
+    metadata = Container(existing_file(os.path.join(data_dir, 'lif', fname[:-5] + '.lif'))).payload.metadata
+    if 'journal' not in metadata:
+        with open_file(existing_file(os.path.join(data_dir, 'jsn', fname))) as fh:
+            metadata = dict(metadata, journal=json.load(fh).get('journal'))
+    journal = metadata.get('journal') or UNKNOWN_JOURNAL
+    year = int(metadata.get('year') or UNKNOWN_YEAR)
+    return journal, year, topics
+
+
+class Cube(object):
+
+    """The cube while it is built or updated, with a dictionary from (journal,
+    year) pairs to cells. A cell is a list with the number of documents, an array
+    with the number of documents for each topic and an array with the summed
+    scores for each topic."""
+
+    def __init__(self, num_topics=0):
+        self.num_topics = num_topics
+        self.cells = {}
+
+    def add(self, entry, sign=1):
+        """Add a (journal, year, topics) triple as returned by document_entry(),
+        use sign=-1 to subtract it."""
+        journal, year, topics = entry
+        if topics:
+            self._grow(max(topic for topic, score in topics) + 1)
+        cell = self._cell(journal, year)
+        cell[0] += sign
+        for topic, score in topics:
+            cell[1][topic] += sign
+            cell[2][topic] += sign * score
+        if cell[0] <= 0:
+            del self.cells[(journal, year)]
+
+    def merge(self, other):
+        self._grow(other.num_topics)
+        for key, (docs, topic_docs, scores) in other.cells.items():
+            cell = self._cell(*key)
+            cell[0] += docs
+            cell[1][:len(topic_docs)] += topic_docs
+            cell[2][:len(scores)] += scores
+
+    def _cell(self, journal, year):
+        if (journal, year) not in self.cells:
+            self.cells[(journal, year)] = [0, np.zeros(self.num_topics, dtype=np.int32),
+                                           np.zeros(self.num_topics, dtype=np.float64)]
+        return self.cells[(journal, year)]
+
+    def _grow(self, num_topics):
+        if num_topics <= self.num_topics:
+            return
+        for cell in self.cells.values():
+            cell[1] = np.concatenate((cell[1], np.zeros(num_topics - len(cell[1]), dtype=np.int32)))
+            cell[2] = np.concatenate((cell[2], np.zeros(num_topics - len(cell[2]))))
+        self.num_topics = num_topics
+
+    def save(self, fname):
+        keys = sorted(self.cells)
+        journals = sorted(set(journal for journal, year in keys))
+        years = sorted(set(year for journal, year in keys))
+        journal_idx = {journal: i for i, journal in enumerate(journals)}
+        year_idx = {year: i for i, year in enumerate(years)}
+        cell_journal = np.array([journal_idx[journal] for journal, year in keys], dtype=np.int32)
+        cell_year = np.array([year_idx[year] for journal, year in keys], dtype=np.int32)
+        shape = (len(keys), self.num_topics)
+        docs = np.array([self.cells[key][0] for key in keys], dtype=np.int32)
+        topic_docs = np.array([self.cells[key][1] for key in keys], dtype=np.int32).reshape(shape)
+        scores = np.array([self.cells[key][2] for key in keys], dtype=np.float64).reshape(shape)
+        # cells are sorted on journal, so the cells of journal i are the slice
+        # from journal_offsets[i] to journal_offsets[i+1]
+        journal_offsets = np.searchsorted(cell_journal, np.arange(len(journals) + 1)).astype(np.int64)
+        year_docs = np.zeros(len(years), dtype=np.int64)
+        year_topic_docs = np.zeros((len(years), self.num_topics), dtype=np.int64)
+        year_scores = np.zeros((len(years), self.num_topics), dtype=np.float64)
+        np.add.at(year_docs, cell_year, docs)
+        np.add.at(year_topic_docs, cell_year, topic_docs)
+        np.add.at(year_scores, cell_year, scores)
+        # written to a temporary file first so that readers never see half a cube
+        tmp_file = "%s.%d.tmp" % (fname, os.getpid())
+        with open(tmp_file, 'wb') as fh:
+            np.savez(fh, journals=np.array(journals, dtype=str), years=np.array(years, dtype=np.int32),
+                     cell_journal=cell_journal, cell_year=cell_year, docs=docs,
+                     topic_docs=topic_docs, scores=scores, journal_offsets=journal_offsets,
+                     year_docs=year_docs, year_topic_docs=year_topic_docs, year_scores=year_scores)
+        os.replace(tmp_file, fname)
+
+    @classmethod
+    def load(cls, fname):
+        reader = CubeReader(fname=fname)
+        cube = cls(reader.num_topics)
+        for i in range(len(reader.docs)):
+            key = (str(reader.journals[reader.cell_journal[i]]), int(reader.years[reader.cell_year[i]]))
+            cube.cells[key] = [int(reader.docs[i]), reader.topic_docs[i].copy(), reader.scores[i].copy()]
+        return cube
+
+
+class CubeReader(object):
+
+    """Answers queries from a saved cube."""
+
+    def __init__(self, data_dir=None, fname=None):
+        fname = cube_file(data_dir) if fname is None else fname
+        with np.load(fname) as npz:
+            for name in npz.files:
+                setattr(self, name, npz[name])
+        self.num_topics = self.scores.shape[1]
+        self.journal_idx = {str(journal): i for i, journal in enumerate(self.journals)}
+
+    def trend(self, topic, journal=None):
+        """Return a list of (year, documents, documents with the topic, summed
+        score) tuples, for all journals or for one journal."""
+        if topic >= self.num_topics:
+            return []
+        if journal is None:
+            return list(zip(self.years.tolist(), self.year_docs.tolist(),
+                            self.year_topic_docs[:, topic].tolist(),
+                            self.year_scores[:, topic].tolist()))
+        i = self.journal_idx.get(journal)
+        if i is None:
+            return []
+        cells = slice(self.journal_offsets[i], self.journal_offsets[i + 1])
+        return list(zip(self.years[self.cell_year[cells]].tolist(), self.docs[cells].tolist(),
+                        self.topic_docs[cells, topic].tolist(), self.scores[cells, topic].tolist()))
+
+    def top_journals(self, topic, year=None, k=10):
+        """Return the k journals with the highest summed score for the topic, as a
+        list of (journal, documents, documents with the topic, summed score)
+        tuples, for all years or for one year."""
+        if topic >= self.num_topics:
+            return []
+        cells = np.arange(len(self.docs))
+        if year is not None:
+            cells = cells[self.years[self.cell_year] == year]
+        n = len(self.journals)
+        docs = np.bincount(self.cell_journal[cells], weights=self.docs[cells], minlength=n)
+        topic_docs = np.bincount(self.cell_journal[cells], weights=self.topic_docs[cells, topic], minlength=n)
+        scores = np.bincount(self.cell_journal[cells], weights=self.scores[cells, topic], minlength=n)
+        best = [i for i in np.argsort(-scores, kind='stable')[:k] if topic_docs[i] > 0]
+        return [(str(self.journals[i]), int(docs[i]), int(topic_docs[i]), float(scores[i]))
+                for i in best]
+
+
+def build_chunk(data_dir, chunk):
+    """Return the cube for a list of file names, this runs in the workers."""
+    cube = Cube()
+    for fname in chunk:
+        try:
+            entry = document_entry(data_dir, fname)
+        except Exception as e:
+            sys.stderr.write("\nERROR on %s  %s\n" % (fname, e))
+            continue
+        if entry is not None:
+            cube.add(entry)
+    return cube, len(chunk)
+
+
+def _chunks(fnames, size):
+    for i in range(0, len(fnames), size):
+        yield fnames[i:i + size]
+
+
+@time_elapsed
+def build(data_dir, filelist, start, end, jobs=1):
+    fnames = [fname for n, fname in elements(filelist, start, end)]
+    cube = Cube()
+    done = 0
+    fun = functools.partial(build_chunk, data_dir)
+    for chunk_cube, size in run_jobs(fun, _chunks(fnames, CHUNK_SIZE), jobs):
+        cube.merge(chunk_cube)
+        done += size
+        sys.stderr.write("\r%d documents" % done)
+    sys.stderr.write("\n")
+    cube.save(cube_file(data_dir))
+    print("Wrote %s with %d documents in %d cells"
+          % (cube_file(data_dir), sum(cell[0] for cell in cube.cells.values()), len(cube.cells)))
+
+
+def print_trend(reader, topic, journal=None):
+    print("\n  year      docs   with topic   mean score")
+    for year, docs, topic_docs, score in reader.trend(topic, journal):
+        print("  %4d  %8d     %8d       %.4f" % (year, docs, topic_docs, score / docs if docs else 0.0))
+
+
+def print_journals(reader, topic, year=None, k=10):
+    print("\n      docs   with topic   mean score   journal")
+    for journal, docs, topic_docs, score in reader.top_journals(topic, year, k):
+        print("  %8d     %8d       %.4f   %s" % (docs, topic_docs, score / docs, journal or '-'))
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 cube.py --build -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS]"
+          + "\n    $ python3 cube.py --trend TOPIC -d DATA_DIR [--journal JOURNAL]"
+          + "\n    $ python3 cube.py --journals TOPIC -d DATA_DIR [--year YEAR] [-k K]"
+          + "\n    $ python3 cube.py (-h | --help)\n")
+
+
+def main(args):
+    data_dir = '/DATA/eager/sample-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(
+        args, 'd:f:b:e:j:k:h',
+        ['build', 'trend=', 'journal=', 'journals=', 'year=', 'help'])[0])
+    data_dir = options.get('-d', data_dir)
+    filelist = options.get('-f', filelist)
+
+    if '-h' in options or '--help' in options:
+        usage()
+    elif '--build' in options:
+        build(data_dir, filelist, int(options.get('-b', 1)), int(options.get('-e', 1)),
+              jobs=int(options.get('-j', 1)))
+    elif '--trend' in options:
+        print_trend(CubeReader(data_dir), int(options['--trend']), options.get('--journal'))
+    elif '--journals' in options:
+        year = int(options['--year']) if '--year' in options else None
+        print_journals(CubeReader(data_dir), int(options['--journals']), year,
+                       int(options.get('-k', 10)))
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
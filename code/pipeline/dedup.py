@@ -0,0 +1,304 @@
+"""dedup.py
+
+Find duplicate articles before running the pipeline.
+
+The PMC bulk data has articles that occur more than once, for example the same
+article under more than one journal directory, or an older and a newer version
+of an article. This script is a pre-pass that takes a file list and writes a new
+file list without the duplicates, which can then be handed to the pipeline
+scripts.
+
+Usage:
+
+$ python3 dedup.py -s SOURCE_DIR -f FILELIST -b BEGIN -e END -o OUTFILE [OPTIONS]
+$ python3 dedup.py --fingerprints FPFILE -s SOURCE_DIR -f FILELIST -b BEGIN -e END [OPTIONS]
+$ python3 dedup.py --resolve OUTFILE FPFILE1 FPFILE2 ...
+
+The first invocation fingerprints all files on lines BEGIN through END of
+FILELIST (paths relative to SOURCE_DIR) and writes the file list without
+duplicates to OUTFILE. A report with one line for each file that was dropped,
+with the reason and the file that was kept instead, is written next to it with
+a -duplicates.tsv suffix. Options:
+
+-j JOBS       number of worker processes (default 1)
+--shard I/N   only use the I-th of N shards, see utils.parse_shard()
+
+The second invocation only writes the fingerprints, this is useful to split the
+work over several runs (for example one for each shard). The fingerprint files of
+all runs are then handed to the third invocation, which writes the output as the
+first invocation does.
+
+A fingerprint has the SHA-1 hash of the file content, the pmc and pmid
+identifiers, the article version and the most recent date in the front matter.
+The identifiers, version and dates are taken from the article-meta element with
+regular expressions, the file is never parsed. Duplicates are resolved as
+follows:
+
+1. Files with the same content are exact duplicates, only the first one in the
+   file list is kept.
+2. Files that share a pmc identifier or a pmid are versions of the same article,
+   only the latest one is kept. The latest version is the one with the highest
+   article-version, then the most recent date and then the largest size. If all
+   of those are the same the first one in the file list is kept.
+
+"""
+
+
+import os
+import re
+import sys
+import getopt
+import hashlib
+import functools
+
+from utils import elements, parse_shard
+from schedule import run_jobs
+
+
+BLOCK_SIZE = 1 << 16
+
+# stop looking for the end of the front matter after this many bytes
+MAX_FRONT = 1 << 20
+
+# number of files handed to a worker at once
+CHUNK_SIZE = 64
+
+ARTICLE_META_END = b'</article-meta>'
+
+ARTICLE_ID = re.compile(rb'<article-id[^>]*pub-id-type="([^"]+)"[^>]*>\s*([^<\s]+)\s*</article-id>')
+ARTICLE_VERSION = re.compile(rb'<article-version[^>]*>\s*([^<\s]+)\s*</article-version>')
+DATE = re.compile(rb'<(pub-date|date)\b[^>]*>(.*?)</\1>', re.DOTALL)
+YEAR = re.compile(rb'<year>\s*(\d+)\s*</year>')
+MONTH = re.compile(rb'<month>\s*(\d+)\s*</month>')
+DAY = re.compile(rb'<day>\s*(\d+)\s*</day>')
+
+FIELDS = ('n', 'fname', 'size', 'sha1', 'id-pmc', 'id-pmid', 'version', 'date')
+
+
+def fingerprint(source_dir, n, fname):
+    """Return the fingerprint of a file as a dictionary. The file is read once,
+    the front matter is kept only until the end of article-meta is seen."""
+    sha1 = hashlib.sha1()
+    front = b''
+    in_front = True
+    size = 0
+    with open(os.path.join(source_dir, fname), 'rb') as fh:
+        while True:
+            block = fh.read(BLOCK_SIZE)
+            if not block:
+                break
+            size += len(block)
+            sha1.update(block)
+            if in_front:
+                front += block
+                # the end tag may straddle two blocks
+                end = front.find(ARTICLE_META_END, max(0, len(front) - len(block) - len(ARTICLE_META_END)))
+                if end >= 0:
+                    front = front[:end]
+                    in_front = False
+                elif len(front) > MAX_FRONT:
+                    in_front = False
+    ids = {}
+    for id_type, value in ARTICLE_ID.findall(front):
+        ids.setdefault(id_type.decode('utf8'), value.decode('utf8'))
+    pmc = ids.get('pmc', ids.get('pmcid'))
+    if pmc is not None and pmc.upper().startswith('PMC'):
+        pmc = pmc[3:]
+    version = ARTICLE_VERSION.search(front)
+    return {'n': n, 'fname': fname, 'size': size, 'sha1': sha1.hexdigest(),
+            'id-pmc': pmc, 'id-pmid': ids.get('pmid'),
+            'version': version.group(1).decode('utf8') if version else None,
+            'date': _latest_date(front)}
+
+
+def _latest_date(front):
+    dates = []
+    for _, date in DATE.findall(front):
+        year = YEAR.search(date)
+        if year is None:
+            continue
+        month = MONTH.search(date)
+        day = DAY.search(date)
+        dates.append("%04d-%02d-%02d" % (int(year.group(1)),
+                                         int(month.group(1)) if month else 0,
+                                         int(day.group(1)) if day else 0))
+    return max(dates) if dates else None
+
+
+def fingerprint_chunk(source_dir, chunk):
+    """Return fingerprints for a list of (n, fname) pairs, this runs in the
+    workers."""
+    fingerprints = []
+    for n, fname in chunk:
+        try:
+            fingerprints.append(fingerprint(source_dir, n, fname))
+        except Exception as e:
+            sys.stderr.write("ERROR on %07d  %s  %s\n" % (n, fname, e))
+    return fingerprints
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def collect_fingerprints(source_dir, filelist, start, end, jobs=1, shard=None):
+    fingerprints = []
+    fun = functools.partial(fingerprint_chunk, source_dir)
+    chunks = _chunks(elements(filelist, start, end, shard), CHUNK_SIZE)
+    for result in run_jobs(fun, chunks, jobs):
+        fingerprints.extend(result)
+        sys.stderr.write("\r%d files" % len(fingerprints))
+    sys.stderr.write("\n")
+    return fingerprints
+
+
+def write_fingerprints(fingerprints, fname):
+    with open(fname, 'w') as fh:
+        for fp in sorted(fingerprints, key=lambda fp: fp['n']):
+            fh.write("\t".join(_as_string(fp[field]) for field in FIELDS) + "\n")
+
+
+def _as_string(value):
+    return '-' if value is None else str(value)
+
+
+def read_fingerprints(fname):
+    fingerprints = []
+    with open(fname) as fh:
+        for line in fh:
+            values = [None if v == '-' else v for v in line.rstrip("\n").split("\t")]
+            fp = dict(zip(FIELDS, values))
+            fp['n'] = int(fp['n'])
+            fp['size'] = int(fp['size'])
+            fingerprints.append(fp)
+    return fingerprints
+
+
+def resolve(fingerprints):
+    """Return a list of fingerprints to keep, in file list order, and a list of
+    (fingerprint, reason, kept fingerprint) triples for the ones dropped."""
+    fingerprints = sorted(fingerprints, key=lambda fp: fp['n'])
+    dropped = []
+    # exact duplicates
+    by_hash = {}
+    unique = []
+    for fp in fingerprints:
+        if fp['sha1'] in by_hash:
+            dropped.append((fp, 'duplicate', by_hash[fp['sha1']]))
+        else:
+            by_hash[fp['sha1']] = fp
+            unique.append(fp)
+    # versions, files are linked if they share either identifier
+    parent = list(range(len(unique)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    first_with_id = {}
+    for i, fp in enumerate(unique):
+        for field in ('id-pmc', 'id-pmid'):
+            if fp[field] is None:
+                continue
+            key = (field, fp[field])
+            if key in first_with_id:
+                parent[find(i)] = find(first_with_id[key])
+            else:
+                first_with_id[key] = i
+    groups = {}
+    for i, fp in enumerate(unique):
+        groups.setdefault(find(i), []).append(fp)
+    keep = []
+    for group in groups.values():
+        latest = max(group, key=_version_key)
+        keep.append(latest)
+        for fp in group:
+            if fp is not latest:
+                dropped.append((fp, 'superseded', latest))
+    keep.sort(key=lambda fp: fp['n'])
+    dropped.sort(key=lambda triple: triple[0]['n'])
+    return keep, dropped
+
+
+def _version_key(fp):
+    version = fp['version']
+    try:
+        version = float(version) if version is not None else -1.0
+    except ValueError:
+        version = -1.0
+    # the last element prefers the earlier file if all else is equal
+    return (version, fp['date'] or '', fp['size'], -fp['n'])
+
+
+def write_results(keep, dropped, outfile):
+    with open(outfile, 'w') as fh:
+        for fp in keep:
+            fh.write("%s\t%d\n" % (fp['fname'], fp['size']))
+    report_file = report_filename(outfile)
+    with open(report_file, 'w') as fh:
+        for fp, reason, kept in dropped:
+            fh.write("%s\t%s\t%s\n" % (fp['fname'], reason, kept['fname']))
+    duplicates = [fp for fp, reason, _ in dropped if reason == 'duplicate']
+    superseded = [fp for fp, reason, _ in dropped if reason == 'superseded']
+    print("Kept %d files, dropped %d exact duplicates and %d older versions"
+          % (len(keep), len(duplicates), len(superseded)))
+    print("Dropped %d bytes of %d" % (sum(fp['size'] for fp, _, _ in dropped),
+                                      sum(fp['size'] for fp in keep + [d[0] for d in dropped])))
+    print("Wrote %s and %s" % (outfile, report_file))
+
+
+def report_filename(outfile):
+    basename = outfile[:-4] if outfile.endswith('.txt') else outfile
+    return basename + '-duplicates.tsv'
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 dedup.py -s SOURCE_DIR -f FILELIST -b BEGIN -e END -o OUTFILE"
+          + "\n          [-j JOBS] [--shard I/N]"
+          + "\n    $ python3 dedup.py --fingerprints FPFILE -s SOURCE_DIR -f FILELIST -b BEGIN -e END"
+          + "\n          [-j JOBS] [--shard I/N]"
+          + "\n    $ python3 dedup.py --resolve OUTFILE FPFILE1 FPFILE2 ..."
+          + "\n    $ python3 dedup.py (-h | --help)\n")
+
+
+def main(args):
+    source_dir = '/DATA/eager/pubmed-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    opts, args = getopt.getopt(args, 's:f:b:e:o:j:h',
+                               ['shard=', 'fingerprints=', 'resolve=', 'help'])
+    options = dict(opts)
+
+    if '-h' in options or '--help' in options:
+        usage()
+    elif '--resolve' in options:
+        fingerprints = []
+        for fname in args:
+            fingerprints.extend(read_fingerprints(fname))
+        write_results(*resolve(fingerprints), options['--resolve'])
+    elif '-o' not in options and '--fingerprints' not in options:
+        usage()
+    else:
+        shard = parse_shard(options['--shard']) if '--shard' in options else None
+        fingerprints = collect_fingerprints(options.get('-s', source_dir),
+                                            options.get('-f', filelist),
+                                            int(options.get('-b', 1)),
+                                            int(options.get('-e', 1)),
+                                            jobs=int(options.get('-j', 1)), shard=shard)
+        if '--fingerprints' in options:
+            write_fingerprints(fingerprints, options['--fingerprints'])
+        else:
+            write_results(*resolve(fingerprints), options['-o'])
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
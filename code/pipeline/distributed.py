@@ -0,0 +1,493 @@
+"""distributed.py
+
+Run a pipeline stage on several machines that share a file system, without a
+coordinator.
+
+Usage:
+
+$ python3 distributed.py --stage STAGE -s SOURCE_DIR -d DATA_DIR -f FILELIST [OPTIONS]
+$ python3 distributed.py --status --stage STAGE -d DATA_DIR -f FILELIST [--name NAME]
+$ python3 distributed.py (-h | --help)
+
+The first invocation starts a worker for STAGE, which is one of convert, lif or
+topics (convert_nxml.py, create_lif.py and generate_topics.py). The same command
+can be started on any number of hosts that see DATA_DIR, and more than once on
+the same host. Workers split lines BEGIN through END of FILELIST (by default the
+whole list) into chunks and claim chunks one at a time until all chunks are
+done. Options:
+
+-b BEGIN            first line of the file list (default 1)
+-e END              last line of the file list (default the last line)
+--chunk N           number of lines in a chunk (default 1000)
+--jobs J            number of worker processes for each chunk (default 1)
+--lease SECONDS     time after which the lease of a worker that stopped sending
+                    heartbeats expires (default 600)
+--name NAME         name of the run (default STAGE-FILELIST without extension)
+--compress (gz|zst) write compressed outputs, see convert_nxml.py
+
+All state is kept in DATA_DIR/dist/NAME. The first worker writes plan.json with
+the file list, the range and the chunk size, later workers check that they were
+started with the same settings. A worker claims a chunk by creating a lease file
+for it, which is an atomic operation that only one worker can win, also on NFS.
+While the chunk is processed a heartbeat thread updates the modification time of
+the lease. If the lease is older than --lease seconds the worker is assumed to
+be dead and another worker takes over the chunk. When a chunk is finished a done
+marker with the counts for the chunk is written and the lease is removed. Since
+outputs are simply overwritten it does no harm if a chunk is processed twice,
+which may happen when a slow worker loses its lease. The clocks of all hosts
+should be synchronized to well within the lease time.
+
+If a chunk fails with an exception, the error is written to a failed marker,
+the lease is released and the worker goes on with the next chunk. Failed chunks
+are not claimed again, they are listed by --status, remove their .failed files
+and start a worker to retry them.
+
+A worker keeps what it can between chunks, for the topics stage the model is
+loaded once and the pool of --jobs worker processes is reused for all chunks.
+
+A worker exits when there are no chunks left to claim, after each chunk it
+prints the progress of the whole run. The second invocation prints the progress
+at any time, with the workers that hold a lease.
+
+To try this on one machine, start a few workers in the background:
+
+$ for i in 1 2 3; do python3 distributed.py --stage convert -s SRC -d DATA -f FILES & done
+
+If a worker is killed its chunk is taken over by another worker once the lease
+expires. Chunks that are done are skipped, so starting workers again after all
+of them stopped continues the run.
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import getopt
+import datetime
+import traceback
+import threading
+
+from utils import count_lines
+
+
+STAGES = ('convert', 'lif', 'topics')
+
+DIST_DIR = 'dist'
+PLAN_FILE = 'plan.json'
+
+CHUNK_SIZE = 1000
+
+# seconds after the last heartbeat when a lease expires
+LEASE_TIME = 600
+
+
+def run_name(stage, filelist):
+    return "%s-%s" % (stage, os.path.splitext(os.path.basename(filelist))[0])
+
+
+class WorkDir(object):
+
+    """The directory with the plan, the leases and the done markers of a run."""
+
+    def __init__(self, data_dir, name):
+        self.path = os.path.join(data_dir, DIST_DIR, name)
+        self.plan = None
+
+    def create_plan(self, filelist, start, end, chunk_size):
+        """Write the plan if there is none yet, otherwise check that it is the same
+        as the one given."""
+        os.makedirs(self.path, exist_ok=True)
+        plan = {'filelist': os.path.abspath(filelist), 'start': start, 'end': end,
+                'chunk_size': chunk_size,
+                'chunks': max(0, (end - start + chunk_size) // chunk_size)}
+        # a linked file appears with all its content at once, unlike a file that
+        # is created and then written to
+        tmp_file = os.path.join(self.path, "%s.%s.tmp" % (PLAN_FILE, uuid.uuid4().hex))
+        with open(tmp_file, 'w') as fh:
+            json.dump(plan, fh, indent=4)
+        try:
+            os.link(tmp_file, self.plan_file())
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_file)
+        self.read_plan()
+        for key in ('filelist', 'start', 'end', 'chunk_size'):
+            if self.plan[key] != plan[key]:
+                raise ValueError("%s was created with %s=%s, not %s, use --name for another run"
+                                 % (self.plan_file(), key, self.plan[key], plan[key]))
+
+    def read_plan(self):
+        with open(self.plan_file()) as fh:
+            self.plan = json.load(fh)
+        return self.plan
+
+    def plan_file(self):
+        return os.path.join(self.path, PLAN_FILE)
+
+    def chunks(self):
+        return range(self.plan['chunks'])
+
+    def chunk_range(self, i):
+        start = self.plan['start'] + i * self.plan['chunk_size']
+        return start, min(self.plan['end'], start + self.plan['chunk_size'] - 1)
+
+    def lease_file(self, i):
+        return os.path.join(self.path, "chunk-%05d.lease" % i)
+
+    def done_file(self, i):
+        return os.path.join(self.path, "chunk-%05d.done" % i)
+
+    def failed_file(self, i):
+        return os.path.join(self.path, "chunk-%05d.failed" % i)
+
+    def is_done(self, i):
+        return os.path.exists(self.done_file(i))
+
+    def is_failed(self, i):
+        return os.path.exists(self.failed_file(i))
+
+    def claim(self, owner, lease_time=LEASE_TIME):
+        """Return the number of a chunk that is not done or failed and its Lease, or
+        None if all chunks are done, failed or leased."""
+        for i in self.chunks():
+            if self.is_done(i) or self.is_failed(i):
+                continue
+            lease = Lease.acquire(self.lease_file(i), owner, lease_time)
+            if lease is None:
+                continue
+            if self.is_done(i):
+                # finished by another worker after we checked
+                lease.release()
+                continue
+            return i, lease
+        return None
+
+    def mark_done(self, i, record):
+        self._write_marker(self.done_file(i), record)
+
+    def mark_failed(self, i, record):
+        self._write_marker(self.failed_file(i), record)
+
+    def read_done(self, i):
+        return self._read_marker(self.done_file(i))
+
+    def read_failed(self, i):
+        return self._read_marker(self.failed_file(i))
+
+    @staticmethod
+    def _write_marker(fname, record):
+        tmp_file = "%s.%s.tmp" % (fname, uuid.uuid4().hex)
+        with open(tmp_file, 'w') as fh:
+            json.dump(record, fh)
+        os.replace(tmp_file, fname)
+
+    @staticmethod
+    def _read_marker(fname):
+        try:
+            with open(fname) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+
+class Lease(object):
+
+    """A lease on a chunk, which is a file that only one worker can create. The
+    file has a token that identifies the owner and its modification time is the
+    time of the last heartbeat."""
+
+    def __init__(self, fname, token, lease_time=LEASE_TIME):
+        self.fname = fname
+        self.token = token
+        self.lease_time = lease_time
+
+    @classmethod
+    def acquire(cls, fname, owner, lease_time=LEASE_TIME):
+        """Return a Lease, or None if someone else holds a lease that did not
+        expire."""
+        token = "%s %s" % (owner, uuid.uuid4().hex)
+        try:
+            fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not cls._take_over(fname, token, lease_time):
+                return None
+            try:
+                fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                return None
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(token + "\n")
+        return cls(fname, token, lease_time)
+
+    @staticmethod
+    def _take_over(fname, token, lease_time):
+        """Remove an expired lease, returns False if the lease is still valid or
+        if another worker got to it first."""
+        if not lease_expired(fname, lease_time):
+            return False
+        # renaming is atomic, so only one of the workers that saw the expired
+        # lease moves it away
+        stale_file = "%s.%s.stale" % (fname, token.split()[-1])
+        try:
+            os.rename(fname, stale_file)
+        except FileNotFoundError:
+            return False
+        if not lease_expired(stale_file, lease_time):
+            # another worker took over between the check and the rename, put
+            # its lease back unless yet another worker created a new one
+            try:
+                os.link(stale_file, fname)
+            except FileExistsError:
+                pass
+            os.remove(stale_file)
+            return False
+        os.remove(stale_file)
+        return True
+
+    def owned(self):
+        try:
+            with open(self.fname) as fh:
+                return fh.read().strip() == self.token
+        except OSError:
+            return False
+
+    def renew(self):
+        """Update the heartbeat, returns False if the lease was lost."""
+        if not self.owned():
+            return False
+        os.utime(self.fname)
+        return True
+
+    def release(self):
+        if self.owned():
+            os.remove(self.fname)
+
+
+def lease_expired(fname, lease_time):
+    try:
+        return time.time() - os.path.getmtime(fname) > lease_time
+    except FileNotFoundError:
+        return False
+
+
+class Heartbeat(object):
+
+    """Renews a lease on a thread, four times in each lease period."""
+
+    def __init__(self, lease):
+        self.lease = lease
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.lease.lease_time / 4):
+            if not self.lease.renew():
+                sys.stderr.write("\nWARNING: lost the lease on %s\n" % self.lease.fname)
+                self.lost = True
+                return
+
+
+class StageRunner(object):
+
+    """Runs a stage on chunks of the file list. For the topics stage the model is
+    loaded and the pool of worker processes is created once, and reused for all
+    chunks. The stage modules are imported here so that a worker only loads what
+    it needs."""
+
+    def __init__(self, stage, source_dir, data_dir, filelist, jobs=1, compress=None):
+        if stage not in STAGES:
+            raise ValueError("stage should be one of %s" % ', '.join(STAGES))
+        self.stage = stage
+        self.source_dir = source_dir
+        self.data_dir = data_dir
+        self.filelist = filelist
+        self.jobs = jobs
+        self.compress = compress
+        self.pool = None
+        if stage == 'topics':
+            import generate_topics
+            self.pool = generate_topics.worker_pool(jobs)
+
+    def run(self, start, end):
+        """Run the stage on a range of the file list and return its Monitor."""
+        if self.stage == 'convert':
+            import convert_nxml
+            return convert_nxml.process_filelist(self.source_dir, self.data_dir, self.filelist,
+                                                 start, end, jobs=self.jobs,
+                                                 compress=self.compress)
+        elif self.stage == 'lif':
+            import create_lif
+            return create_lif.process_filelist(self.data_dir, self.filelist, start, end,
+                                               jobs=self.jobs, compress=self.compress)
+        import generate_topics
+        return generate_topics.generate_topics(self.data_dir, self.filelist, start, end,
+                                               jobs=self.jobs, compress=self.compress,
+                                               pool=self.pool)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def work(stage, source_dir, data_dir, filelist, start, end, chunk_size=CHUNK_SIZE,
+         jobs=1, lease_time=LEASE_TIME, name=None, compress=None):
+    workdir = WorkDir(data_dir, name or run_name(stage, filelist))
+    workdir.create_plan(filelist, start, end, chunk_size)
+    owner = "%s:%d" % (socket.gethostname(), os.getpid())
+    runner = StageRunner(stage, source_dir, data_dir, filelist, jobs, compress)
+    chunks = 0
+    failed = 0
+    try:
+        while True:
+            claimed = workdir.claim(owner, lease_time)
+            if claimed is None:
+                break
+            i, lease = claimed
+            chunk_start, chunk_end = workdir.chunk_range(i)
+            print("\n%s claimed chunk %d, lines %d-%d" % (owner, i, chunk_start, chunk_end))
+            heartbeat = Heartbeat(lease).start()
+            t0 = time.time()
+            record = {'chunk': i, 'start': chunk_start, 'end': chunk_end,
+                      'owner': owner, 'started': t0}
+            try:
+                monitor = runner.run(chunk_start, chunk_end)
+            except Exception as e:
+                sys.stderr.write("\nERROR on chunk %d  %s\n" % (i, e))
+                traceback.print_exc()
+                monitor = None
+                record.update(error=str(e))
+            finally:
+                heartbeat.stop()
+            record['finished'] = time.time()
+            # the marker is written before the lease is released so that no other
+            # worker claims the chunk in between
+            if monitor is None:
+                workdir.mark_failed(i, record)
+                failed += 1
+            else:
+                # the outputs are there even if the lease was lost, so the chunk
+                # is done whoever holds the lease now
+                record.update(documents=monitor.documents, errors=monitor.errors,
+                              skipped=monitor.skipped)
+                workdir.mark_done(i, record)
+                chunks += 1
+            lease.release()
+            print_status(workdir, lease_time, show_leases=False)
+    finally:
+        runner.close()
+    print("\n%s finished after %d chunks (%d failed), nothing left to claim"
+          % (owner, chunks, failed))
+
+
+def status(workdir, lease_time=LEASE_TIME):
+    """Return a dictionary with the progress of a run."""
+    result = {'chunks': len(workdir.chunks()), 'done': 0, 'running': [], 'expired': [],
+              'failed': [], 'documents': 0, 'errors': 0, 'skipped': 0, 'lines_done': 0,
+              'started': None, 'finished': None}
+    for i in workdir.chunks():
+        record = workdir.read_done(i)
+        if record is not None:
+            result['done'] += 1
+            result['lines_done'] += record['end'] - record['start'] + 1
+            for key in ('documents', 'errors', 'skipped'):
+                result[key] += record[key]
+            result['started'] = min(result['started'] or record['started'], record['started'])
+            result['finished'] = max(result['finished'] or record['finished'], record['finished'])
+            continue
+        record = workdir.read_failed(i)
+        if record is not None:
+            result['failed'].append((i, record['owner'], record['error']))
+            continue
+        lease_file = workdir.lease_file(i)
+        try:
+            with open(lease_file) as fh:
+                owner = fh.read().split()[0]
+            age = time.time() - os.path.getmtime(lease_file)
+        except (OSError, IndexError):
+            continue
+        key = 'expired' if age > lease_time else 'running'
+        result[key].append((i, owner, age))
+    result['pending'] = (result['chunks'] - result['done'] - len(result['failed'])
+                         - len(result['running']) - len(result['expired']))
+    return result
+
+
+def print_status(workdir, lease_time=LEASE_TIME, show_leases=True):
+    s = status(workdir, lease_time)
+    print("\n%s: %d/%d chunks done, %d running, %d expired, %d failed, %d pending"
+          % (os.path.basename(workdir.path), s['done'], s['chunks'],
+             len(s['running']), len(s['expired']), len(s['failed']), s['pending']))
+    line = "%d documents, %d errors, %d skipped" % (s['documents'], s['errors'], s['skipped'])
+    if s['done'] and s['finished'] > s['started']:
+        rate = s['lines_done'] / (s['finished'] - s['started'])
+        lines_left = workdir.plan['end'] - workdir.plan['start'] + 1 - s['lines_done']
+        eta = datetime.timedelta(seconds=int(lines_left / rate))
+        line += ", %.1f docs/s, ETA %s" % (rate, eta)
+    print(line)
+    if show_leases:
+        for label in ('running', 'expired'):
+            for i, owner, age in s[label]:
+                print("    chunk %05d  %-8s %s, last heartbeat %ds ago" % (i, label, owner, age))
+        for i, owner, error in s['failed']:
+            print("    chunk %05d  %-8s %s, %s" % (i, 'failed', owner, error))
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 distributed.py --stage STAGE -s SOURCE_DIR -d DATA_DIR -f FILELIST"
+          + "\n          [-b BEGIN] [-e END] [--chunk N] [--jobs J] [--lease SECONDS]"
+          + "\n          [--name NAME] [--compress (gz|zst)]"
+          + "\n    $ python3 distributed.py --status --stage STAGE -d DATA_DIR -f FILELIST [--name NAME]"
+          + "\n    $ python3 distributed.py (-h | --help)\n")
+
+
+def main(args):
+    source_dir = '/DATA/eager/pubmed-01000'
+    data_dir = '/DATA/eager/sample-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(
+        args, 's:d:f:b:e:h',
+        ['stage=', 'status', 'chunk=', 'jobs=', 'lease=', 'name=', 'compress=',
+         'help'])[0])
+    source_dir = options.get('-s', source_dir)
+    data_dir = options.get('-d', data_dir)
+    filelist = options.get('-f', filelist)
+    stage = options.get('--stage')
+    name = options.get('--name') or (run_name(stage, filelist) if stage else None)
+    lease_time = float(options.get('--lease', LEASE_TIME))
+
+    if '-h' in options or '--help' in options or stage not in STAGES:
+        usage()
+    elif '--status' in options:
+        workdir = WorkDir(data_dir, name)
+        workdir.read_plan()
+        print_status(workdir, lease_time)
+    else:
+        work(stage, source_dir, data_dir, filelist,
+             int(options.get('-b', 1)),
+             int(options['-e']) if '-e' in options else count_lines(filelist),
+             chunk_size=int(options.get('--chunk', CHUNK_SIZE)),
+             jobs=int(options.get('--jobs', 1)),
+             lease_time=lease_time, name=name,
+             compress=options.get('--compress'))
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
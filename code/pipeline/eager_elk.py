@@ -0,0 +1,91 @@
+"""eager_elk.py
+
+One entry point for the pipeline scripts.
+
+Usage:
+
+$ python3 eager_elk.py COMMAND [OPTIONS]
+$ python3 eager_elk.py COMMAND --help
+$ python3 eager_elk.py (-h | --help)
+
+Runs the script for COMMAND with OPTIONS by calling the main() function of its
+module, so the options are the ones of the script. The commands are listed in
+COMMANDS, for example
+
+$ python3 eager_elk.py convert -s SOURCE_DIR -d DATA_DIR -f FILELIST -b 1 -e 1000
+$ python3 eager_elk.py topics -d DATA_DIR -f FILELIST -s 1 -e 1000 --jobs 8
+
+Only the module for COMMAND is imported, and the scripts themselves import
+gensim, nltk and bs4 only when they need them, so that --help and short runs
+start quickly. Use bench_startup.py to measure the startup time of each
+command.
+
+The module is imported under its own name and not run as __main__, so that the
+worker processes of --jobs can find the functions they run in it also when they
+are started with spawn or forkserver instead of fork (the default on macOS).
+
+"""
+
+
+import os
+import sys
+import importlib
+
+
+# command, module and description, stats is a script in ../analysis
+COMMANDS = (
+    ('convert', 'convert_nxml', 'convert nxml files into JSON'),
+    ('lif', 'create_lif', 'create LIF and text files from the JSON files'),
+    ('topics', 'generate_topics', 'build the topic model or add topics to the LIF files'),
+    ('topic-server', 'topic_server', 'serve the topic model to local clients'),
+    ('vectors', 'topic_vectors', 'merge and query the topic vectors'),
+    ('index', 'search_index', 'build and search a local full-text index'),
+    ('cube', 'cube', 'build and query the journal, year and topic cube'),
+    ('citations', 'citations', 'build and query the citation graph'),
+    ('export', 'export_table', 'export metadata and topics to a columnar table'),
+    ('dedup', 'dedup', 'remove duplicate articles from a file list'),
+    ('update', 'update', 'apply incremental updates to a data directory'),
+    ('distributed', 'distributed', 'run a stage on several machines'),
+    ('schedule', 'schedule', 'split a file list into parts of equal cost'),
+    ('stats', '../analysis/corpus_stats.py', 'collect statistics on the nxml files'),
+)
+
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(command, args):
+    """Run the script for the command with the arguments as its command line."""
+    for name, module, description in COMMANDS:
+        if name == command:
+            break
+    else:
+        raise ValueError("unknown command: %s" % command)
+    if module.endswith('.py'):
+        # a script in another directory, like ../analysis/corpus_stats.py
+        path = os.path.normpath(os.path.join(PIPELINE_DIR, module))
+        sys.path.insert(0, os.path.dirname(path))
+        module = os.path.splitext(os.path.basename(path))[0]
+    importlib.import_module(module).main(list(args))
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 eager_elk.py COMMAND [OPTIONS]"
+          + "\n    $ python3 eager_elk.py COMMAND --help"
+          + "\n    $ python3 eager_elk.py (-h | --help)\n"
+          + "\nCommands:\n")
+    for name, module, description in COMMANDS:
+        print("    %-14s %s" % (name, description))
+    print('')
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        usage()
+    elif sys.argv[1] not in [name for name, module, description in COMMANDS]:
+        print("\nUnknown command: %s" % sys.argv[1])
+        usage()
+        sys.exit(2)
+    else:
+        run(sys.argv[1], sys.argv[2:])
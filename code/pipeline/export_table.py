@@ -0,0 +1,376 @@
+"""export_table.py
+
+Export the metadata and the topics of all documents to a columnar table, so
+that analyses over the whole corpus do not have to parse the JSON and LIF files
+again.
+
+Usage:
+
+$ python3 export_table.py --export -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS] [--format FORMAT]
+$ python3 export_table.py --show COLUMNS -d DATA_DIR [--years FIRST-LAST] [-n N]
+$ python3 export_table.py --count COLUMN -d DATA_DIR [--years FIRST-LAST] [-k K]
+
+The first invocation exports the documents on lines BEGIN through END of
+FILELIST to DATA_DIR/tbl. The pmc and pmid identifiers, the title, the journal,
+the year and the authors are taken from the JSON files in DATA_DIR/jsn and the
+topics and their scores from the topic files in DATA_DIR/top (documents without
+a topic file have no topics). The table is partitioned on the year: the file
+list is split into chunks of CHUNK_SIZE documents, the documents of a chunk are
+grouped by year and sorted on journal, and each group is written as a part to
+DATA_DIR/tbl/year=YYYY/part-NNNNN (year=unknown for documents without a year).
+With -j JOBS the chunks are handled by JOBS worker processes, which write their
+parts themselves. FORMAT is parquet (the default if the pyarrow package is
+installed) or npz.
+
+The second invocation prints the COLUMNS (a comma-separated list) of the first
+N rows (default 10), the third prints the K (default 10) most frequent values
+of COLUMN, for example the journals with the most documents or the most
+frequent topics. Both can be restricted to the documents published in the years
+FIRST through LAST.
+
+From Python:
+
+>>> table = Table(data_dir)
+>>> columns = table.read(['journal', 'year'], years=(2010, 2015))
+
+The columns are listed in COLUMNS. The identifiers and the year are integers,
+with -1 for missing values, the title and the journal are strings, with the
+empty string for missing values, and the authors, the topics and the topic
+scores are lists. In the parquet format each part is a parquet file. In the npz
+format each part is an uncompressed npz file with an array for the integer
+columns, concatenated utf8 bytes plus an array of offsets for the string
+columns, and an array of offsets into the concatenated values for the list
+columns. In both formats reading a column reads only the data of that column.
+DATA_DIR/tbl/meta.json lists the parts with their year and their number of
+rows, so that the parts of years that are not asked for are not read at all.
+
+The table is not kept up to date by update.py, export it again after updates.
+
+"""
+
+
+import os
+import sys
+import json
+import getopt
+import functools
+import importlib.util
+from collections import Counter
+
+import numpy as np
+
+from utils import elements, time_elapsed, open_file, existing_file
+from schedule import run_jobs
+from cube import document_topics
+
+
+# column names and types, lists of strings are 'strings' and so on
+COLUMNS = (
+    ('pmc', 'int'),
+    ('pmid', 'int'),
+    ('fname', 'string'),
+    ('title', 'string'),
+    ('journal', 'string'),
+    ('year', 'int'),
+    ('authors', 'strings'),
+    ('topics', 'ints'),
+    ('topic_scores', 'floats'))
+
+COLUMN_TYPES = dict(COLUMNS)
+
+FORMATS = ('parquet', 'npz')
+
+# number of documents handed to a worker at once, a worker writes a part for
+# each year in its chunk, so larger chunks give fewer and larger parts
+CHUNK_SIZE = 100000
+
+MISSING = -1
+
+
+def table_dir(data_dir):
+    return os.path.join(data_dir, 'tbl')
+
+
+def have_pyarrow():
+    # pyarrow takes a while to import, so only check whether it is there
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def default_format():
+    return 'parquet' if have_pyarrow() else 'npz'
+
+
+def _int(value):
+    value = str(value).strip() if value is not None else ''
+    return int(value) if value.isdigit() else MISSING
+
+
+def document_row(data_dir, fname):
+    """Return a dictionary with the values of all columns for a document."""
+    with open_file(existing_file(os.path.join(data_dir, 'jsn', fname))) as fh:
+        json_obj = json.load(fh)
+    topics = document_topics(data_dir, fname) or []
+    return {'pmc': _int(json_obj.get('id-pmc')),
+            'pmid': _int(json_obj.get('id-pmid')),
+            'fname': fname,
+            'title': json_obj.get('title') or '',
+            'journal': json_obj.get('journal') or '',
+            'year': _int(json_obj.get('year')),
+            'authors': json_obj.get('authors') or [],
+            'topics': [topic for topic, score in topics],
+            'topic_scores': [score for topic, score in topics]}
+
+
+## Writing
+
+def export_chunk(data_dir, out_dir, fmt, chunk):
+    """Create and write the parts of the table for a (chunk number, file names)
+    pair, this runs in the workers. There is a part for each year, with the rows
+    sorted on journal. Returns a list with a dictionary for each part, with the
+    part file name, the year and the number of rows."""
+    number, fnames = chunk
+    years = {}
+    for fname in fnames:
+        try:
+            row = document_row(data_dir, fname)
+        except Exception as e:
+            sys.stderr.write("ERROR on %s  %s\n" % (fname, e))
+            continue
+        years.setdefault(row['year'], []).append(row)
+    parts = []
+    for year, rows in sorted(years.items()):
+        rows.sort(key=lambda row: row['journal'])
+        columns = {name: [row[name] for row in rows] for name, column_type in COLUMNS}
+        fname = os.path.join(partition(year), 'part-%05d.%s' % (number, fmt))
+        os.makedirs(os.path.join(out_dir, partition(year)), exist_ok=True)
+        # written to a temporary file first so that readers never see half a part
+        tmp_file = os.path.join(out_dir, "%s.%d.tmp" % (fname, os.getpid()))
+        if fmt == 'parquet':
+            write_parquet(tmp_file, columns)
+        else:
+            write_npz(tmp_file, columns)
+        os.replace(tmp_file, os.path.join(out_dir, fname))
+        parts.append({'file': fname, 'year': year, 'rows': len(rows)})
+    return parts, len(fnames)
+
+
+def partition(year):
+    """Return the directory of the parts for a year."""
+    return 'year=%s' % ('unknown' if year == MISSING else year)
+
+
+def write_parquet(fname, columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {'int': pa.int64(), 'string': pa.string(), 'strings': pa.list_(pa.string()),
+             'ints': pa.list_(pa.int32()), 'floats': pa.list_(pa.float32())}
+    schema = pa.schema([(name, types[column_type]) for name, column_type in COLUMNS])
+    table = pa.table([columns[name] for name, column_type in COLUMNS], schema=schema)
+    pq.write_table(table, fname)
+
+
+def write_npz(fname, columns):
+    arrays = {}
+    for name, column_type in COLUMNS:
+        values = columns[name]
+        if column_type == 'int':
+            arrays[name] = np.array(values, dtype=np.int64)
+        elif column_type == 'string':
+            arrays[name + '.data'], arrays[name + '.offsets'] = _encode_strings(values)
+        else:
+            arrays[name + '.offsets'] = _offsets(len(v) for v in values)
+            items = [item for v in values for item in v]
+            if column_type == 'strings':
+                arrays[name + '.items.data'], arrays[name + '.items.offsets'] = _encode_strings(items)
+            elif column_type == 'ints':
+                arrays[name + '.values'] = np.array(items, dtype=np.int32)
+            else:
+                arrays[name + '.values'] = np.array(items, dtype=np.float32)
+    with open(fname, 'wb') as fh:
+        np.savez(fh, **arrays)
+
+
+def _offsets(lengths):
+    lengths = np.fromiter(lengths, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _encode_strings(strings):
+    """Return the concatenated utf8 bytes of strings and their offsets."""
+    encoded = [s.encode('utf8') for s in strings]
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), _offsets(len(e) for e in encoded)
+
+
+def _chunks(fnames, size):
+    for i in range(0, len(fnames), size):
+        yield i // size, fnames[i:i + size]
+
+
+@time_elapsed
+def export(data_dir, filelist, start, end, jobs=1, fmt=None):
+    fmt = default_format() if fmt is None else fmt
+    if fmt not in FORMATS:
+        raise ValueError("format should be one of %s" % ', '.join(FORMATS))
+    if fmt == 'parquet' and not have_pyarrow():
+        raise ImportError("the pyarrow package is needed for the parquet format")
+    out_dir = table_dir(data_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    fnames = [fname for n, fname in elements(filelist, start, end)]
+    parts = []
+    done = 0
+    fun = functools.partial(export_chunk, data_dir, out_dir, fmt)
+    for chunk_parts, size in run_jobs(fun, _chunks(fnames, CHUNK_SIZE), jobs):
+        parts.extend(chunk_parts)
+        done += size
+        sys.stderr.write("\r%d documents" % done)
+    sys.stderr.write("\n")
+    parts.sort(key=lambda p: (p['year'], p['file']))
+    meta = {'format': fmt, 'columns': COLUMNS, 'rows': sum(p['rows'] for p in parts),
+            'parts': parts}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh, indent=4)
+    # parts left over from an earlier export with other years, more chunks or
+    # another format
+    current = set(os.path.join(out_dir, p['file']) for p in parts)
+    for directory, subdirs, fnames in os.walk(out_dir, topdown=False):
+        for fname in fnames:
+            if fname.startswith('part-') and os.path.join(directory, fname) not in current:
+                os.remove(os.path.join(directory, fname))
+        if directory != out_dir and not os.listdir(directory):
+            os.rmdir(directory)
+    print("Wrote %d documents in %d parts to %s" % (meta['rows'], len(parts), out_dir))
+
+
+## Reading
+
+class Table(object):
+
+    def __init__(self, data_dir):
+        self.directory = table_dir(data_dir)
+        with open(os.path.join(self.directory, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+        self.format = self.meta['format']
+        self.parts = self.meta['parts']
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def read(self, columns, years=None):
+        """Return a dictionary with the values of the columns, as a numpy array for
+        integer columns and as a list for the other columns. With years, a (first,
+        last) pair, only documents from those years are returned."""
+        for name in columns:
+            if name not in COLUMN_TYPES:
+                raise KeyError("no column %s" % name)
+        result = {name: [] for name in columns}
+        for part in self.parts:
+            # all rows of a part have the same year
+            if years is not None and not years[0] <= part['year'] <= years[1]:
+                continue
+            fname = os.path.join(self.directory, part['file'])
+            values = self.read_parquet(fname, columns) if self.format == 'parquet' \
+                else self.read_npz(fname, columns)
+            for name in columns:
+                result[name].append(values[name])
+        for name in columns:
+            if COLUMN_TYPES[name] == 'int':
+                result[name] = np.concatenate(result[name]) if result[name] else np.zeros(0, np.int64)
+            else:
+                result[name] = [value for values in result[name] for value in values]
+        return result
+
+    @staticmethod
+    def read_parquet(fname, columns):
+        import pyarrow.parquet as pq
+        table = pq.read_table(fname, columns=columns)
+        return {name: table.column(name).to_numpy() if COLUMN_TYPES[name] == 'int'
+                else table.column(name).to_pylist() for name in columns}
+
+    @staticmethod
+    def read_npz(fname, columns):
+        values = {}
+        # members of an npz file are only read when they are asked for
+        with np.load(fname) as npz:
+            for name in columns:
+                column_type = COLUMN_TYPES[name]
+                if column_type == 'int':
+                    values[name] = npz[name]
+                elif column_type == 'string':
+                    values[name] = _decode_strings(npz[name + '.data'], npz[name + '.offsets'])
+                else:
+                    offsets = npz[name + '.offsets']
+                    if column_type == 'strings':
+                        items = _decode_strings(npz[name + '.items.data'], npz[name + '.items.offsets'])
+                    else:
+                        items = npz[name + '.values'].tolist()
+                    values[name] = [items[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return values
+
+
+def _decode_strings(data, offsets):
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf8') for i in range(len(offsets) - 1)]
+
+
+def parse_years(spec):
+    """Return a (first, last) pair for FIRST-LAST or YEAR."""
+    first, _, last = spec.partition('-')
+    return int(first), int(last or first)
+
+
+def print_rows(table, columns, years=None, n=10):
+    values = table.read(columns, years)
+    print('\t'.join(columns))
+    for i in range(min(n, len(values[columns[0]]))):
+        print('\t'.join(str(values[name][i]) for name in columns))
+
+
+def print_counts(table, column, years=None, k=10):
+    values = table.read([column], years)[column]
+    if COLUMN_TYPES[column] in ('strings', 'ints', 'floats'):
+        values = [item for items in values for item in items]
+    elif COLUMN_TYPES[column] == 'int':
+        values = values.tolist()
+    for value, count in Counter(values).most_common(k):
+        print("%8d  %s" % (count, value))
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 export_table.py --export -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS]"
+          + "\n          [--format (parquet|npz)]"
+          + "\n    $ python3 export_table.py --show COLUMNS -d DATA_DIR [--years FIRST-LAST] [-n N]"
+          + "\n    $ python3 export_table.py --count COLUMN -d DATA_DIR [--years FIRST-LAST] [-k K]"
+          + "\n    $ python3 export_table.py (-h | --help)\n")
+
+
+def main(args):
+    data_dir = '/DATA/eager/sample-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(
+        args, 'd:f:b:e:j:k:n:h',
+        ['export', 'format=', 'show=', 'count=', 'years=', 'help'])[0])
+    data_dir = options.get('-d', data_dir)
+    years = parse_years(options['--years']) if '--years' in options else None
+
+    if '-h' in options or '--help' in options:
+        usage()
+    elif '--export' in options:
+        export(data_dir, options.get('-f', filelist),
+               int(options.get('-b', 1)), int(options.get('-e', 1)),
+               jobs=int(options.get('-j', 1)), fmt=options.get('--format'))
+    elif '--show' in options:
+        print_rows(Table(data_dir), options['--show'].split(','), years, int(options.get('-n', 10)))
+    elif '--count' in options:
+        print_counts(Table(data_dir), options['--count'], years, int(options.get('-k', 10)))
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -11,72 +11,366 @@ FILELIST (which has the relative paths from DATA_DIR/lif) only using the lines
 from BEGIN to END. Both BEGIN and END defaylt to 1. The model is written to
 ../../data/topics.
 
+Options for the vocabulary used when building the model:
+
+--no-below N   drop words that occur in less than N documents (default 5)
+--no-above F   drop words that occur in more than fraction F of all documents
+               (default 0.5)
+--keep-n N     keep at most the N most frequent words (default 100000)
+--hashed       use a hashing dictionary with N buckets instead of a regular
+               dictionary, the size of the dictionary then does not depend on
+               the vocabulary, but words can collide (the text data and the
+               corpus are still kept in memory)
+
+Statistics on the vocabulary are printed and also written to
+../../data/topics/vocabulary.json.
+
+Options for training:
+
+--passes N            run at most N passes over the corpus (default 15)
+--min-improvement F   stop when the perplexity improves by less than fraction F
+                      after a pass (default 0.001)
+--heldout F           fraction of documents held out for computing perplexity,
+                      these are not used for training (default 0, which trains
+                      on all documents and computes the perplexity on them)
+--resume              continue training from the last checkpoint
+
+After each pass the model is saved in ../../data/topics/checkpoints, together
+with checkpoint.json which has the perplexity for each pass. With --resume no
+data are collected, instead the dictionary and corpus saved by the interrupted
+run are used and training continues after the last finished pass. All passes use
+gensim's own learning rate schedule, except that a resumed run only approximates
+the schedule of an uninterrupted one.
+
 $ python generate_topics.py -d DATA_DIR -f FILELIST -b BEGIN -e END --crash?
 
 Run the topic model created with --train to generate topics for the files in
 DATA_DIR/lif as filtered by FILELIST, BEGIN and END. Results are written to
 DATA_DIR/top. Usually errors are trapped, adding the optional --crash option
-makes the script exit with an error.
+makes the script exit with an error. The full topic distributions are also
+written as rows of a dense matrix to DATA_DIR/vec, see topic_vectors.py.
+
+For both invocations --shard I/N restricts processing to the I-th of N shards of
+the BEGIN-END range, see utils.parse_shard(). When running the model, --jobs J
+uses J worker processes, each with its own copy of the model, and hands out the
+largest files first, --costs FILE can be used to give costs for each file. See
+schedule.py.
+
+When running the model a progress line is printed to standard error instead of a
+line for each file, --metrics FILE writes timings for each stage and other
+metrics to FILE and --record-costs FILE writes the time spent on each file to
+FILE, which can be handed to --costs in a later run. See instrument.py. With
+--profile FRACTION a random FRACTION of the files is profiled and the profiles
+are written to profile-topics.pstats and profile-topics.collapsed, --profiler
+and --profile-out are as for convert_nxml.py. See profiling.py. The LIF files
+are read ahead and the topic files written on separate threads, --prefetch,
+--readers and --writers are also as for convert_nxml.py. Compressed LIF files
+are read as well, and with --compress gz or --compress zst the topic files are
+written compressed, see utils.open_file().
 
 """
 
 
 import os
 import sys
-import codecs
+import json
 import pickle
 import getopt
+import functools
+import multiprocessing
 
-import gensim
-
-import nltk
-from nltk import word_tokenize
-from nltk.corpus import wordnet as wn
+# gensim and nltk take more than a second to import, so they are imported in the
+# functions that use them, this keeps --help and modules that only need a few
+# functions from here (like topic_server.py) quick to start
 
 from lif import Container, LIF, View, Annotation
-from utils import elements, ensure_directory, time_elapsed
+from utils import elements, ensure_directory, time_elapsed, parse_shard
+from utils import Prefetcher, BackgroundWriter, PREFETCH, READERS, WRITERS
+from utils import open_file, existing_file, write_file
+from schedule import schedule_items, run_jobs
+from instrument import DocTimer, Monitor, Progress, estimate_total
+from profiling import session, collector, profiler_from_options
 
 
 TOPICS_DIR = "../../data/topics"
 CORPUS_FILE = os.path.join(TOPICS_DIR, 'corpus.pkl')
 DICTIONARY_FILE = os.path.join(TOPICS_DIR, 'dictionary.gensim')
 MODEL_FILE = os.path.join(TOPICS_DIR, 'model5.gensim')
+VOCABULARY_FILE = os.path.join(TOPICS_DIR, 'vocabulary.json')
+CHECKPOINT_DIR = os.path.join(TOPICS_DIR, 'checkpoints')
+CHECKPOINT_FILE = os.path.join(CHECKPOINT_DIR, 'checkpoint.json')
 
 NUM_TOPICS = 100
 
-STOPWORDS = set(nltk.corpus.stopwords.words('english'))
+# Defaults for pruning the vocabulary, these are the same as the defaults for
+# gensim.corpora.Dictionary.filter_extremes().
+NO_BELOW = 5
+NO_ABOVE = 0.5
+KEEP_N = 100000
+
+# especially the first two occur  in most abstracts so let's ignore them
+WORDS_TO_IGNORE = {'title', 'abstract', 'result', 'study'}
+
+# Defaults for training
+PASSES = 15
+MIN_IMPROVEMENT = 0.001
+HELDOUT = 0.0
+
+# loaded from nltk on first use, see stopwords()
+STOPWORDS = None
 
 
 @time_elapsed
-def build_model(data_dir, filelist, start, end):
+def build_model(data_dir, filelist, start, end, no_below=NO_BELOW,
+                no_above=NO_ABOVE, keep_n=KEEP_N, hashed=False, passes=PASSES,
+                min_improvement=MIN_IMPROVEMENT, heldout=HELDOUT, resume=False,
+                shard=None):
     """Build a model from scratch using the files as specified in the arguments."""
+    import gensim
+    if resume and os.path.exists(CHECKPOINT_FILE):
+        print("\nLoading dictionary and corpus from disk")
+        dictionary = gensim.utils.SaveLoad.load(DICTIONARY_FILE)
+        with open(CORPUS_FILE, 'rb') as fh:
+            corpus = pickle.load(fh)
+        _train_and_save(corpus, dictionary, passes, min_improvement, heldout, resume)
+        return
     print("\nCollecting data")
-    text_data = _collect_data(data_dir, filelist, start, end)
+    text_data = _collect_data(data_dir, filelist, start, end, shard)
     print("\nLoading text data into dictionary")
-    dictionary = gensim.corpora.Dictionary(text_data)
-    print("\nCreating bag-of-words corpus")
-    corpus = [dictionary.doc2bow(text) for text in text_data]
+    dictionary, corpus, stats = build_vocabulary(
+        text_data, no_below, no_above, keep_n, hashed)
     print(dictionary)
-    print("\nCreating LDA model")
-    ldamodel = gensim.models.ldamodel.LdaModel(corpus, num_topics=NUM_TOPICS,
-                                               id2word=dictionary, passes=15)
-    print("\nSaving dictionary, corpus and LDA model to disk\n")
-    pickle.dump(corpus, open(CORPUS_FILE, 'wb'))
+    print_vocabulary_statistics(stats)
+    with open(VOCABULARY_FILE, 'w') as fh:
+        json.dump(stats, fh, sort_keys=True, indent=4)
+    print("\nSaving dictionary and corpus to disk")
+    with open(CORPUS_FILE, 'wb') as fh:
+        pickle.dump(corpus, fh)
     dictionary.save(DICTIONARY_FILE)
+    _train_and_save(corpus, dictionary, passes, min_improvement, heldout, False)
+
+
+def _train_and_save(corpus, dictionary, passes, min_improvement, heldout, resume):
+    print("\nCreating LDA model")
+    ldamodel = train_model(corpus, dictionary, passes, min_improvement, heldout, resume)
+    print("\nSaving LDA model to disk\n")
     ldamodel.save(MODEL_FILE)
 
 
-def _collect_data(data_dir, filelist, start, end):
+def train_model(corpus, dictionary, passes=PASSES, min_improvement=MIN_IMPROVEMENT,
+                heldout=HELDOUT, resume=False):
+    """Train an LDA model, saving a checkpoint after each pass and stopping early
+    when the perplexity on the held-out documents improves by less than
+    min_improvement (as a fraction of the previous perplexity). With heldout=0
+    all documents are used for training and the perplexity is computed on them.
+
+    All passes are run by one call of LdaModel.update(), with a callback that
+    does the checkpointing and the stopping after each pass, because gensim
+    computes the learning rate from the pass number within a call and only
+    counts the documents of the first pass of a call. Running one pass per call
+    would give another learning rate schedule than LdaModel(corpus, passes=N).
+    A resumed run starts a new call with the number of finished passes added to
+    the offset, which is close to but not exactly the uninterrupted schedule."""
+    import gensim
+    train_corpus, heldout_corpus = _split_corpus(corpus, heldout)
+    print("Training on %d documents, %d held out"
+          % (len(train_corpus), len(heldout_corpus)))
+    if not heldout_corpus:
+        heldout_corpus = train_corpus
+    checkpoint = {'pass': 0, 'model': None, 'history': []}
+    offset = None
+    if resume and os.path.exists(CHECKPOINT_FILE):
+        with open(CHECKPOINT_FILE) as fh:
+            checkpoint = json.load(fh)
+        print("Resuming after pass %d" % checkpoint['pass'])
+        ldamodel = gensim.models.ldamodel.LdaModel.load(checkpoint['model'])
+        offset = ldamodel.offset + checkpoint['pass']
+    else:
+        _remove_checkpoints()
+        ldamodel = gensim.models.ldamodel.LdaModel(num_topics=NUM_TOPICS,
+                                                   id2word=dictionary)
+    history = checkpoint['history']
+    if _converged(history, min_improvement) or checkpoint['pass'] >= passes:
+        return ldamodel
+    ldamodel.callbacks = [_PassCallback(heldout_corpus, checkpoint['pass'], history,
+                                       min_improvement)]
+    try:
+        ldamodel.update(train_corpus, passes=passes - checkpoint['pass'], offset=offset)
+    except _StopTraining:
+        print("Perplexity improved less than %s, stopping" % min_improvement)
+    finally:
+        # the callback has the held-out corpus, which should not be saved
+        ldamodel.callbacks = None
+    return ldamodel
+
+
+class _StopTraining(Exception):
+    pass
+
+
+class _PassCallback(object):
+
+    """Used as a gensim callback metric, which is called at the end of each pass.
+    Computes the held-out perplexity, saves a checkpoint and raises _StopTraining
+    when the perplexity no longer improves enough."""
+
+    # looked at by gensim.models.callbacks.Callback
+    logger = None
+
+    def __init__(self, heldout_corpus, pass_number, history, min_improvement):
+        self.heldout_corpus = heldout_corpus
+        self.pass_number = pass_number
+        self.history = history
+        self.min_improvement = min_improvement
+
+    def __str__(self):
+        return 'PassCallback'
+
+    def get_value(self, model=None, **kwargs):
+        self.pass_number += 1
+        bound = model.log_perplexity(self.heldout_corpus)
+        self.history.append({'pass': self.pass_number, 'bound': bound, 'perplexity': 2 ** -bound})
+        print("    pass %3d  bound %.4f  perplexity %.2f"
+              % (self.pass_number, bound, 2 ** -bound))
+        _save_checkpoint(model, self.pass_number, self.history)
+        if _converged(self.history, self.min_improvement):
+            raise _StopTraining()
+        return bound
+
+
+def _split_corpus(corpus, heldout):
+    """Split the corpus in a training and a held-out part. This is deterministic so
+    the split is the same when training is resumed."""
+    if heldout <= 0:
+        return corpus, []
+    step = max(2, int(round(1 / heldout)))
+    train_corpus = [bow for i, bow in enumerate(corpus) if i % step != 0]
+    heldout_corpus = [bow for i, bow in enumerate(corpus) if i % step == 0]
+    return train_corpus, heldout_corpus
+
+
+def _converged(history, min_improvement):
+    if len(history) < 2:
+        return False
+    previous, current = history[-2]['perplexity'], history[-1]['perplexity']
+    return (previous - current) / previous < min_improvement
+
+
+def _remove_checkpoints():
+    if os.path.exists(CHECKPOINT_DIR):
+        for fname in os.listdir(CHECKPOINT_DIR):
+            if fname.startswith('model-pass-') or fname == os.path.basename(CHECKPOINT_FILE):
+                os.remove(os.path.join(CHECKPOINT_DIR, fname))
+
+
+def _save_checkpoint(ldamodel, pass_number, history):
+    """Save the model for this pass and then point checkpoint.json at it, the
+    model of the pass before that is removed once the new one is in place."""
+    ensure_directory(CHECKPOINT_FILE)
+    model_file = os.path.join(CHECKPOINT_DIR, 'model-pass-%03d.gensim' % pass_number)
+    # during training the callbacks have the held-out corpus
+    ldamodel.save(model_file, ignore=('callbacks',))
+    checkpoint = {'pass': pass_number, 'model': model_file, 'history': history}
+    with open(CHECKPOINT_FILE + '.tmp', 'w') as fh:
+        json.dump(checkpoint, fh, indent=4)
+    os.replace(CHECKPOINT_FILE + '.tmp', CHECKPOINT_FILE)
+    previous = 'model-pass-%03d.gensim' % (pass_number - 1)
+    for fname in os.listdir(CHECKPOINT_DIR):
+        if fname.startswith(previous):
+            os.remove(os.path.join(CHECKPOINT_DIR, fname))
+
+
+def build_vocabulary(text_data, no_below=NO_BELOW, no_above=NO_ABOVE,
+                     keep_n=KEEP_N, hashed=False):
+    """Create a dictionary from the text data, prune it, and return the dictionary,
+    the bag-of-words corpus and a dictionary with statistics. Words are pruned if
+    they are in less than no_below documents or in more than a fraction no_above
+    of all documents, after that only the keep_n most frequent words are kept.
+
+    With hashed=True a HashDictionary with keep_n buckets is used. Its size does
+    not depend on the vocabulary, pruning is done on the buckets and each
+    bucket is labeled with the first word that was hashed into it. This only
+    bounds the dictionary, the text data and the corpus are kept in memory as
+    with a regular dictionary."""
+    import gensim
+    if hashed:
+        dictionary = gensim.corpora.HashDictionary(id_range=keep_n, debug=False)
+        corpus = [dictionary.doc2bow(text, allow_update=True) for text in text_data]
+        # without debug=True the hash dictionary does not count document
+        # frequencies, so they are counted here with one counter per bucket
+        for bow in corpus:
+            for bucket, _ in bow:
+                dictionary.dfs[bucket] = dictionary.dfs.get(bucket, 0) + 1
+        stats = _vocabulary_statistics(dictionary)
+        removed = _filter_buckets(dictionary, no_below, no_above)
+        corpus = [[(i, c) for i, c in bow if i not in removed] for bow in corpus]
+        for text in text_data:
+            for token in text:
+                dictionary.id2token.setdefault(dictionary.restricted_hash(token), token)
+    else:
+        dictionary = gensim.corpora.Dictionary(text_data)
+        stats = _vocabulary_statistics(dictionary)
+        dictionary.filter_extremes(no_below=no_below, no_above=no_above, keep_n=keep_n)
+        corpus = [dictionary.doc2bow(text) for text in text_data]
+    stats['pruned'] = _vocabulary_statistics(dictionary, corpus)
+    stats['pruned']['vocabulary_size'] = len(dictionary.dfs)
+    stats['settings'] = {'no_below': no_below, 'no_above': no_above,
+                         'keep_n': keep_n, 'hashed': hashed}
+    # LdaModel keeps two float32 topics x terms matrices (sstats and expElogbeta)
+    stats['model_bytes'] = 2 * 4 * NUM_TOPICS * len(dictionary)
+    return dictionary, corpus, stats
+
+
+def _filter_buckets(dictionary, no_below, no_above):
+    """Remove buckets from a HashDictionary that are too rare or too frequent and
+    return the set of removed bucket identifiers."""
+    no_above_abs = int(no_above * dictionary.num_docs)
+    removed = {bucket for bucket, df in dictionary.dfs.items()
+               if df < no_below or df > no_above_abs}
+    for bucket in removed:
+        del dictionary.dfs[bucket]
+    return removed
+
+
+def _vocabulary_statistics(dictionary, corpus=None):
+    if corpus is None:
+        tokens = dictionary.num_pos
+    else:
+        tokens = sum(count for bow in corpus for _, count in bow)
+    dfs = sorted(dictionary.dfs.values())
+    return {'documents': dictionary.num_docs,
+            'tokens': tokens,
+            'vocabulary_size': len(dfs),
+            'singletons': sum(1 for df in dfs if df == 1),
+            'median_df': dfs[len(dfs) // 2] if dfs else 0}
+
+
+def print_vocabulary_statistics(stats):
+    full, pruned = stats, stats['pruned']
+    print("\nVocabulary statistics\n")
+    print("    documents          %12d" % full['documents'])
+    print("    tokens             %12d  ->  %12d  (%.1f%% kept)"
+          % (full['tokens'], pruned['tokens'],
+             100.0 * pruned['tokens'] / max(1, full['tokens'])))
+    print("    vocabulary size    %12d  ->  %12d"
+          % (full['vocabulary_size'], pruned['vocabulary_size']))
+    print("    singletons         %12d  ->  %12d"
+          % (full['singletons'], pruned['singletons']))
+    print("    model size (MB)    %12.1f" % (stats['model_bytes'] / 1024 / 1024))
+
+
+def _collect_data(data_dir, filelist, start, end, shard=None):
     all_data = []
-    # especially the first two occur  in most abstracts so let's ignore them
-    words_to_ignore = {'title', 'abstract', 'result', 'study'}
-    for n, fname in elements(filelist, start, end):
-        print("    %07d  %s" % (n, fname))
-        fpath = os.path.join(data_dir, 'lif', fname[:-5] + '.lif')
+    words_to_ignore = WORDS_TO_IGNORE
+    progress = Progress(estimate_total(filelist, start, end, shard))
+    for n, fname in elements(filelist, start, end, shard):
+        progress.update()
+        fpath = existing_file(os.path.join(data_dir, 'lif', fname[:-5] + '.lif'))
         lif = Container(fpath).payload
         text_data = prepare_text_for_lda(lif.text.value)
         text_data = [w for w in text_data if w not in words_to_ignore]
         all_data.append(text_data)
+    progress.finish()
     token_count = sum([len(d) for d in all_data])
     print('\nToken count = %d' % token_count)
     return all_data
@@ -92,59 +386,203 @@ def print_model(lda=None):
 
 
 def load_model():
+    import gensim
     return gensim.models.ldamodel.LdaModel.load(MODEL_FILE)
 
 
 def load_dictionary():
-    return gensim.corpora.Dictionary.load(DICTIONARY_FILE)
+    import gensim
+    # this may also be a HashDictionary, so use the generic loader
+    return gensim.utils.SaveLoad.load(DICTIONARY_FILE)
+
+
+def load_topic_index(lda):
+    """Return a dictionary of topic names indexed on topic identifiers."""
+    return {topic_id: topic for topic_id, topic
+            in lda.print_topics(num_topics=NUM_TOPICS)}
 
 
 @time_elapsed
-def generate_topics(data_dir, filelist, start, end, crash=False):
+def generate_topics(data_dir, filelist, start, end, crash=False, shard=None,
+                    jobs=1, costs=None, metrics=None, record_costs=None,
+                    profiler=None, profile_out='profile-topics', vectors_name=None,
+                    prefetch=PREFETCH, readers=READERS, writers=WRITERS, compress=None,
+                    pool=None):
+    """Add topics to the LIF files in a range of the file list. A pool from
+    worker_pool() can be handed in to reuse the workers, and the model loaded in
+    them, over several calls, otherwise a pool with jobs workers is created."""
+    # this loads numpy
+    from topic_vectors import TopicVectorWriter
+    vectors = TopicVectorWriter(data_dir, start, end, NUM_TOPICS, shard, vectors_name)
+    items = elements(filelist, start, end, shard)
+    total = estimate_total(filelist, start, end, shard)
+    if jobs > 1:
+        items = schedule_items(items, filelist, costs,
+                               lambda fname: existing_file(os.path.join(data_dir, 'lif', fname[:-5] + '.lif')))
+        total = len(items)
+    monitor = Monitor('topics', total, metrics, record_costs,
+                      profile=collector(profiler, profile_out))
+    inputs = Prefetcher(items, functools.partial(read_lif_file, data_dir),
+                        prefetch, readers, jobs)
+    writer = BackgroundWriter(writers, compression=compress)
+    fun = functools.partial(generate_topics_for_item, data_dir, crash, profiler)
+    for record in run_jobs(fun, inputs, jobs, initializer=_load_resources, pool=pool):
+        inputs.done()
+        writer.write_all(record.pop('outputs', ()))
+        monitor.add(record)
+        if record['error'] is None:
+            vectors.add(record['fname'], record['topics'])
+    vectors.close()
+    monitor.errors += len(writer.close())
+    print(monitor.finish().summary())
+    return monitor
+
+
+# model, topic index and dictionary, loaded once in each worker process
+_RESOURCES = None
+
+
+def _load_resources():
+    global _RESOURCES
+    if _RESOURCES is not None:
+        return
     lda = load_model()
-    topic_idx = {topic_id: topic for topic_id, topic
-                 in lda.print_topics(num_topics=NUM_TOPICS)}
-    dictionary = load_dictionary()
-    for n, fname in elements(filelist, start, end):
-        print("%07d  %s" % (n, fname))
-        if crash:
-            generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary)
-        else:
-            try:
-                generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary)
-            except Exception as e:
-                print('ERROR:', Exception, e)
-                sys.stderr.write("ERROR on %07d  %s\n" % (n, fname))
-
-
-def generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary):
-    topic_id = 0
+    _RESOURCES = (lda, load_topic_index(lda), load_dictionary())
+    # nltk loads its data on first use
+    prepare_text_for_lda("Loading tokenizers and wordnet")
+
+
+def worker_pool(jobs):
+    """Return a pool of jobs worker processes that have loaded the model, for
+    generate_topics() calls on several ranges. With one job the model is loaded
+    in this process and None is returned."""
+    if jobs <= 1:
+        _load_resources()
+        return None
+    return multiprocessing.Pool(jobs, _load_resources)
+
+
+def read_lif_file(data_dir, item):
+    n, fname = item
+    with open_file(existing_file(os.path.join(data_dir, 'lif', fname[:-5] + '.lif'))) as fh:
+        return fh.read()
+
+
+def generate_topics_for_item(data_dir, crash, profiler, task):
+    """Generate topics for an item from a Prefetcher, which has the (n, fname)
+    pair from the file list and the LIF string read by read_lif_file(). Returns
+    the record of the DocTimer with the topics added and the topics file to be
+    written in the outputs, see instrument.py."""
+    (n, fname), json_string, read_time = task
+    timer = DocTimer(fname)
+    timer.stages['read'] = read_time
+    if crash:
+        return _generate_topics_record(data_dir, fname, json_string, profiler, timer)
+    try:
+        return _generate_topics_record(data_dir, fname, json_string, profiler, timer)
+    except Exception as e:
+        print('ERROR:', Exception, e)
+        sys.stderr.write("\nERROR on %07d  %s\n" % (n, fname))
+        return timer.record(error=str(e))
+
+
+def _generate_topics_record(data_dir, fname, json_string, profiler, timer):
+    if isinstance(json_string, Exception):
+        raise json_string
+    lda, topic_idx, dictionary = _RESOURCES
+    fname_out = os.path.join(data_dir, 'top', fname[:-5] + '.lif')
+    with session(profiler, fname) as profile:
+        topics, s = topics_for_string(json_string, lda, topic_idx, dictionary, timer)
+    return timer.record(topics=topics, profile=profile.result, outputs=[(fname_out, s)])
+
+
+def generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary, timer=None):
+    timer = DocTimer() if timer is None else timer
     fname_in = os.path.join(data_dir, 'lif', fname[:-5] + '.lif')
     fname_out = os.path.join(data_dir, 'top', fname[:-5] + '.lif')
-    ensure_directory(fname_out)
-    lif_in = Container(fname_in).payload
+    with timer.stage('read'), open_file(existing_file(fname_in)) as fh:
+        json_string = fh.read()
+    all_topics, s = topics_for_string(json_string, lda, topic_idx, dictionary, timer)
+    with timer.stage('write'):
+        write_file(fname_out, s)
+    return all_topics
+
+
+def topics_for_string(json_string, lda, topic_idx, dictionary, timer=None):
+    """Return the full topic distribution for a LIF string and the string of the
+    LIF object with the topics view."""
+    timer = DocTimer() if timer is None else timer
+    with timer.stage('parse'):
+        lif_in = Container(json_string=json_string).payload
+    with timer.stage('extract'):
+        doc = prepare_text_for_lda(lif_in.text.value)
+        bow = dictionary.doc2bow(doc)
+    with timer.stage('infer'):
+        # get the full distribution for the topic vectors, but only add the
+        # topics that get_document_topics() would return by default to the LIF
+        all_topics = lda.get_document_topics(bow, minimum_probability=0.0)
+        topics = [t for t in all_topics if t[1] >= lda.minimum_probability]
+    with timer.stage('serialize'):
+        lif_out = create_topics_lif(lif_in, topics, topic_idx)
+        s = lif_out.as_string(pretty=True)
+    timer.bytes_in += len(json_string)
+    timer.bytes_out += len(s)
+    return all_topics, s
+
+
+def create_topics_lif(lif_in, topics, topic_idx):
+    """Return a copy of lif_in with all metadata and views replaced by a view with
+    the topics, which is a list of pairs of topic identifiers and scores."""
     lif_out = LIF(json_object=lif_in.as_json())
     # just to save some space, we get them from the lif file anyway
     lif_out.metadata = {}
+    lif_out.views = [create_topics_view(lif_in, topics, topic_idx)]
+    return lif_out
+
+
+def create_topics_view(lif_in, topics, topic_idx):
     topics_view = _create_view()
-    lif_out.views = [topics_view]
     topics_view.annotations.append(markable_annotation(lif_in))
-    doc = prepare_text_for_lda(lif_in.text.value)
-    bow = dictionary.doc2bow(doc)
-    for topic in lda.get_document_topics(bow):
-        topic_id += 1
+    for topic_id, topic in enumerate(topics, start=1):
         # these are tuples of topic_id and score
         lemmas = get_lemmas_from_topic_name(topic_idx.get(topic[0]))
         # print('   %3d  %.04f  %s' % (topic[0], topic[1], lemmas))
         topics_view.annotations.append(
             topic_annotation(topic, topic_id, lemmas))
-    lif_out.write(fname=fname_out, pretty=True)
+    return topics_view
+
+
+def get_batch_topics(bows, lda):
+    """Run inference on a list of bags of words in one go and return a list of
+    topics for each of them, filtered like LdaModel.get_document_topics()
+    does. This is quite a bit faster than running get_document_topics() on each
+    bag of words separately."""
+    gamma, _ = lda.inference(bows)
+    minimum_probability = max(lda.minimum_probability, 1e-8)
+    batch_topics = []
+    for doc_gamma in gamma:
+        topic_dist = doc_gamma / doc_gamma.sum()
+        batch_topics.append([(topic_id, float(score))
+                             for topic_id, score in enumerate(topic_dist)
+                             if score >= minimum_probability])
+    return batch_topics
 
 
 def prepare_text_for_lda(text):
+    from nltk import word_tokenize
+    stop_words = stopwords()
     tokens = word_tokenize(text)
     return [get_lemma(tok.lower()) for tok in tokens
-            if len(tok) > 4 and tok not in STOPWORDS]
+            if len(tok) > 4 and tok not in stop_words]
+
+
+def stopwords():
+    """Return the set of English stopwords, they are loaded on the first call."""
+    global STOPWORDS
+    if STOPWORDS is None:
+        import nltk
+        STOPWORDS = set(nltk.corpus.stopwords.words('english'))
+    return STOPWORDS
 
 
 def markable_annotation(lif_obj):
@@ -166,6 +604,7 @@ def topic_annotation(topic, topic_id, lemmas):
 
 
 def get_lemma(word):
+    from nltk.corpus import wordnet as wn
     lemma = wn.morphy(word)
     return word if lemma is None else lemma
 
@@ -197,16 +636,30 @@ def usage():
           + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST"
           + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST -s START -e END"
           + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --crash"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --shard I/N"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --jobs J [--costs FILE]"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --metrics FILE [--record-costs FILE]"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --profile FRACTION"
+          + "\n          [--profiler (sample|cprofile)] [--profile-out PREFIX]"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST [--prefetch K] [--readers R] [--writers W]"
+          + "\n          [--compress (gz|zst)]"
           + "\n    $ python3 generate_topics.py --build -d DATA_DIR -f FILELIST -s START -e END"
+          + "\n          [--no-below N] [--no-above F] [--keep-n N] [--hashed]"
+          + "\n          [--passes N] [--min-improvement F] [--heldout F] [--resume]"
           + "\n    $ python3 generate_topics.py (-h | --help)\n")
 
 
-if __name__ == '__main__':
-
+def main(args):
     data_dir = '/DATA/eager/sample-01000'
     filelist = '../../data/files-random-01000.txt'
 
-    options = dict(getopt.getopt(sys.argv[1:], 'd:f:s:e:bh', ['crash', 'help', 'build'])[0])
+    options = dict(getopt.getopt(
+        args, 'd:f:s:e:bh',
+        ['crash', 'help', 'build', 'no-below=', 'no-above=', 'keep-n=', 'hashed',
+         'passes=', 'min-improvement=', 'heldout=', 'resume', 'shard=',
+         'jobs=', 'costs=', 'metrics=', 'record-costs=',
+         'profile=', 'profiler=', 'profile-out=', 'prefetch=', 'readers=',
+         'writers=', 'compress='])[0])
     data_dir = options.get('-d', data_dir)
     filelist = options.get('-f', filelist)
     start = int(options.get('-s', 1))
@@ -214,11 +667,36 @@ if __name__ == '__main__':
     crash = True if '--crash' in options else False
     help_wanted = True if '-h' in options or '--help' in options else False
     build = True if '-b' in options or '--build' in options else False
+    shard = parse_shard(options['--shard']) if '--shard' in options else None
+    jobs = int(options.get('--jobs', 1))
 
     if help_wanted:
         usage()
     elif build:
-        build_model(data_dir, filelist, start, end)
+        build_model(data_dir, filelist, start, end,
+                    no_below=int(options.get('--no-below', NO_BELOW)),
+                    no_above=float(options.get('--no-above', NO_ABOVE)),
+                    keep_n=int(options.get('--keep-n', KEEP_N)),
+                    hashed='--hashed' in options,
+                    passes=int(options.get('--passes', PASSES)),
+                    min_improvement=float(options.get('--min-improvement', MIN_IMPROVEMENT)),
+                    heldout=float(options.get('--heldout', HELDOUT)),
+                    resume='--resume' in options,
+                    shard=shard)
         print_model()
     else:
-        generate_topics(data_dir, filelist, start, end, crash=crash)
+        generate_topics(data_dir, filelist, start, end, crash=crash, shard=shard,
+                        jobs=jobs, costs=options.get('--costs'),
+                        metrics=options.get('--metrics'),
+                        record_costs=options.get('--record-costs'),
+                        profiler=profiler_from_options(options),
+                        profile_out=options.get('--profile-out', 'profile-topics'),
+                        prefetch=int(options.get('--prefetch', PREFETCH)),
+                        readers=int(options.get('--readers', READERS)),
+                        writers=int(options.get('--writers', WRITERS)),
+                        compress=options.get('--compress'))
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
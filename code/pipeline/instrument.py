@@ -0,0 +1,300 @@
+"""instrument.py
+
+Performance instrumentation for the pipeline scripts.
+
+Each document is processed with a DocTimer that records how long each stage of
+the processing takes (for example parse, extract, serialize and write) and how
+many bytes were read and written. The record of each document is handed to a
+Monitor in the main process, which keeps
+
+- a histogram of the time per document for each stage
+- totals for documents, errors, skipped documents, bytes in and bytes out
+- the slowest documents
+- the throughput and the peak resident memory of this process and its workers,
+  the latter is measured in the workers and handed in with the records
+
+and prints a progress line with an estimate of the remaining time to standard
+error, at most once every few seconds, instead of printing a line for each file.
+
+The pipeline scripts have two options that use this:
+
+--metrics FILE   write the metrics to FILE when done, in the Prometheus textfile
+                 format if FILE ends in .prom and as JSON otherwise
+--record-costs FILE
+                 write the time spent on each document to FILE, this can be
+                 handed to the --costs option, see schedule.py
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import heapq
+import resource
+from contextlib import contextmanager
+
+from utils import count_lines
+
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+SLOWEST = 20
+
+PROGRESS_INTERVAL = 2.0
+
+
+class DocTimer(object):
+
+    """Records the time spent in each stage of processing one document."""
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t0
+
+    def record(self, error=None, **kwargs):
+        """Return the timing information as a dictionary, other information can be
+        added with keyword arguments."""
+        record = {'fname': self.fname, 'stages': self.stages,
+                  'total': time.perf_counter() - self.t0,
+                  'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                  'error': error, 'pid': os.getpid(), 'peak_rss': peak_rss()}
+        record.update(kwargs)
+        return record
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket that has the q-th quantile."""
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return BUCKETS[-1]
+
+    def as_json(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': {str(bound): count for bound, count in zip(BUCKETS, self.counts)}}
+
+
+class Progress(object):
+
+    """Prints a rate-limited progress line with throughput and remaining time."""
+
+    def __init__(self, total=None, interval=PROGRESS_INTERVAL, stream=sys.stderr):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.t0 = time.time()
+        self.last = 0.0
+        self.done = 0
+        self.errors = 0
+
+    def update(self, done=None, errors=None, force=False):
+        self.done = self.done + 1 if done is None else done
+        if errors is not None:
+            self.errors = errors
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.t0
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        line = "%9d" % self.done
+        if self.total:
+            line += "/%d  %5.1f%%" % (self.total, 100.0 * self.done / self.total)
+        line += "  %8.1f docs/s  errors %d" % (rate, self.errors)
+        if self.total and rate > 0:
+            line += "  ETA %s" % _format_seconds((self.total - self.done) / rate)
+        self.stream.write("\r" + line + "   ")
+        self.stream.flush()
+
+    def finish(self):
+        self.update(self.done, force=True)
+        self.stream.write("\n")
+
+
+def _format_seconds(seconds):
+    seconds = max(0, int(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def estimate_total(filelist, start, end, shard=None):
+    """Estimate the number of documents in a range of a file list."""
+    total = max(0, min(end, count_lines(filelist)) - max(start, 1) + 1)
+    if shard is not None:
+        total = (total + shard[2] - 1) // shard[2]
+    return total
+
+
+class Monitor(object):
+
+    """Collects the records of all documents processed in a run."""
+
+    def __init__(self, name, total=None, metrics_file=None, costs_file=None,
+                 slowest=SLOWEST, profile=None):
+        self.name = name
+        # a profiling.Collector for records that have a profile
+        self.profile = profile
+        self.metrics_file = metrics_file
+        self.costs_fh = open(costs_file, 'w') if costs_file is not None else None
+        self.progress = Progress(total)
+        self.histograms = {}
+        self.documents = 0
+        self.errors = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.slowest_n = slowest
+        self.slowest = []
+        # peak resident memory of each worker process, from their records
+        self.worker_rss = {}
+        self.t0 = time.time()
+        self.elapsed = 0.0
+
+    def add(self, record):
+        self.documents += 1
+        if record.get('pid', os.getpid()) != os.getpid():
+            self.worker_rss[record['pid']] = max(self.worker_rss.get(record['pid'], 0),
+                                                 record['peak_rss'])
+        if record.get('error') is not None:
+            self.errors += 1
+        elif record.get('skipped'):
+            self.skipped += 1
+        else:
+            for stage, seconds in record['stages'].items():
+                self.histograms.setdefault(stage, Histogram()).add(seconds)
+            self.histograms.setdefault('document', Histogram()).add(record['total'])
+            self.bytes_in += record['bytes_in']
+            self.bytes_out += record['bytes_out']
+            item = (record['total'], record['fname'])
+            if len(self.slowest) < self.slowest_n:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+            if self.costs_fh is not None:
+                self.costs_fh.write("%s\t%.6f\n" % (record['fname'], record['total']))
+            if self.profile is not None and record.get('profile') is not None:
+                self.profile.add(record['profile'])
+        self.progress.update(self.documents, self.errors)
+
+    def finish(self):
+        self.elapsed = time.time() - self.t0
+        self.progress.finish()
+        if self.costs_fh is not None:
+            self.costs_fh.close()
+        if self.metrics_file is not None:
+            write_metrics(self.as_json(), self.metrics_file)
+        if self.profile is not None:
+            self.profile.write()
+        return self
+
+    def as_json(self):
+        elapsed = self.elapsed or time.time() - self.t0
+        return {'pipeline': self.name,
+                'documents': self.documents,
+                'errors': self.errors,
+                'skipped': self.skipped,
+                'elapsed': elapsed,
+                'throughput': self.documents / elapsed if elapsed > 0 else 0.0,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'peak_rss': peak_rss(),
+                'peak_rss_workers': max(self.worker_rss.values(), default=0),
+                'stages': {stage: h.as_json() for stage, h in self.histograms.items()},
+                'slowest': [{'fname': fname, 'seconds': seconds}
+                            for seconds, fname in sorted(self.slowest, reverse=True)]}
+
+    def summary(self):
+        """Return a short text summary, with the mean time for each stage."""
+        lines = ["%d documents, %d errors, %d skipped, %.1f docs/s"
+                 % (self.documents, self.errors, self.skipped, self.as_json()['throughput'])]
+        for stage, h in sorted(self.histograms.items()):
+            lines.append("    %-12s mean %8.4fs  max %8.4fs"
+                         % (stage, h.sum / max(1, h.count), h.max))
+        return "\n".join(lines)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def write_metrics(metrics, fname):
+    """Write the metrics as JSON or, if fname ends in .prom, in the Prometheus
+    textfile format. The file is replaced atomically so that a collector never
+    sees a half-written file."""
+    if fname.endswith('.prom'):
+        s = prometheus_text(metrics)
+    else:
+        s = json.dumps(metrics, indent=4) + "\n"
+    tmp_file = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp_file, 'w') as fh:
+        fh.write(s)
+    os.replace(tmp_file, fname)
+
+
+def prometheus_text(metrics):
+    label = 'pipeline="%s"' % metrics['pipeline']
+    lines = [
+        "# HELP eager_elk_stage_seconds Time spent on a document in each stage.",
+        "# TYPE eager_elk_stage_seconds histogram"]
+    for stage, h in sorted(metrics['stages'].items()):
+        labels = '%s,stage="%s"' % (label, stage)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, [h['buckets'][str(b)] for b in BUCKETS]):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('eager_elk_stage_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+        lines.append('eager_elk_stage_seconds_sum{%s} %f' % (labels, h['sum']))
+        lines.append('eager_elk_stage_seconds_count{%s} %d' % (labels, h['count']))
+    for name, key, kind, help_text in (
+            ('documents_total', 'documents', 'counter', 'Documents processed.'),
+            ('errors_total', 'errors', 'counter', 'Documents that failed.'),
+            ('skipped_total', 'skipped', 'counter', 'Documents skipped because of their size.'),
+            ('bytes_in_total', 'bytes_in', 'counter', 'Bytes read.'),
+            ('bytes_out_total', 'bytes_out', 'counter', 'Bytes written.'),
+            ('elapsed_seconds', 'elapsed', 'gauge', 'Wall clock time of the run.'),
+            ('throughput_documents_per_second', 'throughput', 'gauge', 'Documents per second.'),
+            ('peak_rss_bytes', 'peak_rss', 'gauge', 'Peak resident memory of the main process.'),
+            ('peak_rss_workers_bytes', 'peak_rss_workers', 'gauge',
+             'Peak resident memory of the largest worker process.')):
+        lines.append("# HELP eager_elk_%s %s" % (name, help_text))
+        lines.append("# TYPE eager_elk_%s %s" % (name, kind))
+        lines.append("eager_elk_%s{%s} %s" % (name, label, metrics[key]))
+    return "\n".join(lines) + "\n"
@@ -29,13 +29,17 @@ $ python lif.py --lif INFILE OUTFILE
 
 Example input files are in ../data/in/lif.
 
+Files with a .gz or .zst extension are read and written compressed, see
+utils.open_file().
+
 """
 
 import os
 import sys
 import codecs
 import json
-import subprocess
+
+from utils import open_file
 
 #from past.builtins import xrange
 
@@ -47,7 +51,8 @@ class LappsObject(object):
         self.json_file = json_string
         self.json_object = json_object
         if json_file is not None:
-            self.json_string = codecs.open(json_file).read()
+            with open_file(json_file) as fh:
+                self.json_string = fh.read()
             self.json_object = json.loads(self.json_string)
         elif json_string is not None:
             self.json_string = json_string
@@ -57,14 +62,22 @@ class LappsObject(object):
             self.json_object = json_object
 
     def write(self, fname=None, pretty=False):
+        s = self.as_string(pretty)
+        if fname is None:
+            sys.stdout.write(s)
+        else:
+            with open_file(fname, 'w') as fh:
+                fh.write(s)
+
+    def as_string(self, pretty=False):
+        """Return the string that write() writes."""
         # first update the json object for those case where it has been changed
         json_obj = self.as_json()
         if pretty:
             s = json.dumps(json_obj, sort_keys=True, indent=4, separators=(',', ': '))
         else:
             s = json.dumps(json_obj)
-        fh = sys.stdout if fname is None else codecs.open(fname, 'w')
-        fh.write(s + "\n")
+        return s + "\n"
 
 
 class Container(LappsObject):
@@ -266,6 +279,8 @@ def compare(file1, file2):
     """Output file could have a very different ordering of json properties, so
     compare by taking all the lines, normalizing them (stripping space and commas)
     and sorting them."""
+    # only needed here, so not imported when the module is loaded
+    import subprocess
     lines1 = sorted(codecs.open(file1).readlines())
     lines2 = sorted(codecs.open(file2).readlines())
     with codecs.open("comp1", 'w') as c1, codecs.open("comp2", 'w') as c2:
@@ -0,0 +1,243 @@
+"""profiling.py
+
+Profile a random subset of the documents processed by a pipeline script.
+
+The pipeline scripts have these options:
+
+--profile FRACTION   profile a random FRACTION of the documents (for example 0.01,
+                     or 1 to profile all of them), the same documents are picked
+                     on every run so runs can be compared
+--profiler NAME      either sample (the default) or cprofile
+--profile-out PREFIX write the results to PREFIX.pstats and PREFIX.collapsed, the
+                     default prefix is profile-NAME where NAME is the stage
+
+The sample profiler runs a thread that looks at the stack of the thread that is
+processing the document every few milliseconds, which hardly slows down the
+processing. Since the sampling thread needs the global interpreter lock to take
+a sample, code that releases the lock (for example while reading or writing
+files) tends to get more than its share of the samples. The cprofile profiler
+uses cProfile, which gives exact call counts but makes function calls quite a
+bit slower. With cprofile the sampler runs as well, since cProfile does not
+record full stacks.
+
+The profiles of all documents, from all worker processes, are added up in the
+main process. PREFIX.pstats can be read with the pstats module or with tools like
+snakeviz, with the sample profiler the call counts in it are sample counts.
+PREFIX.collapsed has one line per stack with the number of samples, this is the
+input format of flamegraph.pl and speedscope.
+
+"""
+
+
+import os
+import sys
+import zlib
+import threading
+import collections
+
+
+PROFILERS = ('sample', 'cprofile')
+
+# seconds between samples
+INTERVAL = 0.005
+
+# seed for picking documents, so that the same ones are picked on each run
+SEED = 0
+
+
+class Profiler(object):
+
+    """Decides which documents are profiled and how, this is handed to the
+    workers so it should stay picklable."""
+
+    def __init__(self, fraction, profiler='sample', interval=INTERVAL):
+        if profiler not in PROFILERS:
+            raise ValueError("profiler should be one of %s" % ', '.join(PROFILERS))
+        self.fraction = fraction
+        self.profiler = profiler
+        self.interval = interval
+
+    def selected(self, fname):
+        h = zlib.crc32(("%d:%s" % (SEED, fname)).encode('utf8'))
+        return h < self.fraction * 2 ** 32
+
+    def session(self, fname):
+        if not self.selected(fname):
+            return Session(None)
+        return Session(self)
+
+
+def session(profiler, fname):
+    """Return a profiling session for a document, which does nothing if profiler
+    is None or if the document was not selected."""
+    return Session(None) if profiler is None else profiler.session(fname)
+
+
+class Session(object):
+
+    """Context manager that profiles the code in its body. Afterwards the result
+    attribute has a dictionary with pstats data and collapsed stacks, or None
+    if nothing was profiled."""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.result = None
+
+    def __enter__(self):
+        if self.profiler is None:
+            return self
+        self.sampler = Sampler(sys._getframe(1), self.profiler.interval)
+        self.cprofile = None
+        if self.profiler.profiler == 'cprofile':
+            import cProfile
+            self.cprofile = cProfile.Profile()
+        self.sampler.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is None:
+            return False
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self.sampler.stop()
+        if exc_type is None:
+            if self.cprofile is not None:
+                self.cprofile.create_stats()
+                stats = self.cprofile.stats
+            else:
+                stats = self.sampler.pstats()
+            self.result = {'pstats': stats, 'stacks': self.sampler.stacks}
+        return False
+
+
+class Sampler(object):
+
+    """Samples the stack of the thread that created it, starting at the root
+    frame, frames above the root are not part of the profile."""
+
+    def __init__(self, root, interval=INTERVAL):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.depth = len(_stack(root)) - 1
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = _stack(frame)[self.depth:]
+                if stack:
+                    self.stacks[stack] += 1
+
+    def pstats(self):
+        """Return the samples as a dictionary in the format of pstats, with sample
+        counts instead of call counts."""
+        stats = {}
+        for stack, count in self.stacks.items():
+            seconds = count * self.interval
+            seen = set()
+            for i, func in enumerate(stack):
+                leaf = i == len(stack) - 1
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+                tt += seconds if leaf else 0.0
+                if func not in seen:
+                    # do not count time twice for recursive calls
+                    ct += seconds
+                    cc += count
+                seen.add(func)
+                if i > 0:
+                    caller = stack[i - 1]
+                    c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c_cc + count, c_nc + count,
+                                       c_tt + (seconds if leaf else 0.0), c_ct + seconds)
+                stats[func] = (cc, nc + count, tt, ct, callers)
+        return stats
+
+
+def _stack(frame):
+    """Return the stack from the outermost frame to frame, as a tuple of pstats
+    function keys."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+class _StatsDict(object):
+
+    # pstats.Stats can load from any object with a create_stats() method and a
+    # stats attribute
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Collector(object):
+
+    """Adds up the profiles of documents in the main process."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.documents = 0
+        self.stats = None
+        self.stacks = collections.Counter()
+
+    def add(self, result):
+        self.documents += 1
+        self.stacks.update(result['stacks'])
+        if not result['pstats']:
+            # the sampler may not have taken any samples on a small document
+            return
+        # imported here since most runs do not profile
+        import pstats
+        if self.stats is None:
+            self.stats = pstats.Stats(_StatsDict(result['pstats']))
+        else:
+            self.stats.add(_StatsDict(result['pstats']))
+
+    def write(self, limit=20):
+        if self.stats is None:
+            print("\nNo documents were profiled")
+            return
+        pstats_file = self.prefix + '.pstats'
+        collapsed_file = self.prefix + '.collapsed'
+        self.stats.dump_stats(pstats_file)
+        with open(collapsed_file, 'w') as fh:
+            for stack, count in sorted(self.stacks.items(), key=lambda x: -x[1]):
+                fh.write("%s %d\n" % (';'.join(_label(func) for func in stack), count))
+        print("\nProfiled %d documents, wrote %s and %s"
+              % (self.documents, pstats_file, collapsed_file))
+        self.stats.sort_stats('cumulative').print_stats(limit)
+
+
+def _label(func):
+    filename, line, name = func
+    return "%s (%s:%d)" % (name, os.path.basename(filename), line)
+
+
+def profiler_from_options(options):
+    """Return a Profiler for the --profile and --profiler options of a script, or
+    None if there is no --profile option."""
+    if '--profile' not in options:
+        return None
+    return Profiler(float(options['--profile']), options.get('--profiler', 'sample'))
+
+
+def collector(profiler, prefix):
+    return None if profiler is None else Collector(prefix)
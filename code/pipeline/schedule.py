@@ -0,0 +1,199 @@
+"""schedule.py
+
+Size-aware scheduling of work for the pipeline scripts.
+
+The time needed to process a document varies a lot with the size of the nxml
+file, so splitting a file list into ranges with the same number of lines gives
+runs that finish at very different times. This module uses an estimate of the
+cost of each file and does two things:
+
+1. Split a file list into N parts with about the same total cost, using the
+longest-processing-time-first heuristic (assign the most expensive file that is
+left to the part with the lowest total so far). The parts can then be handed to
+separate runs, on the same or on different machines.
+
+2. Run a stage with several worker processes on one machine (the --jobs option
+of convert_nxml.py, create_lif.py and generate_topics.py). Files are handed out
+most expensive first and each worker takes the next file as soon as it is done
+with the previous one, so workers never sit idle while others have a backlog.
+
+Costs are taken from, in this order:
+
+- a costs file given with --costs, each line has a path and a cost separated by a
+  tab, for example measured times from an earlier run (see instrument.py)
+- the second column of the file list as written by get_filenames.py, which has
+  the size of the nxml file
+- the size of the input file of the stage, if it exists
+
+Usage:
+
+$ python3 schedule.py -f FILELIST -b BEGIN -e END -n N [-s SOURCE_DIR] [--costs FILE]
+
+This writes N file lists named FILELIST-part-I-of-N.txt and prints the total cost
+of each part. SOURCE_DIR is used to get file sizes if the file list does not
+have them.
+
+"""
+
+
+import os
+import sys
+import heapq
+import getopt
+import multiprocessing
+
+from utils import elements
+
+
+def read_costs(costs_file):
+    """Read a file with tab-separated paths and costs into a dictionary."""
+    costs = {}
+    with open(costs_file) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                costs[fields[0]] = float(fields[1])
+    return costs
+
+
+def read_sizes(filelist, fnames=None):
+    """Return a dictionary with the sizes from the second column of the file list,
+    only for the file names in fnames if that is given."""
+    sizes = {}
+    with open(filelist) as fh:
+        for line in fh:
+            fields = line.strip().split("\t")
+            if len(fields) >= 2 and (fnames is None or fields[0] in fnames):
+                sizes[fields[0]] = float(fields[1])
+    return sizes
+
+
+def add_costs(items, filelist, costs_file=None, path_fun=None):
+    """Take a list of (n, fname) pairs as returned by utils.elements() and return a
+    list of (cost, n, fname) triples, see the module docstring for where costs
+    come from. path_fun maps a file name to the input file of a stage."""
+    fnames = set(fname for n, fname in items)
+    costs = read_costs(costs_file) if costs_file is not None else {}
+    missing = fnames.difference(costs)
+    if missing:
+        sizes = read_sizes(filelist, missing)
+        costs.update(sizes)
+        missing.difference_update(sizes)
+    if missing and path_fun is not None:
+        for fname in missing:
+            try:
+                costs[fname] = float(os.path.getsize(path_fun(fname)))
+            except OSError:
+                pass
+    return [(costs.get(fname, 0.0), n, fname) for n, fname in items]
+
+
+def lpt_partition(costed_items, parts):
+    """Distribute (cost, n, fname) triples over the given number of parts using the
+    longest-processing-time-first heuristic. Returns a list of lists of items,
+    each list sorted on line number, and a list of the total cost of each part."""
+    heap = [(0.0, i) for i in range(parts)]
+    assignment = [[] for _ in range(parts)]
+    for item in sorted(costed_items, reverse=True):
+        load, i = heapq.heappop(heap)
+        assignment[i].append(item)
+        heapq.heappush(heap, (load + item[0], i))
+    loads = [0.0] * parts
+    for load, i in heap:
+        loads[i] = load
+    return [sorted(part, key=lambda item: item[1]) for part in assignment], loads
+
+
+def by_decreasing_cost(costed_items):
+    """Return (n, fname) pairs with the most expensive ones first."""
+    return [(n, fname) for cost, n, fname in sorted(costed_items, reverse=True)]
+
+
+def schedule_items(items, filelist, costs_file=None, path_fun=None):
+    """Return the (n, fname) pairs from items, most expensive first."""
+    return by_decreasing_cost(add_costs(list(items), filelist, costs_file, path_fun))
+
+
+def run_jobs(fun, items, jobs=1, initializer=None, initargs=(), pool=None):
+    """Apply fun to all items and yield the results. With more than one job the
+    items are handed out one at a time to a pool of worker processes as soon as
+    a worker is free, results are yielded in the order in which they finish.
+    The initializer is called once in each worker (or once in this process if
+    there is only one job), for example to load a model. An existing pool can be
+    handed in to use its workers instead, its workers should already have been
+    initialized.
+
+    With a pool the items are taken from the iterator in a thread of the pool.
+    If items has a close() method, like utils.Prefetcher, it is called when
+    this stops, also after an error, so that the thread does not keep waiting
+    for more items and the pool can be terminated."""
+    if pool is not None:
+        try:
+            for result in pool.imap_unordered(fun, items, chunksize=1):
+                yield result
+        finally:
+            _close(items)
+        return
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield fun(item)
+        return
+    with multiprocessing.Pool(jobs, initializer, initargs) as pool:
+        try:
+            for result in pool.imap_unordered(fun, items, chunksize=1):
+                yield result
+        finally:
+            _close(items)
+
+
+def _close(items):
+    close = getattr(items, 'close', None)
+    if close is not None:
+        close()
+
+
+def write_parts(filelist, start, end, parts, source_dir=None, costs_file=None):
+    items = list(elements(filelist, start, end))
+    path_fun = None
+    if source_dir is not None:
+        path_fun = lambda fname: os.path.join(source_dir, fname)
+    assignment, loads = lpt_partition(
+        add_costs(items, filelist, costs_file, path_fun), parts)
+    basename = filelist[:-4] if filelist.endswith('.txt') else filelist
+    for i, (part, load) in enumerate(zip(assignment, loads), start=1):
+        part_file = "%s-part-%02d-of-%02d.txt" % (basename, i, parts)
+        with open(part_file, 'w') as fh:
+            for cost, n, fname in part:
+                fh.write("%s\t%s\n" % (fname, int(cost) if cost.is_integer() else cost))
+        print("%8d files  %14.0f  %s" % (len(part), load, part_file))
+    if loads and max(loads) > 0:
+        print("\nImbalance: %.2f%%" % (100.0 * (max(loads) - min(loads)) / max(loads)))
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 schedule.py -f FILELIST -b BEGIN -e END -n N [-s SOURCE_DIR] [--costs FILE]"
+          + "\n    $ python3 schedule.py (-h | --help)\n")
+
+
+def main(args):
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(args, 'f:b:e:n:s:h', ['costs=', 'help'])[0])
+    filelist = options.get('-f', filelist)
+    begin = int(options.get('-b', 1))
+    end = int(options.get('-e', 1))
+    help_wanted = True if '-h' in options or '--help' in options else False
+
+    if help_wanted or '-n' not in options:
+        usage()
+    else:
+        write_parts(filelist, begin, end, int(options['-n']),
+                    source_dir=options.get('-s'), costs_file=options.get('--costs'))
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -0,0 +1,366 @@
+"""search_index.py
+
+Local full-text search over the processed corpus, as a stand-in for
+Elasticsearch during development and testing.
+
+Usage:
+
+$ python3 search_index.py --build -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS]
+$ python3 search_index.py --search QUERY -d DATA_DIR [-k K] [--boost BOOSTS]
+
+The first invocation builds an inverted index in DATA_DIR/idx from the documents
+on lines BEGIN through END of FILELIST. The text and the Title, Abstract and
+Section annotations are taken from the structure view of the LIF files in
+DATA_DIR/lif, whose text is the same as in DATA_DIR/txt. If there is no LIF file
+the text from DATA_DIR/txt is used and all of it is treated as a section. With
+-j JOBS the documents are split into chunks that are indexed by JOBS worker
+processes, the partial indexes of the chunks are then merged.
+
+The second invocation prints the K (default 10) best matches for QUERY, ranked
+with BM25F, where the term frequencies in the title, abstract and sections are
+weighted with the boosts in BOOSTS, for example title=3,abstract=1.5,section=1
+(the default).
+
+From Python:
+
+>>> index = SearchIndex(data_dir)
+>>> index.search('tumor suppressor', k=10)
+
+The index is made up of these files:
+
+    docs.bin, docs.offsets.npy    file names of the documents
+    doclens.npy                   number of tokens in each field of each document
+    hashes.npy                    64-bit hashes of the terms, sorted
+    terms.bin, terms.offsets.npy  the terms, in the same order
+    df.npy                        document frequency of each term
+    postings.offsets.npy          where the postings of each term start
+    postings.bin                  the postings
+    meta.json                     number of documents and average field lengths
+
+All files are memory-mapped, so opening an index is instant and only the parts
+needed for a query are read from disk. A term is looked up with a binary search
+on its hash. The postings of a term are a list of (document gap, title count,
+abstract count, section count) integers compressed with variable-byte encoding,
+they are decoded in one go with numpy.
+
+"""
+
+
+import os
+import re
+import sys
+import json
+import heapq
+import getopt
+import shutil
+import hashlib
+import functools
+import itertools
+from array import array
+
+import numpy as np
+
+from lif import Container
+from utils import elements, time_elapsed, open_file, existing_file
+from utils import write_strings, MappedStrings
+from schedule import run_jobs
+
+
+FIELDS = ('title', 'abstract', 'section')
+
+BOOSTS = {'title': 3.0, 'abstract': 1.5, 'section': 1.0}
+
+# BM25 parameters, B is used for all fields
+K1 = 1.2
+B = 0.75
+
+# number of documents in the partial index created by a worker
+CHUNK_SIZE = 5000
+
+TOKEN = re.compile(r'\w+')
+
+
+def index_dir(data_dir):
+    return os.path.join(data_dir, 'idx')
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+def document_fields(data_dir, fname):
+    """Return a dictionary with the text of each field of the document."""
+    lif_file = existing_file(os.path.join(data_dir, 'lif', fname[:-4] + 'lif'))
+    if not os.path.exists(lif_file):
+        with open_file(existing_file(os.path.join(data_dir, 'txt', fname[:-4] + 'txt'))) as fh:
+            return {'section': fh.read()}
+    lif = Container(lif_file).payload
+    text = lif.text.value
+    fields = {field: [] for field in FIELDS}
+    view = lif.get_view('structure')
+    for anno in view.annotations if view is not None else []:
+        field = os.path.basename(anno.type).lower()
+        if field in fields:
+            fields[field].append(text[anno.start:anno.end])
+    return {field: ' '.join(texts) for field, texts in fields.items()}
+
+
+## Variable-byte encoding
+
+def vbyte_encode(values):
+    """Encode an array of non-negative integers below 2**63, seven bits per byte
+    with the high bit set on the last byte of each integer."""
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for bits in range(7, 64, 7):
+        nbytes += values >= np.uint64(1 << bits)
+    starts = np.cumsum(nbytes) - nbytes
+    value_idx = np.repeat(np.arange(len(values)), nbytes)
+    position = np.arange(nbytes.sum()) - np.repeat(starts, nbytes)
+    encoded = (values[value_idx] >> (7 * position).astype(np.uint64)) & np.uint64(0x7f)
+    encoded[starts + nbytes - 1] |= np.uint64(0x80)
+    return encoded.astype(np.uint8)
+
+
+def vbyte_decode(data):
+    """Decode the bytes created by vbyte_encode() into an array of integers."""
+    data = np.asarray(data, dtype=np.uint8)
+    last = (data & 0x80) != 0
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    shifted = (data & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(shifted, starts).astype(np.int64)
+
+
+## Building
+
+def index_chunk(data_dir, tmp_dir, chunk):
+    """Create a partial index for a list of (docid, fname) pairs, this runs in the
+    workers. Returns the name of the partial index and the field lengths."""
+    postings = {}
+    doclens = np.zeros((len(chunk), len(FIELDS)), dtype=np.int32)
+    for i, (docid, fname) in enumerate(chunk):
+        try:
+            fields = document_fields(data_dir, fname)
+        except Exception as e:
+            sys.stderr.write("ERROR on %s  %s\n" % (fname, e))
+            continue
+        counts = {}
+        for f, field in enumerate(FIELDS):
+            tokens = tokenize(fields.get(field, ''))
+            doclens[i, f] = len(tokens)
+            for token in tokens:
+                counts.setdefault(token, [0, 0, 0])[f] += 1
+        for term, tfs in counts.items():
+            postings.setdefault(term, []).append((docid, *tfs))
+    terms = sorted(postings, key=term_hash)
+    basename = os.path.join(tmp_dir, 'part-%09d' % chunk[0][0])
+    rows = np.array([row for term in terms for row in postings[term]],
+                    dtype=np.int32).reshape(-1, 1 + len(FIELDS))
+    np.save(basename + '.hashes.npy', np.array([term_hash(t) for t in terms], dtype=np.uint64))
+    np.save(basename + '.counts.npy', np.array([len(postings[t]) for t in terms], dtype=np.int64))
+    np.save(basename + '.rows.npy', rows)
+    with open(basename + '.terms', 'w', encoding='utf8') as fh:
+        for term in terms:
+            fh.write(term + "\n")
+    return basename, [docid for docid, fname in chunk], doclens
+
+
+def _chunks(fnames, size):
+    chunk = []
+    for docid, fname in enumerate(fnames):
+        chunk.append((docid, fname))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@time_elapsed
+def build(data_dir, filelist, start, end, jobs=1):
+    out_dir = index_dir(data_dir)
+    tmp_dir = os.path.join(out_dir, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    fnames = [fname for n, fname in elements(filelist, start, end)]
+    write_strings(os.path.join(out_dir, 'docs'), fnames)
+    doclens = np.zeros((len(fnames), len(FIELDS)), dtype=np.int32)
+    parts = []
+    done = 0
+    fun = functools.partial(index_chunk, data_dir, tmp_dir)
+    for basename, docids, chunk_doclens in run_jobs(fun, _chunks(fnames, CHUNK_SIZE), jobs):
+        parts.append(basename)
+        doclens[docids] = chunk_doclens
+        done += len(docids)
+        sys.stderr.write("\r%d documents" % done)
+    sys.stderr.write("\n")
+    np.save(os.path.join(out_dir, 'doclens.npy'), doclens)
+    # sorting on the first document identifier keeps the postings sorted
+    parts.sort()
+    merge_parts(parts, out_dir)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as fh:
+        json.dump({'documents': len(fnames), 'fields': FIELDS,
+                   'average_lengths': doclens.mean(axis=0).tolist() if len(fnames) else [0.0] * 3},
+                  fh, indent=4)
+    shutil.rmtree(tmp_dir)
+    print("Indexed %d documents in %s" % (len(fnames), out_dir))
+
+
+def merge_parts(parts, out_dir):
+    """Merge the partial indexes into the final index. The terms of each part are
+    sorted on their hash, so the parts are merged with a k-way merge that only
+    has the current term of each part in memory. The parts should be sorted on
+    their first document identifier so that the postings stay sorted."""
+    hashes = array('Q')
+    df = array('i')
+    postings_offsets = array('q', [0])
+    merged = heapq.merge(*[_part_terms(basename, p) for p, basename in enumerate(parts)])
+
+    def terms(fh):
+        # writes the postings while the terms are written by write_strings()
+        for term_hash, group in itertools.groupby(merged, key=lambda entry: entry[0]):
+            group = list(group)
+            term_rows = np.concatenate([entry[4] for entry in group]).astype(np.int64)
+            # store the gaps between document identifiers
+            term_rows[1:, 0] = np.diff(term_rows[:, 0])
+            data = vbyte_encode(term_rows.ravel())
+            fh.write(data.tobytes())
+            hashes.append(term_hash)
+            df.append(len(term_rows))
+            postings_offsets.append(postings_offsets[-1] + len(data))
+            yield group[-1][3]
+
+    with open(os.path.join(out_dir, 'postings.bin'), 'wb') as fh:
+        write_strings(os.path.join(out_dir, 'terms'), terms(fh))
+    np.save(os.path.join(out_dir, 'hashes.npy'), np.frombuffer(hashes, dtype=np.uint64))
+    np.save(os.path.join(out_dir, 'df.npy'), np.frombuffer(df, dtype=np.int32))
+    np.save(os.path.join(out_dir, 'postings.offsets.npy'),
+            np.frombuffer(postings_offsets, dtype=np.int64))
+
+
+def _part_terms(basename, part):
+    """Yield the hash, the part, the position, the term and the postings rows of
+    each term of a partial index, in the order of the hashes."""
+    hashes = np.load(basename + '.hashes.npy', mmap_mode='r')
+    counts = np.load(basename + '.counts.npy', mmap_mode='r')
+    rows = np.load(basename + '.rows.npy', mmap_mode='r')
+    offset = 0
+    with open(basename + '.terms', encoding='utf8') as fh:
+        for i, line in enumerate(fh):
+            count = int(counts[i])
+            yield int(hashes[i]), part, i, line.rstrip("\n"), rows[offset:offset + count]
+            offset += count
+
+
+## Searching
+
+class SearchIndex(object):
+
+    def __init__(self, data_dir, boosts=None, k1=K1, b=B):
+        directory = index_dir(data_dir)
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        self.documents = meta['documents']
+        self.average_lengths = np.array(meta['average_lengths'], dtype=np.float64)
+        self.docs = MappedStrings(os.path.join(directory, 'docs'))
+        self.terms = MappedStrings(os.path.join(directory, 'terms'))
+        self.doclens = np.load(os.path.join(directory, 'doclens.npy'), mmap_mode='r')
+        self.hashes = np.load(os.path.join(directory, 'hashes.npy'), mmap_mode='r')
+        self.df = np.load(os.path.join(directory, 'df.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(directory, 'postings.offsets.npy'), mmap_mode='r')
+        self.postings_data = np.memmap(os.path.join(directory, 'postings.bin'),
+                                       dtype=np.uint8, mode='r') if self.offsets[-1] else None
+        self.boosts = np.array([(boosts or BOOSTS)[f] for f in FIELDS], dtype=np.float64)
+        self.k1 = k1
+        self.b = b
+
+    def lookup(self, term):
+        """Return the index of the term, or None if it is not in the index."""
+        h = np.uint64(term_hash(term))
+        i = int(np.searchsorted(self.hashes, h))
+        if i < len(self.hashes) and self.hashes[i] == h and self.terms[i] == term:
+            return i
+        return None
+
+    def postings(self, t):
+        """Return the document identifiers and an array with a column of term
+        counts for each field, for the term with index t."""
+        data = self.postings_data[self.offsets[t]:self.offsets[t + 1]]
+        rows = vbyte_decode(data).reshape(-1, 1 + len(FIELDS))
+        return np.cumsum(rows[:, 0]), rows[:, 1:]
+
+    def search(self, query, k=10):
+        """Return a list of (fname, score) pairs for the best k documents."""
+        docids = []
+        scores = []
+        for term in set(tokenize(query)):
+            t = self.lookup(term)
+            if t is None:
+                continue
+            ids, tfs = self.postings(t)
+            df = int(self.df[t])
+            idf = np.log(1.0 + (self.documents - df + 0.5) / (df + 0.5))
+            lengths = self.doclens[ids] / np.maximum(self.average_lengths, 1e-9)
+            # BM25F: normalize the counts for each field, weight them with the
+            # boosts and then apply the saturation function once
+            weighted = (tfs / (1.0 - self.b + self.b * lengths)) @ self.boosts
+            docids.append(ids)
+            scores.append(idf * weighted / (self.k1 + weighted))
+        if not docids:
+            return []
+        docids, inverse = np.unique(np.concatenate(docids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        k = min(k, len(totals))
+        best = np.argpartition(-totals, k - 1)[:k]
+        best = best[np.argsort(-totals[best])]
+        return [(self.docs[int(docids[i])], float(totals[i])) for i in best]
+
+
+def parse_boosts(spec):
+    boosts = dict(BOOSTS)
+    for part in spec.split(','):
+        field, value = part.split('=')
+        if field not in boosts:
+            raise ValueError("unknown field: %s" % field)
+        boosts[field] = float(value)
+    return boosts
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 search_index.py --build -d DATA_DIR -f FILELIST -b BEGIN -e END [-j JOBS]"
+          + "\n    $ python3 search_index.py --search QUERY -d DATA_DIR [-k K] [--boost BOOSTS]"
+          + "\n    $ python3 search_index.py (-h | --help)\n")
+
+
+def main(args):
+    data_dir = '/DATA/eager/sample-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(args, 'd:f:b:e:j:k:h',
+                                 ['build', 'search=', 'boost=', 'help'])[0])
+    data_dir = options.get('-d', data_dir)
+
+    if '-h' in options or '--help' in options:
+        usage()
+    elif '--build' in options:
+        build(data_dir, options.get('-f', filelist),
+              int(options.get('-b', 1)), int(options.get('-e', 1)),
+              jobs=int(options.get('-j', 1)))
+    elif '--search' in options:
+        boosts = parse_boosts(options['--boost']) if '--boost' in options else None
+        index = SearchIndex(data_dir, boosts)
+        for fname, score in index.search(options['--search'], int(options.get('-k', 10))):
+            print("%8.4f  %s" % (score, fname))
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
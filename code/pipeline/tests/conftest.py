@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the pipeline scripts import each other as top-level modules
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PIPELINE_DIR)
@@ -0,0 +1,19 @@
+import numpy as np
+
+from citations import csr
+
+
+def test_csr_round_trip():
+    rows = np.array([0, 0, 2, 2, 2, 4], dtype=np.int32)
+    columns = np.array([1, 3, 0, 1, 4, 2], dtype=np.int32)
+    indptr, indices = csr(rows, columns, 6)
+    assert indptr.tolist() == [0, 2, 2, 5, 5, 6, 6]
+    pairs = [(row, int(column)) for row in range(6)
+             for column in indices[indptr[row]:indptr[row + 1]]]
+    assert pairs == list(zip(rows.tolist(), columns.tolist()))
+
+
+def test_csr_empty():
+    indptr, indices = csr(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), 3)
+    assert indptr.tolist() == [0, 0, 0, 0]
+    assert len(indices) == 0
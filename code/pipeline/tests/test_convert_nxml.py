@@ -0,0 +1,43 @@
+import os
+import sys
+import subprocess
+
+from conftest import PIPELINE_DIR
+
+
+def test_crash_with_jobs_exits(tmp_path):
+    # the failing file is the largest so it is handed out first, while the
+    # prefetcher still has many items to go
+    source_dir = tmp_path / 'src'
+    (source_dir / 'J').mkdir(parents=True)
+    (source_dir / 'J' / 'bad.nxml').write_text('<article>' + ' ' * 100000 + '</article>')
+    (source_dir / 'J' / 'empty.nxml').write_text('<article></article>')
+    filelist = tmp_path / 'files.txt'
+    filelist.write_text('J/bad.nxml\n' + 'J/empty.nxml\n' * 40)
+    args = [sys.executable, '-W', 'ignore', 'convert_nxml.py', '-s', str(source_dir),
+            '-d', str(tmp_path / 'data'), '-f', str(filelist), '-b', '1', '-e', '41',
+            '--crash', '--jobs', '2', '--prefetch', '2']
+    result = subprocess.run(args, cwd=PIPELINE_DIR, capture_output=True, text=True,
+                            timeout=60)
+    assert result.returncode != 0
+    assert 'Error' in result.stderr
+
+
+def test_read_file_is_bounded(tmp_path):
+    from convert_nxml import NxmlReader
+    nxml_file = tmp_path / 'large.nxml'
+    nxml_file.write_text('<article><front><title>Ünïcode</title></front><body>'
+                         + '<p>héllo</p><table-wrap>x</table-wrap>' * 10000
+                         + '</body></article>', encoding='utf8')
+    size = os.path.getsize(nxml_file)
+    text, read_size = NxmlReader(max_size=200).read_file(str(nxml_file))
+    assert read_size == size
+    assert len(text.encode('utf8')) <= 200
+    # cut before a tag, so there are no half tags
+    assert text.startswith('<article><front>') and text.rfind('<') < text.rfind('>')
+    text, _ = NxmlReader(max_size=20).read_file(str(nxml_file))
+    assert text.endswith('</front>')
+    text, _ = NxmlReader(max_size=200, size_policy='summarize').read_file(str(nxml_file))
+    assert text.endswith('</front>')
+    text, _ = NxmlReader(max_size=200, size_policy='skip').read_file(str(nxml_file))
+    assert text is None
@@ -0,0 +1,56 @@
+import numpy as np
+
+from cube import Cube, CubeReader
+
+
+ENTRIES = [('Cell', 2010, [(0, 0.5), (2, 0.25)]),
+           ('Cell', 2010, [(0, 0.75)]),
+           ('Cell', 2012, [(1, 1.0)]),
+           ('Nature', 2010, [(0, 0.5), (1, 0.5)]),
+           ('Nature', 2011, [])]
+
+
+def build(entries):
+    cube = Cube()
+    for entry in entries:
+        cube.add(entry)
+    return cube
+
+
+def test_aggregation(tmp_path):
+    fname = str(tmp_path / 'cube.npz')
+    build(ENTRIES).save(fname)
+    reader = CubeReader(fname=fname)
+    assert reader.num_topics == 3
+    assert reader.trend(0) == [(2010, 3, 3, 1.75), (2011, 1, 0, 0.0), (2012, 1, 0, 0.0)]
+    assert reader.trend(0, 'Cell') == [(2010, 2, 2, 1.25), (2012, 1, 0, 0.0)]
+    assert reader.trend(1, 'Nature') == [(2010, 1, 1, 0.5), (2011, 1, 0, 0.0)]
+    assert reader.trend(0, 'Science') == []
+    assert reader.trend(5) == []
+    assert reader.top_journals(0) == [('Cell', 3, 2, 1.25), ('Nature', 2, 1, 0.5)]
+    assert reader.top_journals(1, year=2012) == [('Cell', 1, 1, 1.0)]
+    assert reader.top_journals(0, k=1) == [('Cell', 3, 2, 1.25)]
+
+
+def test_merge_and_subtract(tmp_path):
+    # merging the cubes of two chunks gives the cube of all entries
+    merged = build(ENTRIES[:2])
+    merged.merge(build(ENTRIES[2:]))
+    assert_equal_cubes(merged, build(ENTRIES))
+    # subtracting an entry gives the cube without it
+    merged.add(ENTRIES[2], sign=-1)
+    assert_equal_cubes(merged, build(ENTRIES[:2] + ENTRIES[3:]))
+    assert ('Cell', 2012) not in merged.cells
+    # and saving and loading does not change it
+    fname = str(tmp_path / 'cube.npz')
+    merged.save(fname)
+    assert_equal_cubes(Cube.load(fname), merged)
+
+
+def assert_equal_cubes(cube1, cube2):
+    assert sorted(cube1.cells) == sorted(cube2.cells)
+    for key, (docs, topic_docs, scores) in cube1.cells.items():
+        other = cube2.cells[key]
+        assert docs == other[0]
+        assert np.array_equal(topic_docs, other[1][:len(topic_docs)])
+        assert np.allclose(scores, other[2][:len(scores)])
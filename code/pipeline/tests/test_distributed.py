@@ -0,0 +1,53 @@
+import os
+import time
+
+from distributed import WorkDir, Lease
+
+
+def expire(fname):
+    past = time.time() - 100
+    os.utime(fname, (past, past))
+
+
+def test_lease_is_exclusive(tmp_path):
+    fname = str(tmp_path / 'chunk.lease')
+    lease = Lease.acquire(fname, 'worker-1', lease_time=10)
+    assert lease is not None and lease.owned()
+    assert Lease.acquire(fname, 'worker-2', lease_time=10) is None
+    assert lease.renew()
+    lease.release()
+    assert not os.path.exists(fname)
+    assert Lease.acquire(fname, 'worker-2', lease_time=10) is not None
+
+
+def test_lease_takeover(tmp_path):
+    fname = str(tmp_path / 'chunk.lease')
+    old = Lease.acquire(fname, 'worker-1', lease_time=10)
+    expire(fname)
+    new = Lease.acquire(fname, 'worker-2', lease_time=10)
+    assert new is not None and new.owned()
+    assert not old.owned()
+    assert not old.renew()
+    old.release()
+    assert new.owned()
+    # nothing is left behind from the takeover
+    assert os.listdir(str(tmp_path)) == ['chunk.lease']
+
+
+def test_claim(tmp_path):
+    filelist = str(tmp_path / 'files.txt')
+    with open(filelist, 'w') as fh:
+        fh.write(''.join("article-%d.nxml\n" % n for n in range(10)))
+    workdir = WorkDir(str(tmp_path), 'run')
+    workdir.create_plan(filelist, 1, 10, 3)
+    assert list(workdir.chunks()) == [0, 1, 2, 3]
+    assert workdir.chunk_range(3) == (10, 10)
+    workdir.mark_done(0, {'files': 3})
+    workdir.mark_failed(1, {'error': 'failed'})
+    i, lease = workdir.claim('worker-1', lease_time=10)
+    assert i == 2
+    assert workdir.claim('worker-2', lease_time=10)[0] == 3
+    assert workdir.claim('worker-3', lease_time=10) is None
+    expire(lease.fname)
+    assert workdir.claim('worker-3', lease_time=10)[0] == 2
+    assert workdir.read_done(0) == {'files': 3}
@@ -0,0 +1,42 @@
+import os
+import sys
+
+from conftest import PIPELINE_DIR
+
+sys.path.append(os.path.join(os.path.dirname(PIPELINE_DIR), 'utils'))
+
+from get_filenames import shuffle_filenames
+
+
+def shuffle(tmp_path, seed, buckets=8):
+    sorted_list = str(tmp_path / 'files-sorted.txt')
+    random_list = str(tmp_path / ('files-random-%d.txt' % seed))
+    with open(sorted_list, 'w') as fh:
+        for n in range(500):
+            fh.write("journal/article-%04d.nxml\t%d\n" % (n, n))
+    shuffle_filenames(sorted_list, random_list, seed=seed, buckets=buckets)
+    with open(sorted_list) as fh:
+        original = fh.readlines()
+    with open(random_list) as fh:
+        return original, fh.readlines()
+
+
+def test_shuffle_is_permutation(tmp_path):
+    original, shuffled = shuffle(tmp_path, 42)
+    assert sorted(shuffled) == original
+    assert shuffled != original
+    # the temporary bucket files are removed
+    assert sorted(os.listdir(str(tmp_path))) == ['files-random-42.txt', 'files-sorted.txt']
+
+
+def test_shuffle_is_reproducible(tmp_path):
+    _, first = shuffle(tmp_path, 42)
+    _, second = shuffle(tmp_path, 42)
+    _, other = shuffle(tmp_path, 7)
+    assert first == second
+    assert first != other
+
+
+def test_shuffle_with_more_buckets_than_lines(tmp_path):
+    original, shuffled = shuffle(tmp_path, 42, buckets=1000)
+    assert sorted(shuffled) == original
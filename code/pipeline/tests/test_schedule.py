@@ -0,0 +1,30 @@
+import random
+
+from schedule import lpt_partition
+
+
+def test_lpt_partition():
+    rng = random.Random(1)
+    items = [(float(rng.randint(1, 100)), n, "file-%d.nxml" % n) for n in range(1, 101)]
+    assignment, loads = lpt_partition(items, 4)
+    assert len(assignment) == 4
+    assert sorted(item for part in assignment for item in part) == sorted(items)
+    for part, load in zip(assignment, loads):
+        assert [item[1] for item in part] == sorted(item[1] for item in part)
+        assert load == sum(item[0] for item in part)
+    # LPT is within 4/3 of the optimum, which is at least the average load
+    total = sum(item[0] for item in items)
+    assert max(loads) <= max(total / 4, max(items)[0]) * 4 / 3
+
+
+def test_lpt_partition_one_large_item():
+    items = [(100.0, 1, 'a'), (1.0, 2, 'b'), (1.0, 3, 'c'), (1.0, 4, 'd')]
+    assignment, loads = lpt_partition(items, 2)
+    assert sorted(loads) == [3.0, 100.0]
+    assert [(100.0, 1, 'a')] in assignment
+
+
+def test_lpt_partition_more_parts_than_items():
+    assignment, loads = lpt_partition([(2.0, 1, 'a'), (1.0, 2, 'b')], 4)
+    assert sorted(loads) == [0.0, 0.0, 1.0, 2.0]
+    assert sorted(len(part) for part in assignment) == [0, 0, 1, 1]
@@ -0,0 +1,22 @@
+import numpy as np
+
+from search_index import vbyte_encode, vbyte_decode
+
+
+def test_vbyte_round_trip():
+    values = [0, 1, 127, 128, 16383, 16384, 2 ** 42, 2 ** 49 + 5, 2 ** 56, 2 ** 63 - 1]
+    encoded = vbyte_encode(values)
+    assert encoded.dtype == np.uint8
+    assert vbyte_decode(encoded).tolist() == values
+
+
+def test_vbyte_sizes():
+    assert len(vbyte_encode([127])) == 1
+    assert len(vbyte_encode([128])) == 2
+    assert len(vbyte_encode([2 ** 63 - 1])) == 9
+
+
+def test_vbyte_random():
+    rng = np.random.RandomState(0)
+    values = rng.randint(0, 2 ** 62, size=1000, dtype=np.int64) >> rng.randint(0, 62, size=1000)
+    assert np.array_equal(vbyte_decode(vbyte_encode(values)), values)
@@ -0,0 +1,49 @@
+import json
+
+from topic_server import TopicService, _handle_json
+
+
+class StubModel(object):
+
+    topic_idx = {0: '0.500*"cell" + 0.500*"protein"'}
+
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def bow(self, text):
+        return [(len(word), 1) for word in text.split()]
+
+    def topics(self, bows):
+        if self.fail:
+            raise ValueError('model failed')
+        return [[(0, 1.0)] for bow in bows]
+
+
+def handle(request, model=None):
+    service = TopicService(model or StubModel())
+    return _handle_json(service, json.dumps(request))
+
+
+def test_texts():
+    response = handle({'texts': ['cell protein', 'protein']})
+    assert [list(result) for result in response['results']] == [['view'], ['view']]
+
+
+def test_bad_documents_get_an_error():
+    response = handle({'texts': ['cell protein', 1, None]})
+    assert 'view' in response['results'][0]
+    assert 'error' in response['results'][1]
+    assert 'error' in response['results'][2]
+    response = handle({'lifs': [1, '/does/not/exist.lif']})
+    assert all('error' in result for result in response['results'])
+
+
+def test_bad_requests_get_an_error():
+    for request in ([1, 2], {'texts': 'text'}, {'lifs': 'a.lif'}, {'other': 1},
+                    {'lifs': ['a.lif'], 'outputs': ['a.lif', 'b.lif']},
+                    {'lifs': ['a.lif'], 'outputs': 'a.lif'}):
+        assert 'error' in handle(request)
+
+
+def test_model_errors_get_an_error():
+    assert 'error' in handle({'texts': ['cell protein']}, StubModel(fail=True))
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from utils import elements, _scan_elements, index_filelist, load_index, parse_shard
+from utils import write_strings, MappedStrings
+
+
+@pytest.fixture
+def filelist(tmp_path):
+    fname = str(tmp_path / 'files.txt')
+    with open(fname, 'w') as fh:
+        for n in range(1, 24):
+            fh.write("journal-%d/article-%03d.nxml\t%d\n" % (n % 4, n, n * 100))
+    return fname
+
+
+@pytest.mark.parametrize('shard', [None, '1/1', '2/3', '3/3', 'hash:1/2', 'hash:2/2'])
+@pytest.mark.parametrize('start, end', [(1, 23), (0, 100), (5, 17), (4, 4), (10, 9), (30, 40)])
+def test_elements_with_index(filelist, shard, start, end):
+    shard = None if shard is None else parse_shard(shard)
+    expected = list(_scan_elements(filelist, start, end, shard))
+    assert load_index(filelist) is None
+    assert list(elements(filelist, start, end, shard)) == expected
+    # the second call seeks using the index written by the first one
+    assert load_index(filelist) is not None
+    assert list(elements(filelist, start, end, shard)) == expected
+
+
+def test_elements_reindexes_changed_filelist(filelist):
+    index_filelist(filelist)
+    with open(filelist, 'a') as fh:
+        fh.write("journal-9/article-999.nxml\t10\n")
+    stat = os.stat(filelist)
+    os.utime(filelist, (stat.st_atime, stat.st_mtime + 10))
+    assert load_index(filelist) is None
+    assert list(elements(filelist, 23, 24)) == [
+        (23, 'journal-3/article-023.nxml'), (24, 'journal-9/article-999.nxml')]
+
+
+def test_shards_partition_lines(filelist):
+    for spec in ('%d/3', 'hash:%d/3'):
+        lines = []
+        for i in range(1, 4):
+            lines.extend(elements(filelist, 1, 23, parse_shard(spec % i)))
+        assert sorted(lines) == list(elements(filelist, 1, 23))
+
+
+def test_mapped_strings(tmp_path):
+    strings = ['abc', '', 'café', '文献', '', 'x' * 1000]
+    basename = str(tmp_path / 'strings')
+    write_strings(basename, (s for s in strings))
+    mapped = MappedStrings(basename)
+    assert len(mapped) == len(strings)
+    assert [mapped[i] for i in range(len(mapped))] == strings
+
+
+def test_mapped_strings_empty(tmp_path):
+    basename = str(tmp_path / 'strings')
+    write_strings(basename, ['', ''])
+    mapped = MappedStrings(basename)
+    assert [mapped[0], mapped[1]] == ['', '']
+    write_strings(basename, [])
+    assert len(MappedStrings(basename)) == 0
@@ -0,0 +1,420 @@
+"""topic_server.py
+
+Long-running topic inference service. The topic model, the dictionary and the
+topic names are loaded once and kept in memory, clients hand in batches of
+texts or LIF files over a local Unix socket or a local HTTP port and get the
+topics back as LIF views.
+
+Usage:
+
+$ python3 topic_server.py --serve --socket PATH
+$ python3 topic_server.py --serve --port PORT
+$ python3 topic_server.py --client ADDRESS -d DATA_DIR -f FILELIST -s START -e END
+$ python3 topic_server.py (-h | --help)
+
+The first two invocations start the server, using the model created with
+generate_topics.py --build. With --socket the server listens on a Unix domain
+socket and each request and response is a JSON object on a single line, several
+requests can be sent over the same connection. With --port the server listens
+for HTTP POST requests on 127.0.0.1 only, the JSON object is the body of the
+request and a GET request returns the status of the server. Nothing ever goes
+outside of the local machine.
+
+A request has either a list of texts or a list of LIF files. For LIF files an
+optional list of output files can be added, in which case the server writes the
+topic LIF files itself, just like generate_topics.py does:
+
+{"texts": ["some text", "some more text"]}
+{"lifs": ["/DATA/lif/a.lif", "/DATA/lif/b.lif"],
+ "outputs": ["/DATA/top/a.lif", "/DATA/top/b.lif"]}
+
+The response has a list of results, one for each text or file, each result is
+either the JSON of the topics view or an error:
+
+{"results": [{"view": {"id": "topics", ...}}, {"error": "..."}]}
+
+Requests from all clients are put on one queue and are handed to the model in
+batches of up to --batch documents (default 64), waiting at most --wait
+milliseconds (default 10) for a batch to fill up. Reading and writing the files
+happens in the threads that handle the client connections.
+
+The third invocation is a client that runs the topic model on the files in
+DATA_DIR/lif as filtered by FILELIST, START and END and writes results to
+DATA_DIR/top, like generate_topics.py but without loading gensim, nltk or the
+model. ADDRESS is either the path to the socket or a port number. The client
+also takes the --shard option, see utils.parse_shard(), and --compress gz or
+--compress zst to have the topic files written compressed. LIF files and output
+files with a .gz or .zst extension are compressed, see utils.open_file().
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import getopt
+import threading
+import socketserver
+import http.client
+import http.server
+
+# generate_topics imports gensim and nltk only when they are used, so the
+# client does not load them
+import generate_topics
+from utils import elements, time_elapsed, parse_shard
+from utils import existing_file, compressed_name, write_file
+from instrument import Progress, estimate_total
+
+
+BATCH_SIZE = 64
+BATCH_WAIT = 0.010
+CLIENT_BATCH_SIZE = 16
+
+
+class TopicModel(object):
+
+    """Wraps the LDA model, dictionary and topic names. Loading the model is
+    deferred to this class so that client code does not need gensim or nltk."""
+
+    def __init__(self):
+        self.lda = generate_topics.load_model()
+        self.dictionary = generate_topics.load_dictionary()
+        self.topic_idx = generate_topics.load_topic_index(self.lda)
+        # the nltk tokenizer, stopwords and wordnet are loaded lazily and the
+        # loaders are not thread-safe, so they are loaded here, before the
+        # client threads call bow() at the same time
+        self.bow("Loading tokenizers and wordnet")
+
+    def bow(self, text):
+        doc = generate_topics.prepare_text_for_lda(text)
+        return self.dictionary.doc2bow(doc)
+
+    def topics(self, bows):
+        return generate_topics.get_batch_topics(bows, self.lda)
+
+
+class Batcher(object):
+
+    """Collects documents from concurrent requests and runs the model on batches of
+    them in a single worker thread."""
+
+    def __init__(self, model, batch_size=BATCH_SIZE, wait=BATCH_WAIT):
+        self.model = model
+        self.batch_size = batch_size
+        self.wait = wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.documents = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def topics(self, bows):
+        """Return the list of topics for each of the bags of words, blocks until the
+        worker thread has processed them."""
+        job = {'bows': bows, 'done': threading.Event(), 'result': None, 'error': None}
+        self.queue.put(job)
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['result']
+
+    def _run(self):
+        while True:
+            jobs = [self.queue.get()]
+            size = len(jobs[0]['bows'])
+            deadline = time.time() + self.wait
+            while size < self.batch_size:
+                try:
+                    job = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                size += len(job['bows'])
+            self._process(jobs)
+
+    def _process(self, jobs):
+        bows = [bow for job in jobs for bow in job['bows']]
+        try:
+            topics = self.model.topics(bows) if bows else []
+        except Exception as e:
+            topics = None
+            for job in jobs:
+                job['error'] = e
+        self.batches += 1
+        self.documents += len(bows)
+        offset = 0
+        for job in jobs:
+            if topics is not None:
+                job['result'] = topics[offset:offset + len(job['bows'])]
+                offset += len(job['bows'])
+            job['done'].set()
+
+
+class TopicService(object):
+
+    """Handles requests, this is shared by the socket and HTTP servers."""
+
+    def __init__(self, model, batch_size=BATCH_SIZE, wait=BATCH_WAIT):
+        self.model = model
+        self.batcher = Batcher(model, batch_size, wait)
+        self.started = time.time()
+
+    def status(self):
+        return {"status": "ok",
+                "uptime": round(time.time() - self.started, 3),
+                "batches": self.batcher.batches,
+                "documents": self.batcher.documents}
+
+    def handle(self, request):
+        """Handle a request checked by _handle_json(), documents of the wrong type
+        or that cannot be read get an error in the results."""
+        # imported here to keep the client side light
+        from lif import Container, LIF
+        docs = []
+        if 'texts' in request:
+            for text in request['texts']:
+                if not isinstance(text, str):
+                    docs.append([None, None, 'ERROR: text should be a string'])
+                    continue
+                lif = LIF()
+                lif.text.value = text
+                docs.append([lif, None, None])
+        else:
+            outputs = request.get('outputs') or [None] * len(request['lifs'])
+            for lif_file, out_file in zip(request['lifs'], outputs):
+                if not isinstance(lif_file, str) or not isinstance(out_file, (str, type(None))):
+                    docs.append([None, None, 'ERROR: file names should be strings'])
+                    continue
+                try:
+                    docs.append([Container(lif_file).payload, out_file, None])
+                except Exception as e:
+                    docs.append([None, None, 'ERROR: %s' % e])
+        good_docs, bows = [], []
+        for doc in docs:
+            if doc[2] is None:
+                try:
+                    bows.append(self.model.bow(doc[0].text.value))
+                    good_docs.append(doc)
+                except Exception as e:
+                    doc[2] = 'ERROR: %s' % e
+        for doc, topics in zip(good_docs, self.batcher.topics(bows)):
+            doc.append(topics)
+        return {"results": [self._result(*doc) for doc in docs]}
+
+    def _result(self, lif, out_file, error, topics=None):
+        if error is not None:
+            return {"error": error}
+        try:
+            view = generate_topics.create_topics_view(lif, topics, self.model.topic_idx)
+            if out_file is not None:
+                lif_out = generate_topics.create_topics_lif(lif, topics, self.model.topic_idx)
+                write_file(out_file, lif_out.as_string(pretty=True))
+            return {"view": view.as_json()}
+        except Exception as e:
+            return {"error": 'ERROR: %s' % e}
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = _handle_json(self.server.service, line)
+            self.wfile.write(json.dumps(response).encode('utf8') + b"\n")
+            self.wfile.flush()
+
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._respond(200, self.server.service.status())
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        response = _handle_json(self.server.service, self.rfile.read(length))
+        self._respond(400 if 'error' in response else 200, response)
+
+    def _respond(self, code, response):
+        body = json.dumps(response).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def _handle_json(service, data):
+    try:
+        request = json.loads(data)
+    except ValueError as e:
+        return {"error": "ERROR: %s" % e}
+    if not isinstance(request, dict):
+        return {"error": "ERROR: request should be a JSON object"}
+    if request.get('status'):
+        return service.status()
+    if 'texts' not in request and 'lifs' not in request:
+        return {"error": "ERROR: request needs texts or lifs"}
+    if 'texts' in request and not isinstance(request['texts'], list):
+        return {"error": "ERROR: texts should be a list"}
+    if 'texts' not in request:
+        if not isinstance(request['lifs'], list):
+            return {"error": "ERROR: lifs should be a list"}
+        outputs = request.get('outputs')
+        if outputs is not None and not isinstance(outputs, list):
+            return {"error": "ERROR: outputs should be a list"}
+        if outputs and len(outputs) != len(request['lifs']):
+            return {"error": "ERROR: lifs and outputs differ in length"}
+    try:
+        return service.handle(request)
+    except Exception as e:
+        # for example an error of the model, every request gets a response
+        return {"error": "ERROR: %s" % e}
+
+
+def serve(socket_path=None, port=None, batch_size=BATCH_SIZE, wait=BATCH_WAIT):
+    print("Loading model")
+    service = TopicService(TopicModel(), batch_size, wait)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixServer(socket_path, SocketHandler)
+        print("Listening on %s" % socket_path)
+    else:
+        server = HTTPServer(('127.0.0.1', port), HTTPHandler)
+        print("Listening on http://127.0.0.1:%d" % port)
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class TopicClient(object):
+
+    """Client for the topic server, ADDRESS is either a socket path or a port."""
+
+    def __init__(self, address):
+        self.address = str(address)
+        self.sock = None
+        self.fh = None
+
+    def request(self, request):
+        if self.address.isdigit():
+            connection = http.client.HTTPConnection('127.0.0.1', int(self.address))
+            connection.request('POST', '/', json.dumps(request),
+                               {'Content-Type': 'application/json'})
+            return json.loads(connection.getresponse().read())
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.address)
+            self.fh = self.sock.makefile('rwb')
+        self.fh.write(json.dumps(request).encode('utf8') + b"\n")
+        self.fh.flush()
+        return json.loads(self.fh.readline())
+
+    def topics(self, texts):
+        return self.request({"texts": texts})['results']
+
+    def close(self):
+        if self.sock is not None:
+            self.fh.close()
+            self.sock.close()
+            self.sock = None
+
+
+@time_elapsed
+def process_filelist(address, data_dir, filelist, start, end,
+                     batch_size=CLIENT_BATCH_SIZE, shard=None, compress=None):
+    client = TopicClient(address)
+    progress = Progress(estimate_total(filelist, start, end, shard))
+    batch = []
+    for n, fname in elements(filelist, start, end, shard):
+        batch.append((n, fname))
+        if len(batch) >= batch_size:
+            _process_batch(client, data_dir, batch, progress, compress)
+            batch = []
+    if batch:
+        _process_batch(client, data_dir, batch, progress, compress)
+    progress.finish()
+    client.close()
+
+
+def _process_batch(client, data_dir, batch, progress, compress=None):
+    lifs = [existing_file(os.path.join(data_dir, 'lif', fname[:-5] + '.lif'))
+            for _, fname in batch]
+    outputs = [compressed_name(os.path.join(data_dir, 'top', fname[:-5] + '.lif'), compress)
+               for _, fname in batch]
+    response = client.request({"lifs": lifs, "outputs": outputs})
+    if 'error' in response:
+        sys.stderr.write("\nERROR on %07d-%07d  %s\n"
+                         % (batch[0][0], batch[-1][0], response['error']))
+        progress.update(progress.done + len(batch), progress.errors + len(batch))
+        return
+    for (n, fname), result in zip(batch, response['results']):
+        if 'error' in result:
+            sys.stderr.write("\nERROR on %07d  %s\n" % (n, fname))
+            print(result['error'])
+            progress.errors += 1
+        progress.update()
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 topic_server.py --serve --socket PATH"
+          + "\n    $ python3 topic_server.py --serve --port PORT [--batch N] [--wait MS]"
+          + "\n    $ python3 topic_server.py --client ADDRESS -d DATA_DIR -f FILELIST -s START -e END [--shard I/N]"
+          + "\n          [--compress (gz|zst)]"
+          + "\n    $ python3 topic_server.py (-h | --help)\n")
+
+
+def main(args):
+    data_dir = '/DATA/eager/sample-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(
+        args, 'd:f:s:e:h',
+        ['serve', 'socket=', 'port=', 'batch=', 'wait=', 'client=', 'shard=', 'compress=',
+         'help'])[0])
+    data_dir = options.get('-d', data_dir)
+    filelist = options.get('-f', filelist)
+    start = int(options.get('-s', 1))
+    end = int(options.get('-e', 1))
+    help_wanted = True if '-h' in options or '--help' in options else False
+
+    if help_wanted:
+        usage()
+    elif '--serve' in options and ('--socket' in options or '--port' in options):
+        port = int(options['--port']) if '--port' in options else None
+        serve(socket_path=options.get('--socket'), port=port,
+              batch_size=int(options.get('--batch', BATCH_SIZE)),
+              wait=float(options.get('--wait', BATCH_WAIT * 1000)) / 1000)
+    elif '--client' in options:
+        shard = parse_shard(options['--shard']) if '--shard' in options else None
+        process_filelist(options['--client'], data_dir, filelist, start, end, shard=shard,
+                         compress=options.get('--compress'))
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -0,0 +1,246 @@
+"""topic_vectors.py
+
+Dense document-by-topic matrix and similar-article search.
+
+When generate_topics.py runs it also writes the full topic distribution of each
+document to DATA_DIR/vec, as raw float32 rows with NUM_TOPICS columns, one pair
+of files for each run:
+
+    DATA_DIR/vec/topics-BEGIN-END.f32     the rows
+    DATA_DIR/vec/topics-BEGIN-END.ids     the file names, one per line
+
+When a run uses --shard the shard is added to these names. Runs of update.py
+use topics-update-TIMESTAMP instead of topics-BEGIN-END and also write a file
+topics-update-TIMESTAMP.deleted with the file names of deleted documents.
+
+These are merged into one memory-mapped matrix with this script. Merging also
+precomputes the row norms and the element-wise square roots of the matrix so that
+queries only need a matrix-vector product.
+
+Usage:
+
+$ python3 topic_vectors.py --merge -d DATA_DIR
+$ python3 topic_vectors.py --similar FILENAME -d DATA_DIR [-k K] [--metric METRIC]
+
+The first invocation creates DATA_DIR/vec/topics.npy, topics.ids, topics.norms.npy
+and topics.sqrt.npy from all the shards in DATA_DIR/vec. If a file name occurs
+in more than one shard the row from the last shard (in sorted order) is used,
+and rows are dropped when their file name is in a .deleted file that comes after
+the shard in sorted order.
+
+The second prints the K (default 10) documents most similar to the document with
+the given file name (as used in the file list), METRIC is either cosine (the
+default) or hellinger.
+
+From Python:
+
+>>> vectors = TopicVectors(data_dir)
+>>> vectors.similar('Sci_Rep/PMC5587738.nxml', k=10, metric='hellinger')
+
+"""
+
+
+import os
+import sys
+import glob
+import getopt
+
+import numpy as np
+
+from utils import time_elapsed, shard_suffix
+
+
+# same as in generate_topics.py
+NUM_TOPICS = 100
+
+# number of rows handled in one go when searching, large enough to make the
+# numpy calls efficient, small enough to stay in the CPU caches: 4096 rows of
+# NUM_TOPICS float32 values are 1.6 MB, which fits in the L2 or L3 cache
+BLOCK_SIZE = 4096
+
+METRICS = ('cosine', 'hellinger')
+
+
+def vectors_dir(data_dir):
+    return os.path.join(data_dir, 'vec')
+
+
+class TopicVectorWriter(object):
+
+    """Appends dense topic vectors for a range of the file list to a shard in
+    DATA_DIR/vec."""
+
+    def __init__(self, data_dir, start, end, num_topics=NUM_TOPICS, shard=None,
+                 name=None):
+        # name replaces the range and the shard in the file names
+        self.num_topics = num_topics
+        if name is None:
+            name = '%07d-%07d%s' % (start, end, shard_suffix(shard))
+        basename = os.path.join(vectors_dir(data_dir), 'topics-%s' % name)
+        os.makedirs(vectors_dir(data_dir), exist_ok=True)
+        self.rows = open(basename + '.f32', 'wb')
+        self.ids = open(basename + '.ids', 'w')
+
+    def add(self, doc_id, topics):
+        """Add a row for doc_id, topics is a list of pairs of topic identifiers and
+        scores, topics not in the list get a zero score."""
+        row = np.zeros(self.num_topics, dtype=np.float32)
+        for topic_id, score in topics:
+            row[topic_id] = score
+        self.rows.write(row.tobytes())
+        self.ids.write(doc_id + "\n")
+
+    def close(self):
+        self.rows.close()
+        self.ids.close()
+
+
+@time_elapsed
+def merge(data_dir, num_topics=NUM_TOPICS):
+    """Merge all shards into DATA_DIR/vec/topics.npy and precompute row norms and
+    square roots."""
+    shards = sorted(glob.glob(os.path.join(vectors_dir(data_dir), 'topics-*.f32')))
+    deletions = glob.glob(os.path.join(vectors_dir(data_dir), 'topics-*.deleted'))
+    rows = {}
+    for fname in sorted(shards + deletions):
+        if fname.endswith('.deleted'):
+            ids = _read_ids(fname)
+            for doc_id in ids:
+                rows.pop(doc_id, None)
+        else:
+            ids = _read_ids(fname[:-4] + '.ids')
+            for i, doc_id in enumerate(ids):
+                rows[doc_id] = (fname, i)
+        print("%8d  %s" % (len(ids), os.path.basename(fname)))
+    doc_ids = list(rows)
+    basename = os.path.join(vectors_dir(data_dir), 'topics')
+    matrix = np.lib.format.open_memmap(basename + '.npy', mode='w+', dtype=np.float32,
+                                       shape=(len(doc_ids), num_topics))
+    row_number = {doc_id: n for n, doc_id in enumerate(doc_ids)}
+    for shard in shards:
+        shard_rows = np.fromfile(shard, dtype=np.float32).reshape(-1, num_topics)
+        ids = _read_ids(shard[:-4] + '.ids')
+        keep = [i for i, doc_id in enumerate(ids) if rows.get(doc_id) == (shard, i)]
+        matrix[[row_number[ids[i]] for i in keep]] = shard_rows[keep]
+    np.save(basename + '.norms.npy', np.linalg.norm(matrix, axis=1).astype(np.float32))
+    sqrt_matrix = np.lib.format.open_memmap(basename + '.sqrt.npy', mode='w+',
+                                            dtype=np.float32, shape=matrix.shape)
+    for i in range(0, len(doc_ids), BLOCK_SIZE):
+        sqrt_matrix[i:i + BLOCK_SIZE] = np.sqrt(matrix[i:i + BLOCK_SIZE])
+    matrix.flush()
+    sqrt_matrix.flush()
+    with open(basename + '.ids', 'w') as fh:
+        for doc_id in doc_ids:
+            fh.write(doc_id + "\n")
+    print("\nMerged %d documents into %s.npy" % (len(doc_ids), basename))
+
+
+def _read_ids(fname):
+    with open(fname) as fh:
+        return [line.rstrip("\n") for line in fh]
+
+
+class TopicVectors(object):
+
+    """Memory-mapped document-by-topic matrix with k-nearest-neighbour search."""
+
+    def __init__(self, data_dir):
+        basename = os.path.join(vectors_dir(data_dir), 'topics')
+        self.matrix = np.load(basename + '.npy', mmap_mode='r')
+        self.norms = np.load(basename + '.norms.npy', mmap_mode='r')
+        self.sqrt_matrix = np.load(basename + '.sqrt.npy', mmap_mode='r')
+        self.ids = _read_ids(basename + '.ids')
+        self._index = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, doc_id):
+        if self._index is None:
+            self._index = {doc_id: n for n, doc_id in enumerate(self.ids)}
+        return self._index[doc_id]
+
+    def vector(self, doc_id):
+        return np.array(self.matrix[self.row(doc_id)])
+
+    def similar(self, doc_id, k=10, metric='cosine'):
+        """Return the k documents most similar to doc_id, not including doc_id."""
+        row = self.row(doc_id)
+        return self.knn(self.matrix[row], k, metric, exclude=row)
+
+    def knn(self, vector, k=10, metric='cosine', exclude=None, block_size=BLOCK_SIZE):
+        """Return a list of k pairs of document identifiers and similarities, sorted
+        on decreasing similarity. For cosine the similarity is the cosine, for
+        hellinger it is one minus the Hellinger distance. The matrix is scanned
+        in blocks of block_size rows, keeping the best k of each block."""
+        if metric not in METRICS:
+            raise ValueError("unknown metric: %s" % metric)
+        vector = np.asarray(vector, dtype=np.float32)
+        if metric == 'cosine':
+            matrix = self.matrix
+            query = vector / max(np.linalg.norm(vector), 1e-12)
+        else:
+            matrix = self.sqrt_matrix
+            query = np.sqrt(vector)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for i in range(0, len(self.ids), block_size):
+            scores = matrix[i:i + block_size] @ query
+            if metric == 'cosine':
+                scores /= np.maximum(self.norms[i:i + block_size], 1e-12)
+            if exclude is not None and i <= exclude < i + block_size:
+                scores[exclude - i] = -np.inf
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+            else:
+                top = np.arange(len(scores))
+            best_rows = np.concatenate([best_rows, top + i])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            if len(best_scores) > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+        order = np.argsort(-best_scores)
+        results = []
+        for row, score in zip(best_rows[order], best_scores[order]):
+            if row == exclude:
+                # only happens if there are no more than k other documents
+                continue
+            if metric == 'hellinger':
+                # the score is the Bhattacharyya coefficient
+                score = 1 - np.sqrt(max(0.0, 1 - score))
+            results.append((self.ids[row], float(score)))
+        return results
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 topic_vectors.py --merge -d DATA_DIR"
+          + "\n    $ python3 topic_vectors.py --similar FILENAME -d DATA_DIR [-k K] [--metric METRIC]"
+          + "\n    $ python3 topic_vectors.py (-h | --help)\n")
+
+
+def main(args):
+    data_dir = '/DATA/eager/sample-01000'
+
+    options = dict(getopt.getopt(args, 'd:k:h',
+                                 ['merge', 'similar=', 'metric=', 'help'])[0])
+    data_dir = options.get('-d', data_dir)
+    help_wanted = True if '-h' in options or '--help' in options else False
+
+    if help_wanted:
+        usage()
+    elif '--merge' in options:
+        merge(data_dir)
+    elif '--similar' in options:
+        vectors = TopicVectors(data_dir)
+        for doc_id, score in vectors.similar(options['--similar'],
+                                             k=int(options.get('-k', 10)),
+                                             metric=options.get('--metric', 'cosine')):
+            print("%.4f  %s" % (score, doc_id))
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
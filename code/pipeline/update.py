@@ -0,0 +1,366 @@
+"""update.py
+
+Incremental updates of a processed corpus.
+
+The pipeline scripts process ranges of a file list, this script instead takes a
+list of changes to the source directory and brings all outputs in the data
+directory up to date, so that a daily update only costs time for the files that
+changed. The state of the source files that were processed is kept in
+DATA_DIR/manifest.tsv, with the size and modification time of each file.
+
+Usage:
+
+$ python3 update.py --init -s SOURCE_DIR -d DATA_DIR -f FILELIST [--skip-tags TAGS]
+      [--max-size BYTES] [--size-policy POLICY] [--references]
+$ python3 update.py --scan DELTA -s SOURCE_DIR -d DATA_DIR -f FILELIST
+$ python3 update.py --apply DELTA -s SOURCE_DIR -d DATA_DIR [--jobs J] [--no-topics]
+      [--changelog FILE] [--compress (gz|zst)] [--references]
+
+The first invocation writes the manifest for a data directory where all files in
+FILELIST were already processed. The --skip-tags, --max-size, --size-policy and
+--references options should be the ones that convert_nxml.py was run with, they
+are saved in DATA_DIR/manifest-settings.json and used for all later updates.
+
+The second compares FILELIST, which should list all files in the source
+directory, with the manifest and writes a delta file to DELTA. This needs to
+look at the size and modification time of every file, but not at their content.
+A delta file can also be created from the lists of new, updated and retracted
+articles that come with the PMC updates. Each line has an operation, a tab and a
+path relative to SOURCE_DIR, where the operation is A (added), M (modified) or
+D (deleted).
+
+The third invocation applies a delta. Added and modified files are run through
+convert_nxml.py, create_lif.py and generate_topics.py, and the jsn, lif, txt and
+top outputs of deleted files are removed. Topic vectors are written to
+DATA_DIR/vec/topics-update-STAMP.f32, with the deleted files in
+topics-update-STAMP.deleted, run topic_vectors.py --merge afterwards to update
+the merged matrix. STAMP is the time and the process id of the update. The
+manifest is updated for all files that were processed without errors. With
+--compress the new outputs are written compressed, and with --references the
+references are extracted even if they were not when the manifest was created.
+
+With --no-topics generate_topics.py is skipped, the top outputs of modified
+files are then left as they are and are out of date, like those of added files
+are missing. The files are listed in DATA_DIR/updates/STAMP-files.txt, run
+generate_topics.py on that file list later to bring the topics up to date.
+
+The citation graph in DATA_DIR/cit is not updated, run citations.py --build
+again after applying deltas. A reminder is printed if the graph exists.
+
+If DATA_DIR/cube.npz exists the journal, year and topic cube is updated as
+well, the topics of the old versions of modified and deleted files are
+subtracted and those of the new versions are added. See cube.py.
+
+A change log is written to DATA_DIR/updates/STAMP-changes.jsonl, or to the
+file given with --changelog. Each line is a JSON object like
+
+    {"op": "add", "fname": "Sci_Rep/PMC5587738.nxml", "id-pmc": "5587738",
+     "id-pmid": "28874676", "outputs": {"jsn": "jsn/Sci_Rep/PMC5587738.nxml", ...}}
+
+where op is add, modify or delete, the output paths are relative to DATA_DIR
+and have a .gz or .zst extension if the outputs are compressed. An
+index loader can apply these in order. Files that could not be processed are
+not in the change log, a later --scan will list them again.
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import getopt
+
+from utils import elements, open_file, existing_file, file_variants
+
+
+MANIFEST = 'manifest.tsv'
+SETTINGS = 'manifest-settings.json'
+UPDATES_DIR = 'updates'
+
+OPERATIONS = {'A': 'add', 'M': 'modify', 'D': 'delete'}
+
+
+def manifest_file(data_dir):
+    return os.path.join(data_dir, MANIFEST)
+
+
+def read_manifest(data_dir):
+    """Return a dictionary from file names to (size, mtime) pairs."""
+    manifest = {}
+    if not os.path.exists(manifest_file(data_dir)):
+        return manifest
+    with open(manifest_file(data_dir)) as fh:
+        for line in fh:
+            fname, size, mtime = line.rstrip("\n").split("\t")
+            manifest[fname] = (int(size), int(mtime))
+    return manifest
+
+
+def settings_file(data_dir):
+    return os.path.join(data_dir, SETTINGS)
+
+
+def read_settings(data_dir):
+    """Return the settings of convert_nxml.py saved by --init, a value of None
+    means that the default of convert_nxml.py is used."""
+    settings = {'skip_tags': None, 'max_size': None, 'size_policy': None,
+                'references': False}
+    if os.path.exists(settings_file(data_dir)):
+        with open(settings_file(data_dir)) as fh:
+            settings.update(json.load(fh))
+    return settings
+
+
+def write_settings(data_dir, settings):
+    with open(settings_file(data_dir), 'w') as fh:
+        json.dump(settings, fh, sort_keys=True, indent=4)
+
+
+def write_manifest(data_dir, manifest):
+    # written to a temporary file first so an interrupted run does not leave a
+    # broken manifest
+    tmp_file = "%s.%d.tmp" % (manifest_file(data_dir), os.getpid())
+    with open(tmp_file, 'w') as fh:
+        for fname in sorted(manifest):
+            fh.write("%s\t%d\t%d\n" % (fname, *manifest[fname]))
+    os.replace(tmp_file, manifest_file(data_dir))
+
+
+def source_state(source_dir, fname):
+    stat = os.stat(os.path.join(source_dir, fname))
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def output_files(fname, topics=True):
+    """Return a dictionary with the outputs for a source file, relative to the
+    data directory."""
+    outputs = {'jsn': os.path.join('jsn', fname),
+               'lif': os.path.join('lif', fname[:-4] + 'lif'),
+               'txt': os.path.join('txt', fname[:-4] + 'txt')}
+    if topics:
+        outputs['top'] = os.path.join('top', fname[:-5] + '.lif')
+    return outputs
+
+
+def init_manifest(source_dir, data_dir, filelist, skip_tags=None, max_size=None,
+                  size_policy=None, references=False):
+    import convert_nxml
+    if size_policy is not None and size_policy not in convert_nxml.SIZE_POLICIES:
+        raise ValueError("size policy should be one of %s" % ', '.join(convert_nxml.SIZE_POLICIES))
+    manifest = {}
+    for n, fname in elements(filelist, 1, sys.maxsize):
+        manifest[fname] = source_state(source_dir, fname)
+    write_manifest(data_dir, manifest)
+    write_settings(data_dir, {'skip_tags': skip_tags, 'max_size': max_size,
+                              'size_policy': size_policy, 'references': references})
+    print("Wrote manifest with %d files" % len(manifest))
+
+
+def scan(source_dir, data_dir, filelist, delta_file):
+    manifest = read_manifest(data_dir)
+    seen = set()
+    counts = {op: 0 for op in OPERATIONS}
+    with open(delta_file, 'w') as fh:
+        def write(op, fname):
+            fh.write("%s\t%s\n" % (op, fname))
+            counts[op] += 1
+        for n, fname in elements(filelist, 1, sys.maxsize):
+            seen.add(fname)
+            try:
+                state = source_state(source_dir, fname)
+            except OSError:
+                continue
+            if fname not in manifest:
+                write('A', fname)
+            elif manifest[fname] != state:
+                write('M', fname)
+        for fname in sorted(set(manifest).difference(seen)):
+            write('D', fname)
+    print("Added %(A)d, modified %(M)d, deleted %(D)d" % counts)
+
+
+def read_delta(delta_file):
+    """Return a list of (operation, fname) pairs. If a file occurs more than once
+    the last operation is used."""
+    changes = {}
+    with open(delta_file) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2 or not fields[0]:
+                continue
+            op = fields[0].upper()
+            if op not in OPERATIONS:
+                raise ValueError("unknown operation in delta: %s" % line.strip())
+            changes.pop(fields[1], None)
+            changes[fields[1]] = op
+    return [(op, fname) for fname, op in changes.items()]
+
+
+def apply_delta(source_dir, data_dir, delta_file, jobs=1, topics=True, changelog=None,
+                compress=None, references=False):
+    # the process id keeps updates that start in the same second apart
+    stamp = "%s-%d" % (time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+    changes = read_delta(delta_file)
+    updates_dir = os.path.join(data_dir, UPDATES_DIR)
+    os.makedirs(updates_dir, exist_ok=True)
+    todo = [fname for op, fname in changes if op != 'D']
+    # the stages and the cube are only loaded when a delta is applied
+    import convert_nxml
+    import create_lif
+    import cube
+    settings = read_settings(data_dir)
+    reader = convert_nxml.NxmlReader(
+        convert_nxml.SKIP_TAGS if settings['skip_tags'] is None else settings['skip_tags'],
+        settings['max_size'], settings['size_policy'] or 'truncate')
+    references = references or settings['references']
+    ids = {}
+    topic_cube = cube.Cube.load(cube.cube_file(data_dir)) if os.path.exists(cube.cube_file(data_dir)) else None
+    for op, fname in changes:
+        # read the identifiers before the outputs are removed, and remove the
+        # old outputs so that a missing output shows that processing failed
+        ids[fname] = _read_ids(data_dir, fname)
+        if topic_cube is not None:
+            _update_cube(topic_cube, data_dir, fname, -1)
+        # without topics the old topics of modified files are kept
+        remove_outputs(data_dir, fname, topics or op == 'D')
+    if todo:
+        filelist = os.path.join(updates_dir, stamp + '-files.txt')
+        with open(filelist, 'w') as fh:
+            for fname in todo:
+                fh.write(fname + "\n")
+        convert_nxml.process_filelist(source_dir, data_dir, filelist, 1, len(todo), jobs=jobs,
+                                      reader=reader, compress=compress, references=references)
+        create_lif.process_filelist(data_dir, filelist, 1, len(todo), jobs=jobs,
+                                    compress=compress)
+        if topics:
+            # only loaded when needed, it loads gensim and nltk
+            import generate_topics
+            generate_topics.generate_topics(data_dir, filelist, 1, len(todo), jobs=jobs,
+                                            vectors_name='update-' + stamp,
+                                            compress=compress)
+    manifest = read_manifest(data_dir)
+    entries = []
+    failed = 0
+    for op, fname in changes:
+        outputs = {kind: os.path.relpath(existing_file(os.path.join(data_dir, path)), data_dir)
+                   for kind, path in output_files(fname, topics).items()}
+        if op == 'D':
+            manifest.pop(fname, None)
+        elif all(os.path.exists(os.path.join(data_dir, path)) for path in outputs.values()):
+            manifest[fname] = source_state(source_dir, fname)
+            ids[fname] = _read_ids(data_dir, fname)
+            if topic_cube is not None:
+                _update_cube(topic_cube, data_dir, fname, 1)
+        else:
+            failed += 1
+            continue
+        entry = {'op': OPERATIONS[op], 'fname': fname}
+        entry.update(ids[fname])
+        if op != 'D':
+            entry['outputs'] = outputs
+        entries.append(entry)
+    deleted = [fname for op, fname in changes if op == 'D']
+    if deleted and topics:
+        os.makedirs(os.path.join(data_dir, 'vec'), exist_ok=True)
+        with open(os.path.join(data_dir, 'vec', 'topics-update-%s.deleted' % stamp), 'w') as fh:
+            for fname in deleted:
+                fh.write(fname + "\n")
+    write_manifest(data_dir, manifest)
+    if topic_cube is not None:
+        topic_cube.save(cube.cube_file(data_dir))
+    if changelog is None:
+        changelog = os.path.join(updates_dir, stamp + '-changes.jsonl')
+    with open(changelog, 'w') as fh:
+        for entry in entries:
+            fh.write(json.dumps(entry, sort_keys=True) + "\n")
+    print("\nApplied %d changes, %d failed, wrote %s" % (len(entries), failed, changelog))
+    if todo and not topics:
+        print("The topics of the files in %s are missing or out of date, run"
+              " generate_topics.py -f %s -s 1 -e %d" % (filelist, filelist, len(todo)))
+    if os.path.exists(os.path.join(data_dir, 'cit')):
+        print("The citation graph in %s is out of date, run citations.py --build"
+              % os.path.join(data_dir, 'cit'))
+
+
+def _read_ids(data_dir, fname):
+    """Return the pmc and pmid identifiers from the JSON file, if there is one."""
+    try:
+        with open_file(existing_file(os.path.join(data_dir, 'jsn', fname))) as fh:
+            json_obj = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    return {key: json_obj.get(key) for key in ('id-pmc', 'id-pmid')}
+
+
+def _update_cube(topic_cube, data_dir, fname, sign):
+    """Add the document to the cube, or subtract it if sign is -1. Does nothing
+    if the document has no topic file."""
+    import cube
+    try:
+        entry = cube.document_entry(data_dir, fname)
+    except Exception as e:
+        sys.stderr.write("\nERROR updating the cube for %s  %s\n" % (fname, e))
+        return
+    if entry is not None:
+        topic_cube.add(entry, sign)
+
+
+def remove_outputs(data_dir, fname, topics=True):
+    for path in output_files(fname, topics).values():
+        for variant in file_variants(os.path.join(data_dir, path)):
+            try:
+                os.remove(variant)
+            except FileNotFoundError:
+                pass
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 update.py --init -s SOURCE_DIR -d DATA_DIR -f FILELIST [--skip-tags TAGS]"
+          + "\n          [--max-size BYTES] [--size-policy POLICY] [--references]"
+          + "\n    $ python3 update.py --scan DELTA -s SOURCE_DIR -d DATA_DIR -f FILELIST"
+          + "\n    $ python3 update.py --apply DELTA -s SOURCE_DIR -d DATA_DIR [--jobs J] [--no-topics]"
+          + "\n          [--changelog FILE] [--compress (gz|zst)] [--references]"
+          + "\n    $ python3 update.py (-h | --help)\n")
+
+
+def main(args):
+    source_dir = '/DATA/eager/pubmed-01000'
+    data_dir = '/DATA/eager/sample-01000'
+    filelist = '../../data/files-random-01000.txt'
+
+    options = dict(getopt.getopt(
+        args, 's:d:f:h',
+        ['init', 'scan=', 'apply=', 'jobs=', 'no-topics', 'changelog=', 'compress=',
+         'references', 'skip-tags=', 'max-size=', 'size-policy=', 'help'])[0])
+    source_dir = options.get('-s', source_dir)
+    data_dir = options.get('-d', data_dir)
+    filelist = options.get('-f', filelist)
+
+    if '-h' in options or '--help' in options:
+        usage()
+    elif '--init' in options:
+        skip_tags = None
+        if '--skip-tags' in options:
+            skip_tags = [t for t in options['--skip-tags'].split(',') if t]
+        init_manifest(source_dir, data_dir, filelist, skip_tags=skip_tags,
+                      max_size=int(options['--max-size']) if '--max-size' in options else None,
+                      size_policy=options.get('--size-policy'),
+                      references='--references' in options)
+    elif '--scan' in options:
+        scan(source_dir, data_dir, filelist, options['--scan'])
+    elif '--apply' in options:
+        apply_delta(source_dir, data_dir, options['--apply'],
+                    jobs=int(options.get('--jobs', 1)),
+                    topics='--no-topics' not in options,
+                    changelog=options.get('--changelog'),
+                    compress=options.get('--compress'),
+                    references='--references' in options)
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1:])
@@ -1,38 +1,380 @@
+
 import os
+import sys
 import time
+import gzip
+import zlib
+import threading
+import collections
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for files with the .zst extension
+    zstandard = None
+
+
+# defaults for the pipelined reading and writing in the pipeline scripts, see
+# Prefetcher and BackgroundWriter
+PREFETCH = 8
+READERS = 4
+WRITERS = 4
+
+# extensions of compressed files and compression levels, see open_file()
+COMPRESSIONS = ('gz', 'zst')
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
 
 
 def time_elapsed(fun):
     """Function to be used as a decorator for measuring time elapsed."""
     def wrapper(*args, **kwargs):
         t0 = time.time()
-        fun(*args, **kwargs)
+        result = fun(*args, **kwargs)
         print("\nTime elapsed = %s" % (time.time() - t0))
+        return result
     return wrapper
 
 
-def elements(filelist, start, end):
+def elements(filelist, start, end, shard=None):
     """Generator over the lines in filelist, only yielding lines from line niumber
-    start up to and including end."""
-    process = False
+    start up to and including end. If shard is given, which should be a tuple
+    as returned by parse_shard(), only the lines in that shard are yielded.
+
+    If there is an index for the file list (see index_filelist()) the generator
+    seeks directly to line start, otherwise the index is created first."""
+    offsets = load_index(filelist)
+    if offsets is None:
+        offsets = index_filelist(filelist)
+    if offsets is None:
+        yield from _scan_elements(filelist, start, end, shard)
+        return
+    start = max(start, 1)
+    end = min(end, len(offsets) - 1)
+    with open(filelist, 'rb') as fh:
+        if shard is not None and shard[0] == 'mod':
+            # only visit the lines in the shard
+            _, i, count = shard
+            first = start + (i - start) % count
+            for n in range(first, end + 1, count):
+                fh.seek(offsets[n - 1])
+                yield (n, _filename(fh.readline().decode('utf8')))
+            return
+        if start > end:
+            return
+        fh.seek(offsets[start - 1])
+        for n in range(start, end + 1):
+            fname = _filename(fh.readline().decode('utf8'))
+            if shard is None or in_shard(n, fname, shard):
+                yield (n, fname)
+
+
+def _scan_elements(filelist, start, end, shard):
     n = 1
     with open(filelist) as fh:
         for line in fh:
-            fname = line.strip()
-            if n == start:
-                process = True
             if n > end:
                 return
-            if process:
-                yield (n, fname)
+            if n >= start:
+                fname = _filename(line)
+                if shard is None or in_shard(n, fname, shard):
+                    yield (n, fname)
             n += 1
 
 
+def _filename(line):
+    # file lists created by get_filenames.py have the file size in a second
+    # column, separated by a tab
+    return line.strip().split('\t', 1)[0]
+
+
+def index_filename(filelist):
+    return filelist + '.idx'
+
+
+def index_filelist(filelist):
+    """Write an index for filelist and return it. The index is an array of 64-bit
+    integers with the byte offset of each line, followed by the size of the
+    file, so line n starts at offsets[n-1]. It is written next to the file list
+    with an .idx extension. Returns None if the index could not be written."""
+    offsets = array('q', [0])
+    with open(filelist, 'rb') as fh:
+        for line in fh:
+            offsets.append(offsets[-1] + len(line))
+    index_file = index_filename(filelist)
+    tmp_file = "%s.%d.tmp" % (index_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as fh:
+            offsets.tofile(fh)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        return None
+    return offsets
+
+
+def load_index(filelist):
+    """Return the index of the file list, or None if there is no index or if it is
+    out of date."""
+    index_file = index_filename(filelist)
+    if not os.path.exists(index_file):
+        return None
+    if os.path.getmtime(index_file) < os.path.getmtime(filelist):
+        return None
+    offsets = array('q')
+    with open(index_file, 'rb') as fh:
+        offsets.frombytes(fh.read())
+    if not offsets or offsets[-1] != os.path.getsize(filelist):
+        return None
+    return offsets
+
+
+def count_lines(filelist):
+    """Return the number of lines in the file list, using the index if possible."""
+    offsets = load_index(filelist) or index_filelist(filelist)
+    if offsets is not None:
+        return len(offsets) - 1
+    with open(filelist, 'rb') as fh:
+        return sum(1 for _ in fh)
+
+
+def parse_shard(spec):
+    """Parse a shard specification as used with the --shard option. The spec is
+    I/N for the I-th of N shards (counting from 1) where lines are distributed
+    round robin, or hash:I/N where lines are assigned to shards by a hash of
+    the file name, which does not change when lines are added or removed."""
+    mode = 'mod'
+    if spec.startswith('hash:'):
+        mode, spec = 'hash', spec[5:]
+    i, count = [int(x) for x in spec.split('/')]
+    if not 1 <= i <= count:
+        raise ValueError("illegal shard specification: %s" % spec)
+    return (mode, i, count)
+
+
+def in_shard(n, fname, shard):
+    """Return True if line n with file name fname is in the shard."""
+    mode, i, count = shard
+    if mode == 'hash':
+        return zlib.crc32(fname.encode('utf8')) % count == i - 1
+    return (n - 1) % count == i - 1
+
+
+def shard_suffix(shard):
+    """Return a string that can be added to file names created for a shard."""
+    if shard is None:
+        return ''
+    return "-shard-%s%02d-of-%02d" % ('h' if shard[0] == 'hash' else '', shard[1], shard[2])
+
+
+class Prefetcher(object):
+
+    """Iterates over items while reading the inputs for the next ones on reader
+    threads, so that reading overlaps with processing. Yields triples of the
+    item, the result of read(item) and the number of seconds the read took. If
+    the read raised an exception the exception is yielded instead of the result,
+    so that it can be handled with the other errors for the item.
+
+    At most depth items are read ahead. To also bound the number of items that
+    were handed out but not yet processed, for example because they are waiting
+    for a worker process, the consumer calls done() for each item when it is
+    finished with it, and at most depth + jobs items are in memory at any time.
+
+    When the consumer stops early, for example because a worker raised an
+    exception, it calls close(). Otherwise the iterator can wait forever for
+    done() calls that never come, which with a multiprocessing pool means that
+    the thread of the pool that hands out the items never finishes and
+    terminating the pool hangs."""
+
+    def __init__(self, items, read, depth=PREFETCH, threads=READERS, jobs=1):
+        self.items = items
+        self.read = read
+        self.depth = max(1, depth)
+        self.threads = max(1, threads)
+        self.slots = threading.Semaphore(self.depth + max(1, jobs))
+        self.stopped = threading.Event()
+
+    def __iter__(self):
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.threads) as executor:
+            for item in self.items:
+                if not self._acquire():
+                    return
+                pending.append((item, executor.submit(self._timed_read, item)))
+                if len(pending) > self.depth:
+                    yield self._result(*pending.popleft())
+            while pending and not self.stopped.is_set():
+                yield self._result(*pending.popleft())
+
+    def _acquire(self):
+        """Wait for a free slot, returns False if the prefetcher was closed."""
+        while not self.stopped.is_set():
+            if self.slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def done(self):
+        self.slots.release()
+
+    def close(self):
+        """Stop handing out items."""
+        self.stopped.set()
+
+    def _timed_read(self, item):
+        t0 = time.perf_counter()
+        try:
+            result = self.read(item)
+        except Exception as e:
+            result = e
+        return result, time.perf_counter() - t0
+
+    @staticmethod
+    def _result(item, future):
+        result, seconds = future.result()
+        return item, result, seconds
+
+
+class BackgroundWriter(object):
+
+    """Writes files on a pool of threads. At most max_pending writes are waiting,
+    after that write() blocks, which bounds the memory used for the data that
+    still needs to be written. Directories are created as needed. If compression
+    is given, one of COMPRESSIONS, files are written compressed and the
+    extension is added to the file names. Errors are printed and the names of
+    the files that could not be written are returned by close()."""
+
+    def __init__(self, threads=WRITERS, max_pending=None, encoding='utf8', compression=None):
+        # fails early if the compression is not available
+        compressed_name('', compression)
+        self.threads = max(1, threads)
+        self.compression = compression
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = threading.Semaphore(max_pending or 2 * self.threads)
+        self.encoding = encoding
+        self.lock = threading.Lock()
+        self.failed = []
+
+    def write(self, fname, data):
+        self.pending.acquire()
+        future = self.executor.submit(self._write, fname, data)
+        future.add_done_callback(lambda f: self.pending.release())
+
+    def write_all(self, outputs):
+        for fname, data in outputs:
+            self.write(fname, data)
+
+    def _write(self, fname, data):
+        try:
+            write_file(compressed_name(fname, self.compression), data, self.encoding)
+        except Exception as e:
+            sys.stderr.write("\nERROR writing %s  %s\n" % (fname, e))
+            with self.lock:
+                self.failed.append(fname)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        return self.failed
+
+
+def open_file(fname, mode='r', encoding='utf8'):
+    """Open a text file for reading (mode 'r') or writing (mode 'w'). The file is
+    compressed with gzip if the name ends in .gz and with zstd if it ends in .zst,
+    compressed files are read and written as streams."""
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode + 't', compresslevel=GZIP_LEVEL, encoding=encoding)
+    if fname.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("the zstandard package is needed for %s" % fname)
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if mode == 'w' else None
+        return zstandard.open(fname, mode + 't', cctx=cctx, encoding=encoding)
+    return open(fname, mode, encoding=encoding)
+
+
+def compressed_name(fname, compression):
+    """Return the name of fname compressed with compression, which is None or one
+    of COMPRESSIONS."""
+    if compression is None:
+        return fname
+    if compression not in COMPRESSIONS:
+        raise ValueError("compression should be one of %s" % ', '.join(COMPRESSIONS))
+    if compression == 'zst' and zstandard is None:
+        raise ImportError("the zstandard package is needed for zst compression")
+    return fname + '.' + compression
+
+
+def file_variants(fname):
+    """Return the uncompressed and compressed names for a file."""
+    return [fname] + [fname + '.' + compression for compression in COMPRESSIONS]
+
+
+def existing_file(fname):
+    """Return the first of the uncompressed and compressed names of fname that
+    exists, or fname itself if none of them exist."""
+    for variant in file_variants(fname):
+        if os.path.exists(variant):
+            return variant
+    return fname
+
+
+def write_file(fname, data, encoding='utf8'):
+    """Write data to fname, compressed as given by its extension, and remove the
+    file with the same name but another compression, if there is one, so that
+    existing_file() does not find a stale copy."""
+    ensure_directory(fname)
+    with open_file(fname, 'w', encoding) as fh:
+        fh.write(data)
+    base = fname.rsplit('.', 1)[0] if fname.endswith(('.gz', '.zst')) else fname
+    for variant in file_variants(base):
+        if variant != fname and os.path.exists(variant):
+            os.remove(variant)
+
+
 def ensure_directory(*fnames):
     """Ensure the directory part of all file names exists."""
     for fname in fnames:
         directory = os.path.split(fname)[0]
         if not os.path.exists(directory):
-            os.makedirs(directory)
+            # other processes may be creating the same directory
+            os.makedirs(directory, exist_ok=True)
+
+
+def write_strings(basename, strings):
+    """Write strings as concatenated utf8 bytes to basename.bin plus an array of
+    offsets to basename.offsets.npy, see MappedStrings. The strings can come
+    from any iterable, for example a generator."""
+    # numpy is imported here since most users of this module do not need it
+    import numpy as np
+    offsets = array('q', [0])
+    with open(basename + '.bin', 'wb') as fh:
+        for s in strings:
+            data = s.encode('utf8')
+            fh.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(basename + '.offsets.npy', np.frombuffer(offsets, dtype=np.int64))
+
+
+class MappedStrings(object):
+
+    """Memory-mapped list of strings written by write_strings()."""
+
+    def __init__(self, basename):
+        import numpy as np
+        self.offsets = np.load(basename + '.offsets.npy', mmap_mode='r')
+        size = int(self.offsets[-1])
+        self.data = np.memmap(basename + '.bin', dtype=np.uint8, mode='r') if size else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf8')
+
 
+if __name__ == '__main__':
 
+    # $ python3 utils.py --index FILELIST
+    if len(sys.argv) == 3 and sys.argv[1] == '--index':
+        print("Indexed %d lines" % (len(index_filelist(sys.argv[2])) - 1))
+    else:
+        print("\nUsage:\n\n    $ python3 utils.py --index FILELIST\n")
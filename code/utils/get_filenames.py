@@ -1,11 +1,26 @@
 """get_filenames.py
 
 Get all the filenames from the Pubmed Central directory and write them to
-files_sorted.txt. You can also run this on a directory that has a sample of all
+files-sorted.txt. You can also run this on a directory that has a sample of all
 files as long as the structure of the directory is the same (see get_sample.py
 on how to create such a directory).
 
-Next step often is to randomize that file using
+Usage:
+
+$ python3 get_filenames.py [-s PUBMED_DIR] [-o SORTED_LIST] [-r RANDOM_LIST]
+                           [--seed N] [--workers N] [--buckets N]
+
+Journal directories are scanned concurrently by WORKERS threads (default 16),
+which helps a lot on networked storage. Each line of the output has the path of
+the file relative to PUBMED_DIR and the size of the file in bytes, separated by
+a tab. The pipeline scripts only use the first column, the sizes are there for
+scheduling work. Journals and file names within journals are sorted.
+
+With -r a randomized version of the list is also written. This uses an
+external-memory shuffle: lines are first distributed at random over BUCKETS
+temporary files (default 64) and then each bucket is shuffled in memory and
+appended to the output. The shuffle is reproducible given the same SEED (default
+42). This replaces what we used to do, which needs the full list in memory:
 
 $ sort -R files-sorted.txt > files-random.txt
 $ cat files-sorted.txt | perl -MList::Util -e 'print List::Util::shuffle <>' > files-random.txt
@@ -14,22 +29,85 @@ $ cat files-sorted.txt | perl -MList::Util -e 'print List::Util::shuffle <>' > f
 
 
 import os
+import sys
+import random
+import getopt
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 PUBMED_DIR = '/data/random-dataset-trunk/ftp.ncbi.nlm.nih.gov/pub/pmc/oa_bulk/decompressed'
 PUBMED_DIR = '/DATA/eager/pubmed-01000'
 PUBMED_DIR = '/DATA/eager/pubmed-10000'
 
+SORTED_LIST = 'files-sorted.txt'
+
+WORKERS = 16
+BUCKETS = 64
+SEED = 42
+
+
+def scan_journal(pubmed_dir, journal):
+    """Return a sorted list of (path, size) pairs for all files in a journal
+    directory, paths are relative to pubmed_dir."""
+    files = []
+    with os.scandir(os.path.join(pubmed_dir, journal)) as entries:
+        for entry in entries:
+            if entry.is_file():
+                files.append((os.path.join(journal, entry.name), entry.stat().st_size))
+    return sorted(files)
+
+
+def write_filenames(pubmed_dir, sorted_list, workers=WORKERS):
+    journals = sorted(entry.name for entry in os.scandir(pubmed_dir) if entry.is_dir())
+    doc_count = 0
+    with open(sorted_list, 'w') as out, ThreadPoolExecutor(workers) as executor:
+        # map() hands back results in the order of the journals while the
+        # directories further down the list are being scanned
+        for journal, files in zip(journals, executor.map(
+                lambda journal: scan_journal(pubmed_dir, journal), journals)):
+            print("%6d  %s" % (len(files), journal))
+            doc_count += len(files)
+            for path, size in files:
+                out.write("%s\t%d\n" % (path, size))
+    print("\nTOTAL = %d" % doc_count)
+
+
+def shuffle_filenames(sorted_list, random_list, seed=SEED, buckets=BUCKETS):
+    """Write a random permutation of the lines in sorted_list to random_list without
+    loading all lines in memory."""
+    rng = random.Random(seed)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(random_list)))
+    try:
+        bucket_files = [open(os.path.join(tmp_dir, "%04d" % i), 'w')
+                        for i in range(buckets)]
+        with open(sorted_list) as fh:
+            for line in fh:
+                bucket_files[rng.randrange(buckets)].write(line)
+        for bucket_file in bucket_files:
+            bucket_file.close()
+        with open(random_list, 'w') as out:
+            for bucket_file in bucket_files:
+                with open(bucket_file.name) as fh:
+                    lines = fh.readlines()
+                rng.shuffle(lines)
+                out.writelines(lines)
+    finally:
+        shutil.rmtree(tmp_dir)
+
 
-journals = os.listdir(PUBMED_DIR)
-file_list = open('files-sorted.txt', 'w')
+if __name__ == '__main__':
 
-c = 0
-for journal in journals:
-    c += 1
-    # if c > 10: break
-    journal_dir = os.path.join(PUBMED_DIR, journal)
-    fnames = os.listdir(journal_dir)
-    print("%6d  %s" % (len(fnames), journal))
-    for fname in os.listdir(journal_dir):
-        file_list.write("%s\n" % os.path.join(journal, fname))
+    options = dict(getopt.getopt(sys.argv[1:], 's:o:r:h',
+                                 ['seed=', 'workers=', 'buckets=', 'help'])[0])
+    if '-h' in options or '--help' in options:
+        print(__doc__)
+        exit()
+    pubmed_dir = options.get('-s', PUBMED_DIR)
+    sorted_list = options.get('-o', SORTED_LIST)
+    write_filenames(pubmed_dir, sorted_list, int(options.get('--workers', WORKERS)))
+    if '-r' in options:
+        shuffle_filenames(sorted_list, options['-r'],
+                          seed=int(options.get('--seed', SEED)),
+                          buckets=int(options.get('--buckets', BUCKETS)))
@@ -4,58 +4,125 @@ Get a random sample of the pubmed files and write them to a directory.
 
 Usage
 
-$ python3 get_sample.py DIRECTORY LIMIT
+$ python3 get_sample.py [OPTIONS] DIRECTORY LIMIT
 
 DIRECTORY is the directory to write the files to and LIMIT is how many
 files you write. Directory structure is the same as in the source,
 that is, it has directories for each journal.
 
 Relies on having the file with the randomized list of file names in
-FILELIST.
+FILELIST, by default the first LIMIT files from that list are taken.
+
+Options:
+
+-f FILELIST     file list to sample from (default files_random.txt)
+-s PUBMED_DIR   directory with the source files
+--stratified    take a sample where each journal has the same share of files
+                as in the file list, files are picked at random within each
+                journal, so the file list does not need to be randomized
+--seed N        random seed for --stratified (default 42)
+--mode MODE     one of copy (the default), hardlink or symlink, the last two do
+                not copy any data, hardlinks need the sample to be on the same
+                file system as the source
+--workers N     number of threads used for copying (default 16)
 
 This can be used to generate a mini corpus that can be easily zipped
-and moved elsewhere. Note that for local processing we tend to use
-file lists that point to the source.
+and moved elsewhere (use copy or hardlink for that, not symlink). Note
+that for local processing we tend to use file lists that point to the
+source.
 
 """
 
 
 import os
 import sys
+import random
+import getopt
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 
 PUBMED_DIR = '/data/random-dataset-trunk/ftp.ncbi.nlm.nih.gov/pub/pmc/oa_bulk/decompressed'
 FILELIST = 'files_random.txt'
 
-
-output_dir = sys.argv[1]
-limit = int(sys.argv[2])
-
-print("Writing %d files to %s" % (limit, output_dir))
-
-file_list = open('files_random.txt')
-
-journals = set()
-files = []
-
-c = 0
-for line in file_list:
-    c += 1
-    if c > limit:
-        break
-    fname = line.strip()
-    journal = os.path.split(fname)[0]
-    journals.add(journal)
-    files.append(fname)
-
-for i, journal in enumerate(sorted(journals)):
-    print(i, journal)
-
-os.mkdir(output_dir)
-for journal in journals:
-    os.mkdir(os.path.join(output_dir, journal))
-for fname in files:
-    source = os.path.join(PUBMED_DIR, fname)
-    target = os.path.join(output_dir, fname)
-    shutil.copyfile(source, target)
+MODES = ('copy', 'hardlink', 'symlink')
+WORKERS = 16
+SEED = 42
+
+
+def read_filelist(filelist, limit=None):
+    files = []
+    with open(filelist) as fh:
+        for line in fh:
+            if limit is not None and len(files) >= limit:
+                break
+            # file lists from get_filenames.py also have the file size
+            files.append(line.strip().split('\t')[0])
+    return files
+
+
+def stratified_sample(files, limit, seed=SEED):
+    """Return a sample of limit files where each journal has the same share as in
+    files, shares are rounded using the largest remainder method."""
+    journals = {}
+    for fname in files:
+        journals.setdefault(os.path.split(fname)[0], []).append(fname)
+    limit = min(limit, len(files))
+    quotas = {j: limit * len(fnames) / len(files) for j, fnames in journals.items()}
+    counts = {j: int(quota) for j, quota in quotas.items()}
+    leftover = limit - sum(counts.values())
+    for j in sorted(quotas, key=lambda j: (counts[j] - quotas[j], j))[:leftover]:
+        counts[j] += 1
+    rng = random.Random(seed)
+    sample = []
+    for journal in sorted(journals):
+        sample.extend(rng.sample(journals[journal], counts[journal]))
+    return sample
+
+
+def materialize(source, target, mode):
+    if mode == 'hardlink':
+        os.link(source, target)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(source), target)
+    else:
+        shutil.copyfile(source, target)
+
+
+def write_sample(files, pubmed_dir, output_dir, mode='copy', workers=WORKERS):
+    journals = set(os.path.split(fname)[0] for fname in files)
+    for i, journal in enumerate(sorted(journals)):
+        print(i, journal)
+    os.mkdir(output_dir)
+    for journal in journals:
+        os.mkdir(os.path.join(output_dir, journal))
+    def process(fname):
+        materialize(os.path.join(pubmed_dir, fname), os.path.join(output_dir, fname), mode)
+    with ThreadPoolExecutor(workers) as executor:
+        # list() so that exceptions in the threads are raised here
+        list(executor.map(process, files))
+
+
+if __name__ == '__main__':
+
+    opts, args = getopt.getopt(sys.argv[1:], 'f:s:h',
+                               ['stratified', 'seed=', 'mode=', 'workers=', 'help'])
+    options = dict(opts)
+    if '-h' in options or '--help' in options or len(args) != 2:
+        exit(__doc__)
+    output_dir = args[0]
+    limit = int(args[1])
+    mode = options.get('--mode', 'copy')
+    if mode not in MODES:
+        exit("ERROR: mode should be one of %s" % ', '.join(MODES))
+    filelist = options.get('-f', FILELIST)
+
+    print("Writing %d files to %s" % (limit, output_dir))
+
+    if '--stratified' in options:
+        files = stratified_sample(read_filelist(filelist), limit,
+                                  int(options.get('--seed', SEED)))
+    else:
+        files = read_filelist(filelist, limit)
+    write_sample(files, options.get('-s', PUBMED_DIR), output_dir, mode,
+                 int(options.get('--workers', WORKERS)))